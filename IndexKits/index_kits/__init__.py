@@ -4,7 +4,7 @@ from .bucket import (
     build_multi_resolution_bucket
 )
 from .bucket import Resolution, ResolutionGroup
-from .indexer import IndexV2Builder, ArrowIndexV2
+from .indexer import IndexV2Builder, ArrowIndexV2, ArrowTableCache
 from .common import load_index, show_index_info
 
 __version__ = "0.3.5"
@@ -1,14 +1,21 @@
 import bisect
+import hashlib
+import io
 import json
+import os
 import random
+from multiprocessing import Pool
 from pathlib import Path
 from typing import Optional, Dict, List, Callable, Union
 
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 from tqdm import tqdm
 from PIL import Image
 
-from .indexer import ArrowIndexV2, IndexV2Builder
+from .indexer import ArrowIndexV2, ArrowTableCache, IndexV2Builder, interleave_by_label, get_table, \
+    load_indices_file
 
 
 class Resolution(object):
@@ -185,7 +192,7 @@ class Bucket(ArrowIndexV2):
         return scale
 
     @staticmethod
-    def from_bucket_index(index_file, align=1, shadow_file_fn=None):
+    def from_bucket_index(index_file, align=1, shadow_file_fn=None, table_cache_size=1, table_cache_bytes=None):
         with open(index_file, 'r') as f:
             res_dict = json.load(f)
 
@@ -203,7 +210,10 @@ class Bucket(ArrowIndexV2):
         assert Path(indices_file).exists(), f'indices_file {indices_file} not found'
 
         # Loading indices data
-        indices_data = np.load(indices_file)
+        indices_data = load_indices_file(indices_file)
+
+        # All buckets share the same arrow files, so they share one table cache.
+        table_cache = ArrowTableCache(table_cache_size, table_cache_bytes)
 
         # Build buckets
         buckets = []
@@ -220,7 +230,9 @@ class Bucket(ArrowIndexV2):
             data['group_length'] = res_dict['group_length'][k]
 
             height, width = map(int, k.split('x'))
-            bucket = Bucket(height, width, res_dict=data, align=align, shadow_file_fn=shadow_file_fn)
+            bucket = Bucket(height, width, res_dict=data, align=align, shadow_file_fn=shadow_file_fn,
+                            table_cache_size=table_cache_size, table_cache_bytes=table_cache_bytes,
+                            table_cache=table_cache)
 
             if len(bucket) > 0:
                 buckets.append(bucket)
@@ -257,6 +269,11 @@ class MultiIndexV2(object):
         is 'default'.
     seed: int
         Only used when sample_strategy=='probability'. The seed to sample the indices.
+    table_cache_size: int
+        The maximum number of arrow files kept open at the same time by each index. Default to 1.
+    table_cache_bytes: int
+        The maximum number of mapped bytes kept open at the same time by each index. If None, only
+        table_cache_size is used.
     """
     buckets: List[ArrowIndexV2]
 
@@ -268,9 +285,12 @@ class MultiIndexV2(object):
                  probability: Optional[List[float]] = None,
                  shadow_file_fn: Optional[Union[Callable, Dict[str, Callable]]] = None,
                  seed: Optional[int] = None,
+                 table_cache_size: int = 1,
+                 table_cache_bytes: Optional[int] = None,
                  ):
         self.buckets = self.load_buckets(index_files,
-                                         batch_size=batch_size, world_size=world_size, shadow_file_fn=shadow_file_fn)
+                                         batch_size=batch_size, world_size=world_size, shadow_file_fn=shadow_file_fn,
+                                         table_cache_size=table_cache_size, table_cache_bytes=table_cache_bytes)
 
         self.sample_strategy = sample_strategy
         self.probability = probability
@@ -334,7 +354,45 @@ class MultiIndexV2(object):
             cum_length.append(length)
         return cum_length
 
-    def shuffle(self, seed=None, fast=False):
+    def table_cache_info(self, shadow=None):
+        """
+        Get the hit/miss counters of the arrow table caches, summed over all sub-indexes.
+        Caches shared by several sub-indexes are only counted once.
+        """
+        caches = {}
+        self._collect_table_caches(caches, shadow)
+        info = {'hits': 0, 'misses': 0, 'evictions': 0, 'tables': 0, 'mapped_bytes': 0}
+        for cache in caches.values():
+            for k, v in cache.info().items():
+                if k in info:
+                    info[k] += v
+        total = info['hits'] + info['misses']
+        info['hit_rate'] = info['hits'] / total if total > 0 else 0.
+        return info
+
+    def _collect_table_caches(self, caches, shadow=None):
+        for bucket in self.buckets:
+            if isinstance(bucket, MultiIndexV2):
+                bucket._collect_table_caches(caches, shadow)
+            else:
+                cache = bucket._table_cache if shadow is None else bucket._shadow_table_cache[shadow]
+                caches[id(cache)] = cache
+
+    def shuffle(self, seed=None, fast=False, locality=0):
+        """
+        Shuffle the indexes and the indices in each index.
+
+        Parameters
+        ----------
+        seed: int
+            The random seed.
+        fast: bool
+            Passed to the shuffle of each index.
+        locality: int
+            If > 0, each index is shuffled with `shuffle(locality=locality)`, and the indexes are randomly
+            interleaved instead of globally shuffled, so that the order inside each index (and its arrow locality)
+            is preserved.
+        """
         if self.sample_strategy == 'probability':
             # Notice: In order to resample indices when shuffling, shuffle will not preserve the
             # initial sampled indices when loading the index.
@@ -353,7 +411,7 @@ class MultiIndexV2(object):
 
         # Shuffle indices in each index
         for i, bucket in enumerate(self.buckets):
-            bucket.shuffle(seed + i, fast=fast)
+            bucket.shuffle(seed + i, fast=fast, locality=locality)
 
         # Shuffle ind_mapper
         if self.sample_strategy == 'uniform':
@@ -362,11 +420,12 @@ class MultiIndexV2(object):
             self.ind_mapper = self.sample_indices_with_probability()
         else:
             raise ValueError(f"Not supported sample_strategy {self.sample_strategy}.")
-        if seed is not None:
-            sampler = np.random.RandomState(seed)
-            sampler.shuffle(self.ind_mapper)
+        sampler = np.random.RandomState(seed) if seed is not None else np.random
+        if locality > 0:
+            labels = np.searchsorted(self.cum_length, self.ind_mapper, side='right')
+            self.ind_mapper = interleave_by_label(self.ind_mapper, labels, sampler)
         else:
-            np.random.shuffle(self.ind_mapper)
+            sampler.shuffle(self.ind_mapper)
 
     def get_arrow_file(self, ind, **kwargs):
         """
@@ -527,6 +586,11 @@ class MultiResolutionBucketIndexV2(MultiIndexV2):
         changed. If a dict is provided, the keys are the shadow names to call the function, and the values are the
         callable functions to map the shadow file path to a new path. If a callable function is provided, the key
         is 'default'.
+    table_cache_size: int
+        The maximum number of arrow files kept open at the same time. The cache is shared by all buckets.
+        Default to 1.
+    table_cache_bytes: int
+        The maximum number of mapped bytes kept open at the same time. If None, only table_cache_size is used.
     """
     buckets: List[Bucket]
 
@@ -535,6 +599,8 @@ class MultiResolutionBucketIndexV2(MultiIndexV2):
                  batch_size: int,
                  world_size: int,
                  shadow_file_fn: Optional[Union[Callable, Dict[str, Callable]]] = None,
+                 table_cache_size: int = 1,
+                 table_cache_bytes: Optional[int] = None,
                  ):
         align = batch_size * world_size
         if align <= 0:
@@ -543,6 +609,8 @@ class MultiResolutionBucketIndexV2(MultiIndexV2):
         self.buckets, self._resolutions = Bucket.from_bucket_index(index_file,
                                                                    align=align,
                                                                    shadow_file_fn=shadow_file_fn,
+                                                                   table_cache_size=table_cache_size,
+                                                                   table_cache_bytes=table_cache_bytes,
                                                                    )
         self.arrow_files = self.buckets[0].arrow_files
         self._base_size = self._resolutions.base_size
@@ -571,7 +639,21 @@ class MultiResolutionBucketIndexV2(MultiIndexV2):
     def resolutions(self):
         return self._resolutions
 
-    def shuffle(self, seed=None, fast=False):
+    def shuffle(self, seed=None, fast=False, locality=0):
+        """
+        Shuffle the buckets, the indices in each bucket and the batch order.
+
+        Parameters
+        ----------
+        seed: int
+            The random seed.
+        fast: bool
+            Passed to the shuffle of each bucket.
+        locality: int
+            If > 0, each bucket is shuffled with `shuffle(locality=locality)`, and the batches of different buckets
+            are randomly interleaved instead of globally shuffled. Consecutive batches of a bucket stay in order,
+            so a worker only touches about `len(buckets) * locality` arrow files at a time.
+        """
         # Shuffle indexes
         if seed is not None:
             state = random.getstate()
@@ -585,15 +667,16 @@ class MultiResolutionBucketIndexV2(MultiIndexV2):
 
         # Shuffle indices in each index
         for i, bucket in enumerate(self.buckets):
-            bucket.shuffle(seed + i, fast=fast)
+            bucket.shuffle(seed + i, fast=fast, locality=locality)
 
         # Shuffle ind_mapper
         batch_ind_mapper = np.arange(self.total_length // self.batch_size) * self.batch_size
-        if seed is not None:
-            sampler = np.random.RandomState(seed)
-            sampler.shuffle(batch_ind_mapper)
+        sampler = np.random.RandomState(seed) if seed is not None else np.random
+        if locality > 0:
+            labels = np.searchsorted(self.cum_length, batch_ind_mapper, side='right')
+            batch_ind_mapper = interleave_by_label(batch_ind_mapper, labels, sampler)
         else:
-            np.random.shuffle(batch_ind_mapper)
+            sampler.shuffle(batch_ind_mapper)
         ind_mapper = np.stack([batch_ind_mapper + i for i in range(self.batch_size)], axis=1).reshape(-1)
         self.ind_mapper = ind_mapper
 
@@ -677,6 +760,8 @@ class MultiMultiResolutionBucketIndexV2(MultiIndexV2):
                                          self.batch_size,
                                          self.world_size,
                                          shadow_file_fn=kwargs.get('shadow_file_fn', None),
+                                         table_cache_size=kwargs.get('table_cache_size', 1),
+                                         table_cache_bytes=kwargs.get('table_cache_bytes', None),
                                          )
             for index_file in index_files
         ]
@@ -707,7 +792,7 @@ class MultiMultiResolutionBucketIndexV2(MultiIndexV2):
         ind_mapper = np.concatenate(ind_mapper_list)
         return ind_mapper
 
-    def shuffle(self, seed=None, fast=False):
+    def shuffle(self, seed=None, fast=False, locality=0):
         if self.sample_strategy == 'probability':
             # Notice: In order to resample indices when shuffling, shuffle will not preserve the
             # initial sampled indices when loading the index.
@@ -726,7 +811,7 @@ class MultiMultiResolutionBucketIndexV2(MultiIndexV2):
 
         # Shuffle indices in each index
         for i, bucket in enumerate(self.buckets):
-            bucket.shuffle(seed + i, fast=fast)
+            bucket.shuffle(seed + i, fast=fast, locality=locality)
 
         # Shuffle ind_mapper in batch level
         if self.sample_strategy == 'uniform':
@@ -735,11 +820,12 @@ class MultiMultiResolutionBucketIndexV2(MultiIndexV2):
             batch_ind_mapper = self.sample_indices_with_probability(return_batch_indices=True)
         else:
             raise ValueError(f"Not supported sample_strategy {self.sample_strategy}.")
-        if seed is not None:
-            sampler = np.random.RandomState(seed)
-            sampler.shuffle(batch_ind_mapper)
+        sampler = np.random.RandomState(seed) if seed is not None else np.random
+        if locality > 0:
+            labels = np.searchsorted(self.cum_length, batch_ind_mapper, side='right')
+            batch_ind_mapper = interleave_by_label(batch_ind_mapper, labels, sampler)
         else:
-            np.random.shuffle(batch_ind_mapper)
+            sampler.shuffle(batch_ind_mapper)
         self.ind_mapper = np.stack([batch_ind_mapper + i for i in range(self.batch_size)], axis=1).reshape(-1)
 
     def get_ratio(self, ind, **kwargs):
@@ -779,6 +865,119 @@ class MultiMultiResolutionBucketIndexV2(MultiIndexV2):
         return self.buckets[i].get_target_size(ind - bias)
 
 
+def column_to_sizes(column):
+    """`int(x)` over a whole arrow column, -1 where it does not give a size (null, non-numeric)."""
+    dtype = column.type
+    if pa.types.is_integer(dtype):
+        values = column.cast(pa.int64())
+    elif pa.types.is_floating(dtype):
+        values = pc.trunc(column).cast(pa.int64())
+    elif pa.types.is_string(dtype) or pa.types.is_large_string(dtype):
+        is_int = pc.match_substring_regex(column, r'^\s*[+-]?\d+\s*$')
+        values = pc.if_else(is_int, pc.utf8_trim_whitespace(column), None).cast(pa.int64())
+    else:
+        values = pa.nulls(len(column), pa.int64())
+    return pc.fill_null(values, -1).to_numpy()
+
+
+def probe_image_sizes(args):
+    """(height, width) of some rows of an arrow file, from the image headers only (no decoding)."""
+    arrow_file, rows = args
+    table = get_table(arrow_file)
+    column = table['image' if 'image' in table.column_names else 'binary']
+    hw = np.full((len(rows), 2), -1, dtype=np.int64)
+    for j, row in enumerate(rows):
+        try:
+            width, height = Image.open(io.BytesIO(column[int(row)].as_py())).size
+            hw[j] = height, width
+        except Exception:
+            pass
+    return hw
+
+
+def size_sidecar_path(size_cache_dir, arrow_file):
+    digest = hashlib.sha1(str(Path(arrow_file).absolute()).encode()).hexdigest()[:12]
+    return Path(size_cache_dir) / f'{Path(arrow_file).stem}-{digest}.hw.npz'
+
+
+def md5_hw_fingerprint(md5_hw):
+    """Content key of an md5 -> (height, width) mapping, '' when there is none."""
+    if not md5_hw:
+        return ''
+    digest = hashlib.sha1()
+    for md5, (h, w) in sorted(md5_hw.items()):
+        digest.update(f'{md5}:{h}:{w};'.encode())
+    return digest.hexdigest()
+
+
+def get_arrow_sizes(arrow_file, md5_hw=None, size_cache_dir=None, num_workers=0, chunk_size=256, md5_hw_key=None):
+    """
+    (height, width) of every row of an arrow file as an int array of shape (N, 2), -1 where unknown.
+
+    Sizes come from the `height`/`width` columns, then from `md5_hw`, then from probing the image
+    headers, in a pool of `num_workers` processes (None for all CPUs, 0 in this process) that is
+    only started when some rows need it. With `size_cache_dir` the result is kept in a per-file
+    sidecar, so later builds (e.g. with other resolutions) neither read the columns nor the images
+    again. The sidecar is keyed by the arrow file and by `md5_hw_key` (see md5_hw_fingerprint),
+    sizes found with another (or without an) md5_hw are not reused.
+    """
+    if md5_hw_key is None:
+        md5_hw_key = md5_hw_fingerprint(md5_hw)
+    stat = os.stat(arrow_file)
+    source = np.asarray([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if size_cache_dir is not None:
+        sidecar = size_sidecar_path(size_cache_dir, arrow_file)
+        if sidecar.exists():
+            cached = np.load(sidecar)
+            if (np.array_equal(cached['source'], source) and 'md5_hw' in cached
+                    and str(cached['md5_hw']) == md5_hw_key):
+                return cached['hw'].astype(np.int64)
+
+    table = get_table(arrow_file)
+    hw = np.full((len(table), 2), -1, dtype=np.int64)
+    if 'height' in table.column_names and 'width' in table.column_names:
+        hw[:, 0] = column_to_sizes(table['height'])
+        hw[:, 1] = column_to_sizes(table['width'])
+
+    missing = np.flatnonzero((hw < 0).any(axis=1))
+    if len(missing) > 0 and md5_hw and 'md5' in table.column_names:
+        md5s = table['md5'].take(pa.array(missing)).to_pylist()
+        for row, md5 in zip(missing, md5s):
+            if md5 in md5_hw:
+                hw[row] = md5_hw[md5]
+        missing = np.flatnonzero((hw < 0).any(axis=1))
+
+    if len(missing) > 0 and ('image' in table.column_names or 'binary' in table.column_names):
+        chunks = [(arrow_file, missing[i:i + chunk_size]) for i in range(0, len(missing), chunk_size)]
+        if num_workers == 0:
+            hw[missing] = np.concatenate(list(map(probe_image_sizes, chunks)))
+        else:
+            with Pool(num_workers) as pool:
+                hw[missing] = np.concatenate(pool.map(probe_image_sizes, chunks))
+
+    if size_cache_dir is not None:
+        sidecar.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = sidecar.with_name(f'{sidecar.name}.{os.getpid()}.tmp.npz')
+        np.savez(tmp_path, hw=hw.astype(np.int32), source=source, md5_hw=md5_hw_key)
+        os.replace(tmp_path, sidecar)
+    return hw
+
+
+def nearest_ratio_index(ratios, target_ratios):
+    """
+    Vectorized `np.argmin(np.abs(target_ratios - ratio))` for every ratio, target_ratios sorted ascending.
+    Ties go to the lower index, like argmin.
+    """
+    target_ratios = np.asarray(target_ratios)
+    pos = np.clip(np.searchsorted(target_ratios, ratios), 1, len(target_ratios) - 1)
+    if len(target_ratios) == 1:
+        return np.zeros(len(ratios), dtype=np.int64)
+    left, right = pos - 1, pos
+    choice = np.where(np.abs(ratios - target_ratios[left]) <= np.abs(ratios - target_ratios[right]), left, right)
+    # first of equal target ratios
+    return np.searchsorted(target_ratios, target_ratios[choice], side='left')
+
+
 def build_multi_resolution_bucket(config_file,
                                   base_size,
                                   src_index_files,
@@ -788,6 +987,10 @@ def build_multi_resolution_bucket(config_file,
                                   align=1,
                                   min_size=0,
                                   md5_hw=None,
+                                  size_cache_dir=None,
+                                  num_workers=None,
+                                  index_format='json',
+                                  md5_hw_key=None,
                                   ):
     # Compute base size
     resolutions = ResolutionGroup(base_size, step=reso_step, target_ratios=target_ratios, align=align)
@@ -806,6 +1009,8 @@ def build_multi_resolution_bucket(config_file,
 
     if md5_hw is None:
         md5_hw = {}
+    if size_cache_dir is not None and md5_hw_key is None:
+        md5_hw_key = md5_hw_fingerprint(md5_hw)
 
     arrow_files = src_indexes[0].arrow_files[:]     # !!!important!!!, copy the list
     for src_index in src_indexes[1:]:
@@ -828,30 +1033,27 @@ def build_multi_resolution_bucket(config_file,
     cum_length_tmp = 0
     total_index_count = 0
     for src_index, src_index_file in zip(src_indexes, src_index_files):
-        index_count = 0
-        pbar = tqdm(src_index.indices.tolist())
-        for i in pbar:
-            try:
-                height = int(src_index.get_attribute_by_index(i, 'height'))
-                width = int(src_index.get_attribute_by_index(i, 'width'))
-            except Exception as e1:
-                try:
-                    md5 = src_index.get_attribute_by_index(i, 'md5')
-                    height, width = md5_hw[md5]
-                except Exception as e2:
-                    try:
-                        width, height = src_index.get_image_by_index(i).size
-                    except Exception as e3:
-                        print(f'Error: {e1} --> {e2} --> {e3}. We will skip this image.')
-                        continue
-
-            if height < min_size or width < min_size:
-                continue
-
-            ratio = height / width
-            idx = np.argmin(np.abs(resolutions.ratio - ratio))
-            buckets[idx].append(i + cum_length_tmp)
-            index_count += 1
+        indices = np.asarray(src_index.indices, dtype=np.int64)
+        file_ids = np.searchsorted(src_index.cum_length, indices, side='right')
+        file_starts = np.concatenate([[0], src_index.cum_length[:-1]]).astype(np.int64)
+        hw = np.full((len(indices), 2), -1, dtype=np.int64)
+        for file_id in tqdm(np.unique(file_ids)):
+            rows = np.flatnonzero(file_ids == file_id)
+            arrow_hw = get_arrow_sizes(src_index.arrow_files[file_id], md5_hw, size_cache_dir, num_workers,
+                                       md5_hw_key=md5_hw_key)
+            hw[rows] = arrow_hw[indices[rows] - file_starts[file_id]]
+
+        height, width = hw[:, 0], hw[:, 1]
+        unknown = (height <= 0) | (width <= 0)
+        if unknown.any():
+            print(f'Warning: no size for {unknown.sum()} images in {src_index_file}. We will skip them.')
+        valid = ~unknown & (height >= min_size) & (width >= min_size)
+        bucket_ids = nearest_ratio_index(height[valid] / width[valid], resolutions.ratio)
+        valid_indices = indices[valid] + cum_length_tmp
+        for i in np.unique(bucket_ids):
+            buckets[i].append(valid_indices[bucket_ids == i])
+
+        index_count = int(valid.sum())
         print(f"Valid indices {index_count} in {src_index_file}.")
         cum_length_tmp += src_index.cum_length[-1]
         total_index_count += index_count
@@ -862,6 +1064,7 @@ def build_multi_resolution_bucket(config_file,
     for i, bucket in tqdm(enumerate(buckets)):
         if len(bucket) == 0:
             continue
+        bucket = np.concatenate(bucket).tolist()
         reso = f'{resolutions[i]}'
         resolutions.attr[i] = f'{len(bucket):>6d}'
         indices[reso] = bucket
@@ -878,6 +1081,7 @@ def build_multi_resolution_bucket(config_file,
                              cum_length=cum_length,
                              indices=indices,
                              config_file=config_file,
+                             index_format=index_format,
                              )
     builder.build(save_file)
     print(resolutions)
@@ -3,7 +3,7 @@ import numpy as np
 from pathlib import Path
 from functools import partial
 
-from .indexer import ArrowIndexV2
+from .indexer import ArrowIndexV2, load_indices_file
 from .bucket import (
     ResolutionGroup,
     MultiIndexV2, MultiResolutionBucketIndexV2, MultiMultiResolutionBucketIndexV2, IndexV2Builder
@@ -18,7 +18,10 @@ def load_index(src,
                probability=None,
                shadow_file_fn=None,
                seed=None,
+               table_cache_size=1,
+               table_cache_bytes=None,
                ):
+    cache_kwargs = dict(table_cache_size=table_cache_size, table_cache_bytes=table_cache_bytes)
     if isinstance(src, str):
         src = [src]
     if src[0].endswith('.arrow'):
@@ -32,22 +35,26 @@ def load_index(src,
                 idx = MultiResolutionBucketIndexV2(src[0], batch_size=batch_size,
                                                    world_size=world_size,
                                                    shadow_file_fn=shadow_file_fn,
+                                                   **cache_kwargs,
                                                    )
             else:
                 idx = MultiMultiResolutionBucketIndexV2(src, batch_size=batch_size,
                                                         world_size=world_size,
                                                         sample_strategy=sample_strategy, probability=probability,
                                                         shadow_file_fn=shadow_file_fn, seed=seed,
+                                                        **cache_kwargs,
                                                         )
         else:
             if len(src) == 1:
                 idx = ArrowIndexV2(src[0],
                                    shadow_file_fn=shadow_file_fn,
+                                   **cache_kwargs,
                                    )
             else:
                 idx = MultiIndexV2(src,
                                    sample_strategy=sample_strategy, probability=probability,
                                    shadow_file_fn=shadow_file_fn, seed=seed,
+                                   **cache_kwargs,
                                    )
     else:
         raise ValueError(f'Unknown file type: {src[0]}')
@@ -170,7 +177,7 @@ def show_index_info(src, only_arrow_files=False, depth=1):
             indices_file = Path(src).parent / data['indices_file']
             if Path(indices_file).exists():
                 print(f"Loading indices from {indices_file} ...")
-                indices = np.load(indices_file)['x']
+                indices = load_indices_file(indices_file)['x']
                 print(f"Loaded.")
             else:
                 raise ValueError(f'This Index file contains an extra file {indices_file} which is missed.')
@@ -210,7 +217,7 @@ ArrowIndexV2(
         indices_file = Path(src).parent / data['indices_file']
         assert Path(indices_file).exists(), f'indices_file {indices_file} not found'
         print(f"Loading indices from {indices_file} ...")
-        indices_data = np.load(indices_file)
+        indices_data = load_indices_file(indices_file)
         print(f"Loaded.")
         indices_length = sum([len(indices) for key, indices in indices_data.items()])
         keys = [k for k in group_length.keys() if len(indices_data[k]) > 0]
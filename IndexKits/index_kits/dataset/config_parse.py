@@ -7,6 +7,10 @@ import json
 from typing import List
 from collections import defaultdict
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
 def source_names_to_names(source_names_):
     """
     Get all arrow file names from a list of source names.
@@ -66,6 +70,43 @@ def to_numeric(x, default_val=0.0):
     return x
 
 
+# Plain decimal strings, cast by arrow. Other non-null strings go through `to_numeric` (`float()`)
+NUMERIC_PATTERN = r'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$'
+
+
+def to_numeric_column(column, default_val=0.0):
+    """
+    `to_numeric` over a whole arrow column, as float64: numbers are kept (nulls of a numeric
+    column are NaN), strings are parsed like `float()`, everything else takes `default_val`.
+    """
+    dtype = column.type
+    if pa.types.is_integer(dtype) or pa.types.is_floating(dtype):
+        return pc.fill_null(column.cast(pa.float64()), float('nan'))
+    elif pa.types.is_boolean(dtype):
+        return pc.fill_null(column.cast(pa.float64()), float(default_val))
+    elif pa.types.is_string(dtype) or pa.types.is_large_string(dtype):
+        is_plain = pc.fill_null(pc.match_substring_regex(column, NUMERIC_PATTERN), False)
+        values = pc.if_else(is_plain, pc.utf8_trim_whitespace(column), None).cast(pa.float64())
+        # nan/inf/underscores/unicode digits: parse the distinct leftover strings with `float()`
+        others = pc.unique(pc.filter(column, pc.and_(pc.invert(is_plain), pc.is_valid(column))))
+        if len(others) > 0:
+            parsed = pa.array([to_numeric(x, default_val) for x in others.to_pylist()], pa.float64())
+            positions = pc.index_in(column, value_set=others)
+            values = pc.if_else(is_plain, values, pc.take(parsed, positions))
+        return pc.fill_null(values, float(default_val))
+    return pa.array(np.full(len(column), float(default_val)))
+
+
+def to_str_column(column):
+    if not (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+        column = column.cast(pa.string())
+    return column
+
+
+def mask_true_count(mask):
+    return pc.sum(mask).as_py() or 0
+
+
 TYPE_MAPPER = {
     "int": int,
     "float": float,
@@ -130,10 +171,23 @@ class Operator(object):
 
 
 class ColumnFilter(Operator):
-    numeric_actions = {"eq", "ne", "gt", "lt", "ge", "le"}
+    """
+    A condition on one arrow column. Filters are evaluated with `pyarrow.compute` kernels on the
+    column chunks (the record batches of the arrow file) and return a boolean arrow mask.
+    """
+    numeric_actions = {"eq", "ne", "gt", "lt", "ge", "le", "is_null", "not_null"}
     str_actions = {"eq", "ne", "len_eq", "len_ne", "len_gt", "len_lt", "len_ge", "len_le", "contains", "not_contains",
-                   "in", "not_in", "lower_last_in"}
-    int_target_str_actions = {"len_eq", "len_gt", "len_lt", "len_ge", "len_le"}
+                   "in", "not_in", "lower_last_in", "is_null", "not_null"}
+    int_target_str_actions = {"len_eq", "len_ne", "len_gt", "len_lt", "len_ge", "len_le"}
+    list_target_str_actions = {"in", "not_in", "lower_last_in"}
+    null_actions = {"is_null", "not_null"}
+    # Actions a null value passes, as `None != target` does
+    negated_actions = {"ne", "len_ne", "not_contains", "not_in"}
+    compare_functions = {
+        "eq": pc.equal, "ne": pc.not_equal,
+        "gt": pc.greater, "lt": pc.less,
+        "ge": pc.greater_equal, "le": pc.less_equal,
+    }
     action_mapper_left = {
         "eq": "==", "ne": "!=", "len_eq": ".len()==",
         "gt": ">", "len_gt": ".len()>",
@@ -144,6 +198,7 @@ class ColumnFilter(Operator):
         "not_contains": ".not_contains(",
         "in": ".isin(", "not_in": ".notin(",
         "lower_last_in": "[-1].lower().isin(",
+        "is_null": ".is_null(", "not_null": ".not_null(",
     }
     action_mapper_right = {
         "eq": "", "ne": "", "len_eq": "",
@@ -155,6 +210,7 @@ class ColumnFilter(Operator):
         "not_contains": ")",
         "in": ")", "not_in": ")",
         "lower_last_in": ")",
+        "is_null": ")", "not_null": ")",
     }
 
     def __init__(self, config):
@@ -162,8 +218,8 @@ class ColumnFilter(Operator):
         self.name = self.column_name = config['name']
         self.dtype = config['type']
         self.action = config['action']
-        self.target = config['target']
-        self.default = config['default']
+        self.target = config.get('target', '')
+        self.default = config.get('default', None)
         self.arrow_file_cond = config.get('arrow_file', None)
         self.arrow_file_keyword = config.get('arrow_file_keyword', None)
         if self.arrow_file_keyword is not None:
@@ -188,78 +244,64 @@ class ColumnFilter(Operator):
                   f" (default={self.default}{arrow_file_keyword_repr})"
         return fmt_str
 
+    def __call__(self, arrow_file, table):
+        success = self.check_exists(arrow_file, table)
+        if not success:
+            return None
+        column = table[self.column_name]
+        if self.action == 'is_null':
+            return pc.is_null(column)
+        elif self.action == 'not_null':
+            return pc.is_valid(column)
+        return pc.fill_null(self.run_on_column(column), self.action in self.negated_actions)
+
 
 class NumericFilter(ColumnFilter):
     def run_on_column(self, column):
-        if self.action == 'eq':
-            return column == self.target
-        elif self.action == 'ne':
-            return column != self.target
-        elif self.action == 'gt':
-            return column > self.target
-        elif self.action == 'lt':
-            return column < self.target
-        elif self.action == 'ge':
-            return column >= self.target
-        elif self.action == 'le':
-            return column <= self.target
-        else:
+        if self.action not in self.compare_functions:
             raise ValueError(f"Invalid action: {self.action}")
+        return self.compare_functions[self.action](to_numeric_column(column, self.default), self.target)
 
 
 class IntFilter(NumericFilter):
-    def __call__(self, arrow_file, table):
-        success = self.check_exists(arrow_file, table)
-        if not success:
-            return None
-        column = table[self.column_name].to_pandas().apply(lambda x: to_numeric(x, self.default))
-        return self.run_on_column(column)
+    pass
 
 
 class FloatFilter(NumericFilter):
-    def __call__(self, arrow_file, table):
-        success = self.check_exists(arrow_file, table)
-        if not success:
-            return None
-        column = table[self.column_name].to_pandas().apply(lambda x: to_numeric(x, self.default))
-        return self.run_on_column(column)
+    pass
 
 
 class StrFilter(ColumnFilter):
-    def __call__(self, arrow_file, table):
-        success = self.check_exists(arrow_file, table)
-        if not success:
-            return None
-        column = table[self.column_name].to_pandas()
-        if self.action == 'eq':
-            return column.apply(lambda x: x == self.target)
-        elif self.action == 'ne':
-            return column.apply(lambda x: x != self.target)
-        elif self.action == 'len_eq':
-            return column.str.len() == self.target
-        elif self.action == 'len_ne':
-            return column.str.len() != self.target
-        elif self.action == 'len_gt':
-            return column.str.len() > self.target
-        elif self.action == 'len_lt':
-            return column.str.len() < self.target
-        elif self.action == 'len_ge':
-            return column.str.len() >= self.target
-        elif self.action == 'len_le':
-            return column.str.len() <= self.target
+    def run_on_column(self, column):
+        column = to_str_column(column)
+        if self.action in ('eq', 'ne'):
+            return self.compare_functions[self.action](column, self.target)
+        elif self.action.startswith('len_'):
+            return self.compare_functions[self.action[4:]](pc.utf8_length(column), self.target)
         elif self.action == 'contains':
-            return column.str.contains(self.target)
+            return pc.match_substring_regex(column, self.target)
         elif self.action == 'not_contains':
-            return ~column.str.contains(self.target)
+            return pc.invert(pc.match_substring_regex(column, self.target))
         elif self.action == 'in':
-            return column.apply(lambda x: x in self.target)
+            return self.isin(column)
         elif self.action == 'not_in':
-            return column.apply(lambda x: x not in self.target)
+            return pc.invert(self.isin(column))
         elif self.action == 'lower_last_in':
-            return column.apply(lambda x: x[-1].lower() in self.target)
+            last = pc.utf8_lower(pc.utf8_slice_codeunits(column, -1))
+            # a str target is a set of characters here
+            value_set = sorted(set(self.target)) if isinstance(self.target, str) else self.target
+            return pc.is_in(last, value_set=pa.array(value_set, pa.string()))
         else:
             raise ValueError(f"Invalid action: {self.action}")
 
+    def isin(self, column):
+        if isinstance(self.target, list):
+            return pc.is_in(column, value_set=pa.array(self.target, pa.string()))
+        # `x in target` of a str target is a substring test, only run it on the distinct values
+        uniques = pc.unique(pc.drop_null(column))
+        hits = pa.array([x in self.target for x in uniques.to_pylist()], pa.bool_())
+        return pc.is_in(column, value_set=uniques.filter(hits))
+
 
 def check_type(parent, config):
     if 'type' not in config:
@@ -291,14 +333,21 @@ def get_column_filter(parent, config):
     if not success:
         return False, msg, None
 
-    if config['type'] == 'str' and config['action'] in ColumnFilter.int_target_str_actions:
-        dtype = TYPE_MAPPER['int']
+    dtype = TYPE_MAPPER[config['type']]
+    if config['type'] == 'str' and config.get('action') in ColumnFilter.int_target_str_actions:
+        target_dtype = TYPE_MAPPER['int']
+    elif config['type'] == 'str' and config.get('action') in ColumnFilter.list_target_str_actions:
+        target_dtype = [(str, list)]
     else:
-        dtype = TYPE_MAPPER[config['type']]
+        target_dtype = dtype
 
     # Check other keys
-    required_args = ['name', 'action', 'target', 'default']
-    types = [str, str, dtype, dtype]
+    if config.get('action') in ColumnFilter.null_actions:
+        required_args = ['name', 'action']
+        types = [str, str]
+    else:
+        required_args = ['name', 'action', 'target', 'default']
+        types = [str, str, target_dtype, dtype]
     success, msg = check_keys(parent, config, required_args, types)
     if not success:
         return False, msg, None
@@ -378,7 +427,23 @@ class MD5Filter(Operator):
         return fmt_str
 
 
+    @property
+    def value_set(self):
+        """The md5s a hit is checked against, as an arrow array built once per filter."""
+        if getattr(self, '_value_set', None) is None:
+            self._value_set = pa.array(self.hit_md5s(), pa.string())
+        return self._value_set
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_value_set'] = None
+        return state
+
+
 class ListFilter(MD5Filter):
+    def hit_md5s(self):
+        return list(self.md5_data)
+
     def __call__(self, md5s):
         if self.action == "in":
             find_valid = self.is_valid
@@ -387,18 +452,17 @@ class ListFilter(MD5Filter):
         else:
             raise ValueError(f"Invalid action: {self.action}")
 
-        if find_valid:
-            return md5s.apply(lambda x: x in self.md5_data)
-        else:
-            return md5s.apply(lambda x: x not in self.md5_data)
+        hit = pc.fill_null(pc.is_in(md5s, value_set=self.value_set), False)
+        return hit if find_valid else pc.invert(hit)
 
 
 class DictFilter(MD5Filter):
+    def hit_md5s(self):
+        return [md5 for md5, value in self.md5_data.items() if self.cond(value)]
+
     def __call__(self, md5s):
-        if self.is_valid:
-            return md5s.apply(lambda x: x in self.md5_data and self.cond(self.md5_data[x]))
-        else:
-            return md5s.apply(lambda x: (x not in self.md5_data) or not self.cond(self.md5_data[x]))
+        hit = pc.fill_null(pc.is_in(md5s, value_set=self.value_set), False)
+        return hit if self.is_valid else pc.invert(hit)
 
     def cond(self, value):
         if self.action == "eq":
@@ -442,84 +506,91 @@ def get_md5_filter(parent, config):
         raise ValueError(f"Invalid type: {config['type']}")
 
 
+LOGICAL_OPS = ('logical_or', 'logical_and', 'logical_not')
+
+
 class FilterCompose(object):
+    """
+    Combines column and md5 filters: top-level filters are and-ed, `('logical_or' | 'logical_and', [filters])`
+    and `('logical_not', filter)` nest. Masks stay arrow boolean arrays until the final numpy mask.
+    """
     def __init__(self, column_filter_list, md5_filter_list):
         self.column_filter_list = column_filter_list
         self.md5_filter_list = md5_filter_list
 
+    @classmethod
+    def filter_name(cls, filter_):
+        if isinstance(filter_, tuple):
+            op, sub = filter_
+            if op == 'logical_not':
+                return '!' + cls.filter_name(sub)
+            sep = '|' if op == 'logical_or' else '&'
+            return sep.join([cls.filter_name(f) for f in sub])
+        return filter_.name
+
+    @classmethod
+    def filter_repr(cls, filter_):
+        if isinstance(filter_, tuple):
+            op, sub = filter_
+            if op == 'logical_not':
+                return f"NOT({cls.filter_repr(sub)})"
+            sep = ' || ' if op == 'logical_or' else ' && '
+            return sep.join([cls.filter_repr(f) if not isinstance(f, tuple) else f"({cls.filter_repr(f)})"
+                             for f in sub])
+        return filter_.data_type
+
+    def evaluate(self, filter_, arrow_file, table, md5s):
+        """Mask of a (possibly nested) filter, None if nothing in it applies to this arrow file."""
+        if isinstance(filter_, tuple):
+            op, sub = filter_
+            if op == 'logical_not':
+                mask = self.evaluate(sub, arrow_file, table, md5s)
+                return None if mask is None else pc.invert(mask)
+            if op not in ('logical_or', 'logical_and'):
+                raise ValueError(f"Invalid operation: {op}")
+            combine = pc.or_ if op == 'logical_or' else pc.and_
+            mask = None
+            for sub_filter in sub:
+                sub_mask = self.evaluate(sub_filter, arrow_file, table, md5s)
+                if sub_mask is not None:
+                    mask = sub_mask if mask is None else combine(mask, sub_mask)
+            return mask
+
+        if not filter_.applicable(arrow_file):
+            return None
+        if isinstance(filter_, MD5Filter):
+            return None if md5s is None else filter_(md5s)
+        return filter_(arrow_file, table)
+
     def __call__(self, arrow_file, table):
         stats = {}
         length = len(table)
         assert length > 0, "Empty table"
 
-        mask = None
-        for filter_ in self.column_filter_list:
-            if isinstance(filter_, tuple):
-                op, filter_list = filter_
-                if op == 'logical_or':
-                    sub_mask = None
-                    for sub_filter in filter_list:
-                        if not sub_filter.applicable(arrow_file):
-                            continue
-                        sub_current_mask = sub_filter(arrow_file, table)
-                        if sub_current_mask is not None:
-                            if sub_mask is None:
-                                sub_mask = sub_current_mask
-                            else:
-                                sub_mask = sub_mask | sub_current_mask
-                    if sub_mask is not None:
-                        name = '|'.join([f.name for f in filter_list])
-                        stats.update({
-                            name: length - sum(sub_mask)
-                        })
-                        if mask is None:
-                            mask = sub_mask
-                        else:
-                            mask = mask & sub_mask
-                else:
-                    raise ValueError(f"Invalid operation: {op}")
-            else:
-                if not filter_.applicable(arrow_file):
-                    continue
-                current_mask = filter_(arrow_file, table)
-                if current_mask is not None:
-                    stats.update({
-                        filter_.name: length - sum(current_mask)
-                    })
-                    if mask is None:
-                        mask = current_mask
-                    else:
-                        mask = mask & current_mask
-
         md5s = None
-        for filter_ in self.md5_filter_list:
-            if not filter_.applicable(arrow_file):
-                continue
-            if 'md5' not in table.column_names:
+        if self.md5_filter_list:
+            if 'md5' in table.column_names:
+                md5s = table['md5']
+            else:
                 print(f"Warning: Column 'md5' not found in {arrow_file}.")
 
-            md5s = table['md5'].to_pandas()
-            current_mask = filter_(md5s)
+        mask = None
+        for filter_ in self.column_filter_list + self.md5_filter_list:
+            current_mask = self.evaluate(filter_, arrow_file, table, md5s)
             if current_mask is not None:
                 stats.update({
-                    filter_.name: length - sum(current_mask)
+                    self.filter_name(filter_): length - mask_true_count(current_mask)
                 })
-                if mask is None:
-                    mask = current_mask
-                else:
-                    mask = mask & current_mask
+                mask = current_mask if mask is None else pc.and_(mask, current_mask)
 
+        if mask is not None:
+            mask = mask.to_numpy(zero_copy_only=False) if isinstance(mask, pa.Array) \
+                else np.concatenate([chunk.to_numpy(zero_copy_only=False) for chunk in mask.chunks])
         return mask, stats, md5s
 
     @property
     def data_type(self):
-        data_type_list = []
-        for filter_ in self.column_filter_list + self.md5_filter_list:
-            if isinstance(filter_, tuple):
-                data_type_list.append(' || '.join([f.data_type for f in filter_[1]]))
-            else:
-                data_type_list.append(filter_.data_type)
-        return data_type_list
+        return [self.filter_repr(filter_) for filter_ in self.column_filter_list + self.md5_filter_list]
 
 
 class MD5Repeater(Operator):
@@ -545,14 +616,35 @@ class MD5Repeater(Operator):
                 # We assume all values are the same type
                 break
 
-    def __call__(self, arrow_file, index, md5):
-        if md5 in self.md5_data:
+    @property
+    def md5_arrays(self):
+        """The md5s (as an arrow array) and their repeat values (numpy), built once per repeater."""
+        if getattr(self, '_md5_arrays', None) is None:
+            keys = pa.array(list(self.md5_data), pa.string())
             if self.repeat is None:
-                return self.md5_data[md5] + self.plus
+                values = np.fromiter(self.md5_data.values(), dtype=np.int64, count=len(self.md5_data)) + self.plus
             else:
-                return self.repeat
-        else:
-            return 1
+                values = None
+            self._md5_arrays = keys, values
+        return self._md5_arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_md5_arrays'] = None
+        return state
+
+    def __call__(self, arrow_file, indices, md5s):
+        """Repeat count of each index, 1 where its md5 is not listed."""
+        if md5s is None:
+            return np.ones(len(indices), dtype=np.int64)
+        keys, values = self.md5_arrays
+        if self.repeat is not None:
+            hit = pc.fill_null(pc.is_in(md5s, value_set=keys), False).to_numpy(zero_copy_only=False)
+            return np.where(hit, self.repeat, 1)
+        positions = pc.index_in(md5s, value_set=keys)
+        hit = pc.is_valid(positions).to_numpy(zero_copy_only=False)
+        positions = pc.fill_null(positions, 0).to_numpy(zero_copy_only=False)
+        return np.where(hit, values[positions] if len(values) else 1, 1)
 
     @property
     def data_type(self):
@@ -590,11 +682,11 @@ class KeywordRepeater(Operator):
         self.repeat = config['repeat']
         self.name = f"Repeat {self.repeat} times"
 
-    def __call__(self, arrow_file, idx, md5):
+    def __call__(self, arrow_file, indices, md5s):
         for key in self.keywords:
             if key in arrow_file:
-                return self.repeat
-        return 1
+                return np.full(len(indices), self.repeat, dtype=np.int64)
+        return np.ones(len(indices), dtype=np.int64)
 
     @property
     def data_type(self):
@@ -612,8 +704,19 @@ def get_keyword_repeater(parent, config):
 
 
 class RepeaterCompose(object):
-    def __init__(self, repeater_list):
+    """
+    Expands the kept indices by their repeat counts. Each repeater gives a count per index, computed
+    over the whole column at once. With policy `max` (default) an index is repeated by the largest of the
+    arrow repeat and the repeater counts (the first repeater wins ties); with `sum` the extra copies of all
+    repeaters are added on top of the arrow repeat.
+    """
+    policies = {"max", "sum"}
+
+    def __init__(self, repeater_list, policy='max'):
+        if policy not in self.policies:
+            raise ValueError(f"Invalid repeater policy: {policy}, expected one of {self.policies}")
         self.repeater_list = repeater_list
+        self.policy = policy
 
     def __call__(self, arrow_file, table, indices, repeat_times=1, md5s=None):
         stats = defaultdict(int)
@@ -625,25 +728,35 @@ class RepeaterCompose(object):
                 print(f"Warning: Column 'md5' not found in {arrow_file}.")
                 md5s = None
             else:
-                md5s = table['md5'].to_pandas()
+                md5s = table['md5']
 
-        repeated_indices = []
-        for idx in indices:
-            md5 = md5s[idx] if md5s is not None else None
-            max_repeat = repeat_times
-            max_i = -1
+        indices = np.asarray(indices, dtype=np.int64)
+        if md5s is not None:
+            md5s = pc.take(md5s, indices)
+
+        counts = np.full(len(indices), repeat_times, dtype=np.int64)
+        max_i = np.full(len(indices), -1, dtype=np.int64)
+        for i, repeater in enumerate(self.repeater_list):
+            if not repeater.applicable(arrow_file):
+                continue
+            repeat = repeater(arrow_file, indices, md5s)
+            if self.policy == 'sum':
+                extra = np.maximum(repeat - 1, 0)
+                if extra.any():
+                    stats[repeater.name] += int(extra.sum())
+                counts += extra
+            else:
+                update = repeat > counts
+                counts = np.where(update, repeat, counts)
+                max_i[update] = i
+
+        if self.policy == 'max':
             for i, repeater in enumerate(self.repeater_list):
-                if not repeater.applicable(arrow_file):
-                    continue
-                repeat = repeater(arrow_file, idx, md5)
-                if repeat > max_repeat:
-                    max_repeat = repeat
-                    max_i = i
-            if max_i >= 0:
-                stats[self.repeater_list[max_i].name] += (max_repeat - 1)
-            repeated_indices.extend([idx] * max_repeat)
-
-        return repeated_indices, stats
+                selected = max_i == i
+                if selected.any():
+                    stats[repeater.name] += int((counts[selected] - 1).sum())
+
+        return np.repeat(indices, counts), stats
 
     @property
     def data_type(self):
@@ -676,6 +789,26 @@ class DatasetConfig(object):
         if len(unknown_args) > 0:
             raise ValueError(f"Unknown arguments in config file ({self.config_file}): {unknown_args}")
 
+    @staticmethod
+    def parse_filter_config(parent, config, get_filter):
+        """A filter config is either a single filter or a `logical_or`/`logical_and`/`logical_not` of them."""
+        ops = [op for op in LOGICAL_OPS if config.get(op, None) is not None]
+        if not ops:
+            success, msg, filter_ = get_filter(parent, config)
+            if not success:
+                raise ValueError(msg)
+            return filter_
+        if len(ops) > 1:
+            raise ValueError(f"{parent} should have only one of {ops}")
+
+        op = ops[0]
+        if op == 'logical_not':
+            assert isinstance(config[op], dict), f"{parent}.{op} should be a dict, got {type(config[op])}"
+            return op, DatasetConfig.parse_filter_config(f'{parent}-{op}', config[op], get_filter)
+        assert isinstance(config[op], list), f"{parent}.{op} should be a list, got {type(config[op])}"
+        return op, [DatasetConfig.parse_filter_config(f'{parent}-{op}.[{j}]', sub_config, get_filter)
+                    for j, sub_config in enumerate(config[op])]
+
     def parse_filter(self):
         column_filter_list = []
         md5_filter_list = []
@@ -685,44 +818,12 @@ class DatasetConfig(object):
                 column_filter_configs = filters['column']
                 assert isinstance(column_filter_configs, list), "filter.column should be a list."
                 for i, config in enumerate(column_filter_configs):
-                    if config.get('logical_or', None) is not None:
-                        assert isinstance(config['logical_or'], list), \
-                            f"filter.column[{i}].logical_or should be a list, got {type(config['logical_or'])}"
-                        sub_column_filter_list = []
-                        for j, sub_config in enumerate(config['logical_or']):
-                            sub_success, sub_msg, sub_filter_ = get_column_filter(f'filter.column[{i}-logical_or].[{j}]', sub_config)
-                            if not sub_success:
-                                raise ValueError(sub_msg)
-                            sub_column_filter_list.append(sub_filter_)
-                        success = True
-                        msg = ''
-                        filter_ = ('logical_or', sub_column_filter_list)
-                    else:
-                        success, msg, filter_ = get_column_filter(f'filter.column[{i}]', config)
-                    if not success:
-                        raise ValueError(msg)
-                    column_filter_list.append(filter_)
+                    column_filter_list.append(self.parse_filter_config(f'filter.column[{i}]', config, get_column_filter))
             if 'md5' in filters:
                 md5_filter_configs = filters['md5']
                 assert isinstance(md5_filter_configs, list), "filter.md5 should be a list."
                 for i, config in enumerate(md5_filter_configs):
-                    if config.get('logical_or', None) is not None:
-                        assert isinstance(config['logical_or'], list), \
-                            f"filter.md5[{i}].logical_or should be a list, got {type(config['logical_or'])}"
-                        sub_md5_filter_list = []
-                        for j, sub_config in enumerate(config['logical_or']):
-                            sub_success, sub_msg, sub_filter_ = get_md5_filter(f'filter.md5[{i}-logical_or].[{j}]', sub_config)
-                            if not sub_success:
-                                raise ValueError(sub_msg)
-                            sub_md5_filter_list.append(sub_filter_)
-                        success = True
-                        msg = ''
-                        filter_ = ('logical_or', sub_md5_filter_list)
-                    else:
-                        success, msg, filter_ = get_md5_filter(f'filter.md5[{i}]', config)
-                    if not success:
-                        raise ValueError(msg)
-                    md5_filter_list.append(filter_)
+                    md5_filter_list.append(self.parse_filter_config(f'filter.md5[{i}]', config, get_md5_filter))
 
         if column_filter_list or md5_filter_list:
             composed_filter = FilterCompose(column_filter_list, md5_filter_list)
@@ -753,7 +854,7 @@ class DatasetConfig(object):
                     repeater_list.append(repeater)
 
         if repeater_list or enable_arrow_repeat:
-            composed_repeater = RepeaterCompose(repeater_list)
+            composed_repeater = RepeaterCompose(repeater_list, policy=self.data.get('repeater', {}).get('policy', 'max'))
         else:
             composed_repeater = None
         return composed_repeater
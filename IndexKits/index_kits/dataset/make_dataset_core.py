@@ -1,4 +1,5 @@
 import json
+import os
 import pickle
 from collections import defaultdict
 from glob import glob
@@ -15,6 +16,7 @@ from tqdm import tqdm
 from index_kits.indexer import IndexV2Builder
 from index_kits.bucket import build_multi_resolution_bucket
 from index_kits.dataset.config_parse import DatasetConfig
+from index_kits.dataset.md5_dedup import md5_dedup_masks
 
 
 def get_table(arrow_file):
@@ -54,19 +56,20 @@ def get_indices(arrow_file, repeat_times, filter_fn, repeat_fn, callback=None):
         if filter_fn is not None:
             mask, stats, md5s = filter_fn(arrow_file, table)
         else:
-            mask = pd.Series([True] * length)
+            mask = np.ones(length, dtype=bool)
             stats = {}
             md5s = None
 
-        # Apply callback function if available
+        # Apply callback function if available. Callbacks get the mask and md5s as pandas Series.
         if callback is not None:
-            mask, stats = callback(arrow_file, table, mask, stats, md5s)
+            mask, stats = callback(arrow_file, table, None if mask is None else pd.Series(mask), stats,
+                                   None if md5s is None else md5s.to_pandas())
 
         # Get indices
         if mask is not None:
-            indices = np.where(mask)[0].tolist()
+            indices = np.flatnonzero(mask)
         else:
-            indices = list(range(length))
+            indices = np.arange(length)
 
         # Apply indices repeat
         if repeat_fn is not None:
@@ -98,7 +101,7 @@ def load_md52cls_files(files, name=None):
     return md52cls
 
 
-def merge_and_build_index(data_type, src, dconfig, save_path):
+def merge_and_build_index(data_type, src, dconfig, save_path, num_workers=1, index_format='json'):
     if isinstance(src, str):
         files = list(sorted(glob(src)))
     else:
@@ -137,39 +140,24 @@ def merge_and_build_index(data_type, src, dconfig, save_path):
     print(f'Processed indices: {total_processed_length:,}')
     print(f'Valid indices: {total_indices:,}')
 
-    cum_length = 0
-    total_indices = []
-    cum_lengths = []
-    group_lengths = []
-    existed = set()
+    if dconfig.remove_md5_dup:
+        save_dir = Path(save_path).parent
+        keep_masks = md5_dedup_masks(arrow_files,
+                                     indices_list,
+                                     tmp_dir=save_dir / (Path(save_path).stem + '_md5_dedup_tmp'),
+                                     num_workers=num_workers,
+                                     report_path=save_dir / (Path(save_path).stem + '_md5_dups.jsonl'),
+                                     )
+        indices_list = [np.asarray(indices)[keep] for indices, keep in zip(indices_list, keep_masks)]
+
     print(f"Accumulating indices...")
-    pbar = tqdm(zip(arrow_files, table_lengths, indices_list), total=len(arrow_files), mininterval=1)
-    _count = 0
-    for arrow_file, table_length, indices in pbar:
-        if len(indices) > 0 and dconfig.remove_md5_dup:
-            new_indices = []
-            table = get_table(arrow_file)
-            if 'md5' not in table.column_names:
-                raise ValueError(f"Column 'md5' not found in {arrow_file}. "
-                                 f"When `remove_md5_dup: true` is set, md5 column is required.")
-            md5s = table['md5'].to_pandas()
-            for i in indices:
-                md5 = md5s[i]
-                if md5 in existed:
-                    continue
-                existed.add(md5)
-                new_indices.append(i)
-            indices = new_indices
-
-        total_indices.extend([int(i + cum_length) for i in indices])
-        cum_length += table_length
-        cum_lengths.append(cum_length)
-        group_lengths.append(len(indices))
-
-        _count += 1
-
-        if _count % 100 == 0:
-            pbar.set_description(f'Indices: {len(total_indices):,}')
+    indices_list = [np.asarray(indices, dtype=np.int64) for indices in indices_list]
+    group_lengths = [len(indices) for indices in indices_list]
+    cum_lengths = np.cumsum(table_lengths, dtype=np.int64).tolist()
+    # offset the indices of each arrow file by the rows of the files before it
+    file_starts = np.asarray(cum_lengths, dtype=np.int64) - np.asarray(table_lengths, dtype=np.int64)
+    total_indices = np.concatenate(indices_list) if indices_list else np.zeros(0, dtype=np.int64)
+    total_indices += np.repeat(file_starts, group_lengths)
 
     builder = IndexV2Builder(data_type=data_type,
                              arrow_files=arrow_files,
@@ -177,6 +165,7 @@ def merge_and_build_index(data_type, src, dconfig, save_path):
                              group_length=group_lengths,
                              indices=total_indices,
                              config_file=dconfig.config_file,
+                             index_format=index_format,
                              )
     builder.build(save_path)
     print(f'Build index finished!\n\n'
@@ -214,6 +203,7 @@ def startup(config_file,
             work_dir='.',
             callback=None,
             use_cache=False,
+            index_format='json',
             ):
     work_dir = Path(work_dir)
     save_path = Path(save)
@@ -267,6 +257,8 @@ def startup(config_file,
                           temp_pickles,
                           dconfig,
                           save_path,
+                          num_workers=world_size,
+                          index_format=index_format,
                           )
 
 
@@ -279,6 +271,9 @@ def make_multireso(target,
                    align=None,
                    min_size=None,
                    md5_file=None,
+                   size_cache_dir=None,
+                   num_workers=None,
+                   index_format='json',
                    ):
     if config_file is not None:
         with Path(config_file).open() as f:
@@ -292,6 +287,11 @@ def make_multireso(target,
     align = config.get('align', align)
     min_size = config.get('min_size', min_size)
     md5_file = config.get('md5_file', md5_file)
+    size_cache_dir = config.get('size_cache_dir', size_cache_dir)
+    num_workers = config.get('num_workers', num_workers)
+    index_format = config.get('index_format', index_format)
+    if size_cache_dir is None:
+        size_cache_dir = Path(target).parent / 'hw_cache'
 
     if src is None:
         raise ValueError('src must be provided in either config file or command line.')
@@ -304,8 +304,12 @@ def make_multireso(target,
         with open(md5_file, 'rb') as f:
             md5_hw = pickle.load(f)
         print(f'Md5 to height and width: {len(md5_hw):,}')
+        # cached sizes depend on the md5 file, key them by it instead of hashing its content
+        stat = os.stat(md5_file)
+        md5_hw_key = f'{Path(md5_file).absolute()}:{stat.st_size}:{stat.st_mtime_ns}'
     else:
         md5_hw = None
+        md5_hw_key = ''
 
     build_multi_resolution_bucket(
         config_file=config_file,
@@ -317,4 +321,8 @@ def make_multireso(target,
         src_index_files=src,
         save_file=target,
         md5_hw=md5_hw,
+        size_cache_dir=size_cache_dir,
+        num_workers=num_workers,
+        index_format=index_format,
+        md5_hw_key=md5_hw_key,
     )
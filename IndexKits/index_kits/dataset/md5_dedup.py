@@ -0,0 +1,166 @@
+import hashlib
+import json
+import os
+import shutil
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+from tqdm import tqdm
+
+from index_kits.indexer import get_table
+
+# One record per kept index: the 128 bit md5 key, its (shard, position) order and how the key was made
+RECORD_DTYPE = np.dtype([('hi', '<u8'), ('lo', '<u8'), ('order', '<u8'), ('hashed', 'u1')])
+POSITION_BITS = 32
+
+# Lowercase hex digit -> nibble, 255 for anything else
+_HEX_LUT = np.full(256, 255, dtype=np.uint8)
+_HEX_LUT[np.frombuffer(b'0123456789', np.uint8)] = np.arange(10)
+_HEX_LUT[np.frombuffer(b'abcdef', np.uint8)] = np.arange(10, 16)
+
+
+def md5_keys(md5s):
+    """
+    Fixed-width keys of an arrow string array: (N, 2) uint64 and a flag per row.
+
+    32 character lowercase hex strings are decoded to their 128 bits, so distinct md5s never collide.
+    Other strings are hashed with blake2b (flag set). Null rows get the key 0 and are flagged invalid.
+    """
+    md5s = md5s.cast(pa.large_string())
+    n = len(md5s)
+    valid = np.ones(n, dtype=bool) if md5s.null_count == 0 else md5s.is_valid().to_numpy(zero_copy_only=False)
+    _, offsets_buf, data_buf = md5s.buffers()
+    offsets = np.frombuffer(offsets_buf, dtype=np.int64)[md5s.offset:md5s.offset + n + 1]
+    data = np.frombuffer(data_buf, dtype=np.uint8) if data_buf is not None else np.zeros(0, dtype=np.uint8)
+
+    keys = np.zeros((n, 2), dtype=np.uint64)
+    hashed = np.zeros(n, dtype=bool)
+    rows = np.flatnonzero(valid & (np.diff(offsets) == 32))
+    nibbles = _HEX_LUT[data[offsets[rows, None] + np.arange(32)]]
+    is_hex = (nibbles != 255).all(axis=1)
+    rows, nibbles = rows[is_hex], nibbles[is_hex]
+    keys[rows] = ((nibbles[:, 0::2] << 4) | nibbles[:, 1::2]).view('<u8')
+
+    others = np.flatnonzero(valid)
+    others = others[~np.isin(others, rows)]
+    for row in others:
+        value = data[offsets[row]:offsets[row + 1]].tobytes()
+        keys[row] = np.frombuffer(hashlib.blake2b(value, digest_size=16).digest(), dtype='<u8')
+    hashed[others] = True
+    return keys, hashed, valid
+
+
+def key_repr(hi, lo, hashed):
+    key = np.asarray([hi, lo], dtype='<u8').tobytes().hex()
+    return f'blake2b:{key}' if hashed else key
+
+
+def shard_records(args):
+    """Records of the md5s of one shard's indices, null md5s are left out (never deduplicated)."""
+    shard_id, arrow_file, indices = args
+    table = get_table(arrow_file)
+    if 'md5' not in table.column_names:
+        raise ValueError(f"Column 'md5' not found in {arrow_file}. "
+                         f"When `remove_md5_dup: true` is set, md5 column is required.")
+    md5s = table['md5'].take(pa.array(indices, pa.int64())).combine_chunks()
+    keys, hashed, valid = md5_keys(md5s)
+    positions = np.flatnonzero(valid)
+    records = np.empty(len(positions), dtype=RECORD_DTYPE)
+    records['hi'], records['lo'] = keys[positions, 0], keys[positions, 1]
+    records['order'] = (np.uint64(shard_id) << np.uint64(POSITION_BITS)) | positions.astype(np.uint64)
+    records['hashed'] = hashed[positions]
+    return records
+
+
+def dedup_partition(path):
+    """
+    Sort one partition by (key, order). The first record of every key wins; the orders of the others
+    are returned, and all members of duplicate clusters are saved next to the partition for the report.
+    """
+    records = np.fromfile(path, dtype=RECORD_DTYPE)
+    records = records[np.lexsort((records['order'], records['lo'], records['hi']))]
+    first = np.ones(len(records), dtype=bool)
+    first[1:] = (records['hi'][1:] != records['hi'][:-1]) | (records['lo'][1:] != records['lo'][:-1])
+    cluster = np.cumsum(first) - 1
+    in_cluster = np.bincount(cluster)[cluster] > 1
+    np.save(f'{path}.dups.npy', records[in_cluster])
+    return records['order'][~first]
+
+
+def md5_dedup_masks(arrow_files, indices_list, tmp_dir, num_workers=1, report_path=None,
+                    partition_bytes=1 << 30):
+    """
+    Keep-mask per shard (arrow file) that drops every index whose md5 already appeared earlier, in shard
+    order and then index order.
+
+    The md5s are turned into fixed-width keys by one pass of workers over the shards and spilled to
+    hash partitions on disk, which are then deduplicated in parallel, so memory is bounded by a shard
+    and a partition instead of a Python set of all md5s. Duplicate clusters are written to report_path
+    as json lines.
+    """
+    tmp_dir = Path(tmp_dir)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    total = sum(len(indices) for indices in indices_list)
+    num_partitions = max(num_workers, -(-total * RECORD_DTYPE.itemsize // partition_bytes))
+    partition_paths = [tmp_dir / f'part-{p:05d}.bin' for p in range(num_partitions)]
+    partition_files = [path.open('wb') for path in partition_paths]
+
+    jobs = [(shard_id, arrow_file, indices) for shard_id, (arrow_file, indices)
+            in enumerate(zip(arrow_files, indices_list)) if len(indices) > 0]
+    with Pool(num_workers) as pool:
+        print(f"Hashing md5s of {len(jobs):,} arrow files into {num_partitions} partitions...")
+        for records in tqdm(pool.imap(shard_records, jobs), total=len(jobs), mininterval=1):
+            partition = records['hi'] % np.uint64(num_partitions)
+            for p in np.unique(partition):
+                records[partition == p].tofile(partition_files[p])
+        for f in partition_files:
+            f.close()
+
+        print(f"Deduplicating partitions...")
+        dropped = pool.map(dedup_partition, partition_paths)
+    dropped = np.sort(np.concatenate(dropped)) if dropped else np.zeros(0, dtype=np.uint64)
+    dropped_shards = (dropped >> np.uint64(POSITION_BITS)).astype(np.int64)
+    dropped_positions = (dropped & np.uint64((1 << POSITION_BITS) - 1)).astype(np.int64)
+
+    keep_masks = []
+    bounds = np.searchsorted(dropped_shards, np.arange(len(indices_list) + 1))
+    for shard_id, indices in enumerate(indices_list):
+        mask = np.ones(len(indices), dtype=bool)
+        mask[dropped_positions[bounds[shard_id]:bounds[shard_id + 1]]] = False
+        keep_masks.append(mask)
+
+    if report_path is not None:
+        num_clusters = write_duplicate_report(report_path, partition_paths, arrow_files, indices_list)
+        print(f"Save {num_clusters:,} md5 duplicate clusters ({len(dropped):,} duplicates) to {report_path}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    return keep_masks
+
+
+def write_duplicate_report(report_path, partition_paths, arrow_files, indices_list):
+    """One json line per duplicate cluster: the md5, the kept sample and the dropped ones as `arrow_file:row`."""
+    def location(order):
+        shard_id, position = int(order) >> POSITION_BITS, int(order) & ((1 << POSITION_BITS) - 1)
+        return f'{arrow_files[shard_id]}:{int(indices_list[shard_id][position])}'
+
+    num_clusters = 0
+    tmp_path = f'{report_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        for path in partition_paths:
+            dups = np.load(f'{path}.dups.npy')
+            if len(dups) == 0:
+                continue
+            starts = np.flatnonzero(np.r_[True, (dups['hi'][1:] != dups['hi'][:-1]) | (dups['lo'][1:] != dups['lo'][:-1])])
+            for start, end in zip(starts, np.r_[starts[1:], len(dups)]):
+                members = dups[start:end]
+                f.write(json.dumps({
+                    'md5': key_repr(members['hi'][0], members['lo'][0], members['hashed'][0]),
+                    'count': int(end - start),
+                    'kept': location(members['order'][0]),
+                    'dropped': [location(order) for order in members['order'][1:]],
+                }) + '\n')
+                num_clusters += 1
+    os.replace(tmp_path, report_path)
+    return num_clusters
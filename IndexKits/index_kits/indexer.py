@@ -1,11 +1,12 @@
 import bisect
 import io
 import json
+import os
 import random
+import shutil
 from pathlib import Path
 import ast
-from itertools import chain
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import partial
 from glob import glob
 
@@ -22,6 +23,49 @@ def get_table(arrow_file):
     return pa.ipc.RecordBatchFileReader(pa.memory_map(f"{arrow_file}", "r")).read_all()
 
 
+def save_indices_dir(path, indices_dict):
+    """
+    Save indices as a directory of int64 .npy files (one per key) and a keys.json with the key order,
+    so that they can be memory-mapped by `load_indices_file`.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    for k, v in indices_dict.items():
+        np.save(tmp_path / f'{k}.npy', np.asarray(v, dtype=np.int64))
+    (tmp_path / 'keys.json').write_text(json.dumps(list(indices_dict.keys())))
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def load_indices_file(indices_file):
+    """
+    Load the indices arrays of an index file, by key.
+
+    A directory written by `save_indices_dir` is memory-mapped read-only, so processes and DataLoader workers
+    share its pages. An .npz archive is read into memory.
+    """
+    indices_file = Path(indices_file)
+    if indices_file.is_dir():
+        keys = json.loads((indices_file / 'keys.json').read_text())
+        return {k: np.load(indices_file / f'{k}.npy', mmap_mode='r') for k in keys}
+    return np.load(indices_file)
+
+
+def memmap_source(array):
+    """(filename, offset, dtype, shape) if array is a whole memory-mapped file, else None."""
+    base = array
+    while base is not None and not isinstance(base, np.memmap):
+        base = base.base
+    if base is None or base.filename is None:
+        return None
+    if array.shape != base.shape or array.dtype != base.dtype or \
+            array.__array_interface__['data'][0] != base.__array_interface__['data'][0]:
+        return None
+    return base.filename, base.offset, base.dtype.str, base.shape
+
+
 def assert_type(data, dtype, msg=''):
     if not isinstance(data, dtype):
         raise ValueError(f'Expected {msg} type {dtype}, got {type(data)}.')
@@ -41,6 +85,142 @@ def ndarray_to_list(data):
     return data
 
 
+def interleave_by_label(values, labels, rng=None):
+    """
+    Randomly interleave the sub-sequences of values that share the same label.
+    The order of values inside each sub-sequence is preserved.
+
+    Parameters
+    ----------
+    values: np.ndarray
+        The values to be interleaved.
+    labels: np.ndarray
+        An integer label for each value.
+    rng: np.random.RandomState
+        The random state. If None, use the global numpy random state.
+
+    Returns
+    -------
+    values: np.ndarray
+        The interleaved values.
+    """
+    if rng is None:
+        rng = np.random
+    labels = np.asarray(labels)
+    sorted_values = values[np.argsort(labels, kind='stable')]
+    slots = labels.copy()
+    rng.shuffle(slots)
+    interleaved = np.empty_like(values)
+    interleaved[np.argsort(slots, kind='stable')] = sorted_values
+    return interleaved
+
+
+class ArrowTableCache(object):
+    """
+    A bounded LRU cache of memory-mapped arrow tables.
+
+    Each DataLoader worker holds its own cache. Opened tables are dropped when the cache is pickled, so
+    spawned workers start with an empty cache instead of copying the tables of the main process.
+
+    Parameters
+    ----------
+    max_tables: int
+        The maximum number of arrow files kept open. Default to 1.
+    max_bytes: int
+        The maximum number of mapped bytes kept open. If None, only max_tables is used. The most recently
+        opened table is always kept, even if it alone exceeds max_bytes.
+
+    Examples
+    --------
+    >>> cache = ArrowTableCache(max_tables=64, max_bytes=8 * 1024 ** 3)
+    >>> table = cache.get('00000.arrow')
+    >>> cache.info()
+    """
+    def __init__(self, max_tables=1, max_bytes=None):
+        if max_tables < 1:
+            raise ValueError(f'max_tables must be positive, got {max_tables}.')
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError(f'max_bytes must be None or positive, got {max_bytes}.')
+        self.max_tables = max_tables
+        self.max_bytes = max_bytes
+        self._tables = OrderedDict()    # arrow_file -> (memory_map, table, mapped_bytes)
+        self.mapped_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._tables)
+
+    def __contains__(self, arrow_file):
+        return arrow_file in self._tables
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tables'] = OrderedDict()
+        state['mapped_bytes'] = 0
+        return state
+
+    def get(self, arrow_file):
+        """
+        Return the table of an arrow file, opening and memory-mapping it on a cache miss.
+        """
+        entry = self._tables.get(arrow_file)
+        if entry is not None:
+            self._tables.move_to_end(arrow_file)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        table_map = pa.memory_map(f"{arrow_file}", "r")
+        table = pa.ipc.RecordBatchFileReader(table_map).read_all()
+        nbytes = table_map.size()
+        self._tables[arrow_file] = (table_map, table, nbytes)
+        self.mapped_bytes += nbytes
+        self._evict()
+        return table
+
+    def _evict(self):
+        while len(self._tables) > 1 and (
+                len(self._tables) > self.max_tables or
+                (self.max_bytes is not None and self.mapped_bytes > self.max_bytes)):
+            _, (table_map, _, nbytes) = self._tables.popitem(last=False)
+            table_map.close()
+            self.mapped_bytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        """ Close all opened tables. The counters are kept. """
+        for table_map, _, _ in self._tables.values():
+            table_map.close()
+        self._tables.clear()
+        self.mapped_bytes = 0
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def info(self):
+        """
+        Return the cache counters.
+
+        Returns
+        -------
+        info: dict
+            hits, misses, evictions, hit_rate, tables (currently opened) and mapped_bytes (currently mapped).
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total > 0 else 0.,
+            'tables': len(self._tables),
+            'mapped_bytes': self.mapped_bytes,
+        }
+
+
 class ArrowIndexV2(object):
     """
     ArrowIndexV2 is a new version of ArrowIndex.
@@ -58,6 +238,15 @@ class ArrowIndexV2(object):
         changed. If a dict is provided, the keys are the shadow names to call the function, and the values are the
         callable functions to map the shadow file path to a new path. If a callable function is provided, the key
         is 'default'.
+    table_cache_size: int
+        The maximum number of arrow files kept open at the same time (per shadow). Default to 1, which only keeps
+        the last accessed arrow file. Increase it when the indices are shuffled across arrow files.
+    table_cache_bytes: int
+        The maximum number of mapped bytes kept open at the same time (per shadow). If None, only
+        table_cache_size is used.
+    table_cache: ArrowTableCache
+        An existing cache for the main arrow files. It can be shared by several indexes built on the same arrow
+        files. If provided, table_cache_size and table_cache_bytes are ignored for the main arrow files.
 
     Examples
     --------
@@ -68,7 +257,7 @@ class ArrowIndexV2(object):
 
     """
     def __init__(self, index_file=None, res_dict=None, align=1,
-                 shadow_file_fn=None, **kwargs):
+                 shadow_file_fn=None, table_cache_size=1, table_cache_bytes=None, table_cache=None, **kwargs):
         if index_file is not None:
             with open(index_file, 'r') as f:
                 res_dict = json.load(f)
@@ -108,7 +297,7 @@ class ArrowIndexV2(object):
             if self.indices_file != '':
                 indices_file = Path(index_file).parent / self.indices_file
                 if Path(indices_file).exists():
-                    self.indices = np.load(indices_file)['x']
+                    self.indices = load_indices_file(indices_file)['x']
                 else:
                     raise ValueError(f'This Index file contains an extra file {indices_file} which is missed.')
         else:
@@ -118,8 +307,7 @@ class ArrowIndexV2(object):
             raise ValueError(f'Expected indices type list or np.ndarray, got {type(self.indices)}.')
 
         if align > 1:
-            if isinstance(self.indices, np.ndarray):
-                self.indices = self.indices.tolist()
+            # An already aligned array (e.g. memory-mapped) is kept as is.
             self.align(align)
 
         self.indices = np.asarray(self.indices, int)
@@ -139,20 +327,22 @@ class ArrowIndexV2(object):
 
         self.bias = self.cum_length
 
+        if table_cache is None:
+            table_cache = ArrowTableCache(table_cache_size, table_cache_bytes)
+        self._table_cache = table_cache
         self._cur_arrow_file = None
-        self._cur_table_map = None
         self._cur_table = None
         self._index_bias = 0
         self.last_index = -1
 
+        self._shadow_table_cache = {}
         self._shadow_cur_arrow_file = {}
-        self._shadow_cur_table_map = {}
         self._shadow_cur_table = {}
         self._shadow_index_bias = {}
         self.shadow_last_index = {}
         for k in self.shadow_file_fn.keys():
+            self._shadow_table_cache[k] = ArrowTableCache(table_cache_size, table_cache_bytes)
             self._shadow_cur_arrow_file[k] = None
-            self._shadow_cur_table_map[k] = None
             self._shadow_cur_table[k] = None
             self._shadow_index_bias[k] = 0
             self.shadow_last_index[k] = -1
@@ -160,6 +350,26 @@ class ArrowIndexV2(object):
     def __len__(self):
         return len(self.indices)
 
+    def __getstate__(self):
+        # Opened tables are not pickled. Each DataLoader worker reopens the arrow files it reads.
+        state = self.__dict__.copy()
+        state['_cur_table'] = None
+        state['last_index'] = -1
+        state['_shadow_cur_table'] = {k: None for k in self._shadow_cur_table}
+        state['shadow_last_index'] = {k: -1 for k in self.shadow_last_index}
+        # Memory-mapped indices are mapped again instead of being copied into the pickle.
+        state['_indices_source'] = memmap_source(self.indices)
+        if state['_indices_source'] is not None:
+            state['indices'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        source = self.__dict__.pop('_indices_source', None)
+        if source is not None:
+            filename, offset, dtype, shape = source
+            self.indices = np.asarray(np.memmap(filename, dtype=dtype, mode='r', offset=offset, shape=shape))
+
     def __repr__(self):
         return f"""
         ArrowIndexV2(
@@ -228,71 +438,112 @@ class ArrowIndexV2(object):
 
         self.group_length = group_length_new
 
-    def shuffle(self, seed=None, fast=False):
+    def shuffle(self, seed=None, fast=False, locality=0):
         """
         It takes about 30 seconds for an index consisting of 100_000 arrows.
+
+        Parameters
+        ----------
+        seed: int
+            The random seed. If not None, this shuffle will not affect any random state.
+        fast: bool
+            If True, globally shuffle the indices without keeping the indices of the same arrow together.
+        locality: int
+            If > 0, shuffle the arrow order and then shuffle the indices inside windows of `locality` arrow
+            files. See shuffle_local. Takes precedence over fast.
         """
+        if locality > 0:
+            return self.shuffle_local(seed, window=locality)
         if fast:
             return self.shuffle_fast(seed)
 
-        indices = self.indices.tolist()
-
         if seed is not None:
             state = random.getstate()
             random.seed(seed)
 
+        # one group at a time as a list, so the whole index is never a python list
         indices_group_list = []
         group_cum_len = 0
         for group_len in self.group_length:
-            indices_group = indices[group_cum_len:group_cum_len + group_len]
+            indices_group = self.indices[group_cum_len:group_cum_len + group_len].tolist()
             random.shuffle(indices_group)
-            indices_group_list.append((indices_group, group_len))
+            indices_group_list.append((np.asarray(indices_group, dtype=np.int64), group_len))
             group_cum_len += group_len
         random.shuffle(indices_group_list)
         self.group_length = [x[1] for x in indices_group_list]
-        self.indices = np.asarray(list(chain.from_iterable([x[0] for x in indices_group_list])))
+        self.indices = np.concatenate([x[0] for x in indices_group_list]) if indices_group_list \
+            else np.zeros(0, dtype=np.int64)
 
         if seed is not None:
             random.setstate(state)
 
     def shuffle_fast(self, seed=None):
+        # Not in place, the indices may be a read-only memory map.
         if seed is not None:
             sampler = np.random.RandomState(seed)
-            sampler.shuffle(self.indices)
+            self.indices = sampler.permutation(self.indices)
         else:
-            np.random.shuffle(self.indices)
+            self.indices = np.random.permutation(self.indices)
+
+    def shuffle_local(self, seed=None, window=8):
+        """
+        Shuffle the arrow order, then shuffle the indices inside windows of `window` consecutive arrow files.
+
+        The indices of a window are mixed together, so any contiguous slice of the shuffled indices only touches
+        about `window` arrow files. Combined with a table cache of at least `window` files, each arrow file is
+        opened about once per epoch. Fully vectorized, and does not depend on the current order of the indices.
+
+        Parameters
+        ----------
+        seed: int
+            The random seed. If not None, this shuffle will not affect any random state.
+        window: int
+            The number of arrow files whose indices are mixed together.
+        """
+        if window < 1:
+            raise ValueError(f'window must be positive, got {window}.')
+        sampler = np.random.RandomState(seed) if seed is not None else np.random
+
+        file_ids = np.searchsorted(self.cum_length, self.indices, side='right')
+        present = np.flatnonzero(np.bincount(file_ids, minlength=len(self.arrow_files)))
+        file_pos = np.zeros(len(self.arrow_files), dtype=np.int64)
+        file_pos[sampler.permutation(present)] = np.arange(len(present))
+        window_ids = file_pos[file_ids] // window
+
+        order = np.lexsort((sampler.random_sample(len(self.indices)), window_ids))
+        self.indices = self.indices[order]
 
     def get_table(self, arrow_file, shadow=None):
         """
         Read an arrow file and return an arrow table.
         """
         if shadow is None:
-            if self._cur_table is not None:
-                if self._cur_arrow_file == arrow_file:
-                    # This is the same arrow file. Return the cached table.
-                    return self._cur_table
-                else:
-                    # This is a different arrow file. Clear the cache.
-                    self._cur_table_map.close()
-                    self._cur_table = None
-
             self._cur_arrow_file = arrow_file
-            self._cur_table_map = pa.memory_map(f"{arrow_file}", "r")
-            self._cur_table = pa.ipc.RecordBatchFileReader(self._cur_table_map).read_all()
+            self._cur_table = self._table_cache.get(arrow_file)
             return self._cur_table
         else:
-            if self._shadow_cur_table[shadow] is not None:
-                if self._shadow_cur_arrow_file[shadow] == arrow_file:
-                    return self._shadow_cur_table[shadow]
-                else:
-                    self._shadow_cur_table_map[shadow].close()
-                    self._shadow_cur_table[shadow] = None
-
             self._shadow_cur_arrow_file[shadow] = arrow_file
-            self._shadow_cur_table_map[shadow] = pa.memory_map(f"{arrow_file}", "r")
-            self._shadow_cur_table[shadow] = pa.ipc.RecordBatchFileReader(self._shadow_cur_table_map[shadow]).read_all()
+            self._shadow_cur_table[shadow] = self._shadow_table_cache[shadow].get(arrow_file)
             return self._shadow_cur_table[shadow]
 
+    def table_cache_info(self, shadow=None):
+        """
+        Get the hit/miss counters of the arrow table cache.
+
+        Parameters
+        ----------
+        shadow: str
+            The shadow name. If None, return the counters of the main arrow files.
+
+        Returns
+        -------
+        info: dict
+            See ArrowTableCache.info.
+        """
+        if shadow is None:
+            return self._table_cache.info()
+        return self._shadow_table_cache[shadow].info()
+
     def get_arrow_file_by_index(self, index, return_index_bias=False, shadow=None):
         i = bisect.bisect_right(self.cum_length, index)
         arrow_file = self.arrow_files[i]
@@ -626,6 +877,7 @@ class IndexV2Builder(object):
                  max_indices=5_000_000,
                  example_num=1000,
                  config_file=None,
+                 index_format='json',
                  ):
         """
         Build index v2 from an index dict.
@@ -652,6 +904,10 @@ class IndexV2Builder(object):
             The number of examples to be saved in the index file. Default to 1000.
         config_file: str
             The path of config file.
+        index_format: str
+            'json' keeps small indices in the json file and larger ones in a compressed .npz. 'npy' always saves
+            the indices as a directory of .npy files next to the json header, which are memory-mapped when
+            loading. Default to 'json'.
 
         Examples
         --------
@@ -672,6 +928,9 @@ class IndexV2Builder(object):
         self.max_indices = max_indices
         self.example_num = example_num
         self.config_file = config_file
+        if index_format not in ('json', 'npy'):
+            raise ValueError(f"Expected index_format 'json' or 'npy', got {index_format}.")
+        self.index_format = index_format
 
         if isinstance(arrow_files, str):
             if '*' in arrow_files or '?' in arrow_files:
@@ -719,7 +978,11 @@ class IndexV2Builder(object):
         assert_type(self.indices, (list, dict, np.ndarray), 'indices')
         self.cum_length = ndarray_to_list(self.cum_length)
         self.group_length = ndarray_to_list(self.group_length)
-        self.indices = ndarray_to_list(self.indices)
+        if isinstance(self.indices, np.ndarray):
+            # kept as an array, it is only listed when small enough to be saved in the json file
+            self.indices = self.indices.astype(np.int64, copy=False)
+        else:
+            self.indices = ndarray_to_list(self.indices)
 
         if isinstance(self.indices, dict):
             for k, v in self.indices.items():
@@ -729,7 +992,7 @@ class IndexV2Builder(object):
             raise ValueError(f'Length of arrow_files and cum_length does not match. {len(self.arrow_files)} != {len(self.cum_length)}')
         if len(self.indices) == 0:
             raise ValueError(f'No indices found in index_dict.')
-        if isinstance(self.indices, list) and self.indices[-1] > self.cum_length[-1] - 1:
+        if isinstance(self.indices, (list, np.ndarray)) and self.indices[-1] > self.cum_length[-1] - 1:
             raise ValueError(f'Indices exceed cum_length. {self.indices[-1]} > {self.cum_length[-1] - 1}')
         if len(self.group_length) > 0:
             if len(self.arrow_files) != len(self.group_length):
@@ -748,7 +1011,7 @@ class IndexV2Builder(object):
 
         # Calculate group_length
         print("Calculating group length...")
-        if isinstance(self.indices, list):
+        if isinstance(self.indices, (list, np.ndarray)):
             if len(self.group_length) == 0:
                 self.group_length = self.calc_group_length(self.indices, self.cum_length)
             else:
@@ -794,7 +1057,8 @@ class IndexV2Builder(object):
         save_path = Path(save_path)
         save_path.parent.mkdir(exist_ok=True, parents=True)
 
-        if isinstance(index_dict['indices'], list) and len(index_dict['indices']) > self.max_indices:
+        if isinstance(index_dict['indices'], (list, np.ndarray)) and \
+                (len(index_dict['indices']) > self.max_indices or self.index_format == 'npy'):
             self.example_indices = index_dict['indices'][:self.example_num]
             indices_to_save = {'x': index_dict['indices']}
             index_dict['indices'] = []
@@ -806,9 +1070,15 @@ class IndexV2Builder(object):
             index_dict['example_indices'] = {k: v[:example_num_per_key] for k, v in index_dict['indices'].items()}
         else:
             indices_to_save = None
+            if isinstance(index_dict['indices'], np.ndarray):
+                index_dict['indices'] = index_dict['indices'].tolist()
 
         # save indices
-        if indices_to_save is not None:
+        if indices_to_save is not None and self.index_format == 'npy':
+            indices_file = save_path.parent / f'{save_path.stem}.index'
+            save_indices_dir(indices_file, indices_to_save)
+            index_dict['indices_file'] = indices_file.name
+        elif indices_to_save is not None:
             indices_file = save_path.parent / f'{save_path.stem}.index'
             indices_dict = {k: np.array(v) for k, v in indices_to_save.items()}
             np.savez_compressed(indices_file, **indices_dict)
@@ -42,6 +42,10 @@ class BlockDistributedSampler(DistributedSampler):
         self._start_index = value
         self.recompute_sizes()
 
+    def skip_batches(self, num_batches, batch_size):
+        """Start the iteration after num_batches batches of this rank."""
+        self.start_index = num_batches * batch_size
+
     def recompute_sizes(self):
         self.num_samples = len(self.dataset) // self.batch_size * self.batch_size // self.num_replicas \
                            - self._start_index
@@ -102,6 +106,10 @@ class DistributedSamplerWithStartIndex(DistributedSampler):
         self._start_index = value
         self.recompute_sizes()
 
+    def skip_batches(self, num_batches, batch_size):
+        """Start the iteration after num_batches batches of each rank."""
+        self.start_index = num_batches * batch_size * self.num_replicas
+
     def recompute_sizes(self):
         # If the dataset length is evenly divisible by # of replicas, then there
         # is no need to drop any data, since the dataset will be split equally.
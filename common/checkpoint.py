@@ -0,0 +1,124 @@
+import os
+import re
+import shutil
+import torch
+
+from concurrent.futures import ThreadPoolExecutor
+from safetensors.torch import save_file
+from common.logging import logger
+
+_active_writer = None
+CHECKPOINT_PATTERN = re.compile(r"^checkpoint-e(\d+)_s(\d+)")
+# the model file (or save_pretrained directory) of a checkpoint, not its _optimizer/_loss_weight/... sidecars
+MODEL_FILE_PATTERN = re.compile(r"^checkpoint-e(\d+)_s(\d+)(\.ckpt|\.safetensors|\.pt)?$")
+
+
+def get_checkpoint_writer():
+    return _active_writer
+
+
+def prune_checkpoints(checkpoint_dir, keep_last_n: int):
+    """Keep the files of the last n checkpoints (by step) in checkpoint_dir, remove the rest."""
+    if keep_last_n <= 0 or not os.path.isdir(checkpoint_dir):
+        return
+
+    groups = {}
+    for name in os.listdir(checkpoint_dir):
+        match = CHECKPOINT_PATTERN.match(name)
+        if match is None or name.endswith(".tmp"):
+            continue
+        epoch, step = int(match.group(1)), int(match.group(2))
+        groups.setdefault((step, epoch), []).append(os.path.join(checkpoint_dir, name))
+
+    for key in sorted(groups)[:-keep_last_n]:
+        for path in groups[key]:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        logger.info(f"Removed old checkpoint e{key[1]}_s{key[0]}")
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints from a background thread.
+
+    The state is first copied into (reused) pinned CPU buffers, so training can
+    continue as soon as the copy finished. Files are written to <path>.tmp and
+    renamed into place, a checkpoint on disk is always complete. Buffers are
+    kept per slot (e.g. "model", "optimizer"), a new snapshot of a slot waits for
+    the previous write of that slot.
+    """
+
+    def __init__(self, keep_last_n: int = -1, checkpoint_dir: str = None):
+        self.keep_last_n = keep_last_n
+        self.checkpoint_dir = checkpoint_dir
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="checkpoint")
+        self._futures = {}
+        self._buffers = {}
+
+    def activate(self):
+        global _active_writer
+        _active_writer = self
+
+    def wait(self, slot=None):
+        """Block until pending writes (of a slot) are done, re-raises errors of the background writes."""
+        slots = list(self._futures) if slot is None else [slot]
+        for s in slots:
+            future = self._futures.pop(s, None)
+            if future is not None:
+                future.result()
+
+    def snapshot(self, obj, key=()):
+        """Copy all tensors of a (nested) state to CPU, into pinned buffers reused across saves."""
+        if isinstance(obj, torch.Tensor):
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=torch.cuda.is_available())
+                self._buffers[key] = buf
+            buf.copy_(obj.detach(), non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            return {k: self.snapshot(v, key + (k,)) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return obj
+
+    def submit(self, path, state, write_fn, slot="model"):
+        """Snapshot state and write it with write_fn(state, tmp_path) in the background."""
+        self.wait(slot)
+        state = self.snapshot(state, (slot,))
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self._futures[slot] = self._executor.submit(self._write, str(path), state, write_fn)
+
+    def _write(self, path, state, write_fn):
+        tmp_path = path + ".tmp"
+        write_fn(state, tmp_path)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved checkpoint to {path}")
+        if self.checkpoint_dir is not None:
+            prune_checkpoints(self.checkpoint_dir, self.keep_last_n)
+
+
+def save_state_dict(state_dict, path, metadata=None, save_format="safetensors"):
+    """
+    Save a model state dict as safetensors or ckpt, through the active async writer if any.
+    Returns the path with the format suffix.
+    """
+    if save_format == "safetensors":
+        path += ".safetensors"
+        write_fn = lambda sd, p: save_file(sd, p, metadata=metadata)
+    else:
+        path += ".ckpt"
+        write_fn = lambda sd, p: torch.save({"state_dict": sd, **(metadata or {})}, p)
+
+    writer = get_checkpoint_writer()
+    if writer is not None:
+        writer.submit(path, state_dict, write_fn)
+        return path
+
+    tmp_path = path + ".tmp"
+    write_fn(state_dict, tmp_path)
+    os.replace(tmp_path, path)
+    return path
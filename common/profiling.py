@@ -0,0 +1,197 @@
+import time
+import torch
+
+from collections import defaultdict
+from contextlib import ContextDecorator, contextmanager, nullcontext
+from common.logging import logger
+
+_active_profiler = None
+
+
+class profile_phase(ContextDecorator):
+    """
+    Time a phase of the current training step, as a context manager or decorator.
+    No-op unless the trainer enabled profiling.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._contexts = []
+
+    def __enter__(self):
+        ctx = _active_profiler.phase(self.name) if _active_profiler is not None else nullcontext()
+        self._contexts.append(ctx)
+        return ctx.__enter__()
+
+    def __exit__(self, *exc):
+        return self._contexts.pop().__exit__(*exc)
+
+
+class StepProfiler:
+    """
+    Per-phase timers for the training loop.
+
+    Phases may nest (e.g. "vae" inside "forward"), each phase is reported
+    exclusive of the phases nested in it. With sync=True CUDA is synchronized at
+    phase boundaries so GPU work is charged to the phase that queued it; this
+    removes some overlap, so compare step times with profiling off as well.
+
+    Config (trainer.profiling):
+        enabled: bool             enable phase timers and throughput metrics
+        sync: bool                synchronize CUDA at phase boundaries (default true)
+        summary_every: int        log a summary table every n steps (0 to disable)
+        profiler_start: int       first global step of the torch.profiler window
+        profiler_steps: int       number of steps to trace (0 to disable)
+        profiler_dir: str         output directory for the tensorboard traces
+    """
+
+    def __init__(
+        self,
+        enabled: bool = False,
+        sync: bool = True,
+        summary_every: int = 0,
+        profiler_start: int = 10,
+        profiler_steps: int = 0,
+        profiler_dir: str = "profiler",
+        world_size: int = 1,
+        rank: int = 0,
+    ):
+        self.enabled = enabled
+        self.sync = sync and torch.cuda.is_available()
+        self.summary_every = summary_every
+        self.profiler_start = profiler_start
+        self.profiler_steps = profiler_steps
+        self.profiler_dir = profiler_dir
+        self.world_size = world_size
+        self.rank = rank
+
+        self._stack = []
+        self._torch_profiler = None
+        self._reset_window()
+        self._summary = defaultdict(float)
+        self._summary_steps = 0
+
+    def _reset_window(self):
+        self._window = defaultdict(float)
+        self._window_steps = 0
+        self._window_start = time.perf_counter()
+        self._samples = 0
+        self._tokens = 0
+        self._pixels = 0
+
+    def activate(self):
+        global _active_profiler
+        _active_profiler = self if self.enabled else None
+
+    @contextmanager
+    def phase(self, name: str):
+        if not self.enabled:
+            yield
+            return
+
+        if self.sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        self._stack.append(0.0)
+        try:
+            yield
+        finally:
+            if self.sync:
+                torch.cuda.synchronize()
+            elapsed = time.perf_counter() - start
+            nested = self._stack.pop()
+            self._window[name] += elapsed - nested
+            if self._stack:
+                self._stack[-1] += elapsed
+
+    def iterate(self, iterable, name: str = "data"):
+        """Wrap an iterable (e.g. the dataloader), time spent waiting for each item goes to `name`."""
+        it = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def count(self, batch):
+        """Count samples, tokens and pixels of a batch from tensor shapes only (no device sync)."""
+        if not self.enabled or not isinstance(batch, dict):
+            return
+        input_ids = batch.get("input_ids")
+        pixels = batch.get("pixels")
+        if isinstance(input_ids, torch.Tensor):
+            self._samples += input_ids.shape[0]
+            self._tokens += input_ids.numel()
+        elif isinstance(pixels, torch.Tensor):
+            scale = 64 if batch.get("is_latent") else 1
+            self._samples += pixels.shape[0]
+            self._pixels += pixels.shape[0] * pixels.shape[-2] * pixels.shape[-1] * scale
+
+    def step(self, global_step: int):
+        """Call once per optimizer step."""
+        if not self.enabled:
+            return
+
+        self._window_steps += 1
+        if self.profiler_steps > 0:
+            if global_step == self.profiler_start:
+                self._start_torch_profiler()
+            elif self._torch_profiler is not None:
+                self._torch_profiler.step()
+                if global_step >= self.profiler_start + self.profiler_steps:
+                    self._torch_profiler.stop()
+                    self._torch_profiler = None
+                    logger.info(f"Saved torch.profiler trace to {self.profiler_dir}")
+
+    def _start_torch_profiler(self):
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._torch_profiler = torch.profiler.profile(
+            activities=activities,
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.profiler_dir, worker_name=f"rank{self.rank}"),
+            record_shapes=True,
+            with_stack=True,
+        )
+        self._torch_profiler.start()
+        logger.info(f"Started torch.profiler for {self.profiler_steps} steps")
+
+    def metrics(self, global_step: int) -> dict:
+        """Averages since the last call, as loggable metrics. Also emits the summary table when due."""
+        if not self.enabled or self._window_steps == 0:
+            return {}
+
+        steps = self._window_steps
+        elapsed = time.perf_counter() - self._window_start
+        metrics = {f"time/{k}_ms": v * 1000 / steps for k, v in self._window.items()}
+        metrics["time/step_ms"] = elapsed * 1000 / steps
+        metrics["throughput/samples_per_sec"] = self._samples * self.world_size / elapsed
+        if self._tokens:
+            metrics["throughput/tokens_per_sec"] = self._tokens * self.world_size / elapsed
+        if self._pixels:
+            metrics["throughput/pixels_per_sec"] = self._pixels * self.world_size / elapsed
+
+        for k, v in self._window.items():
+            self._summary[k] += v
+        self._summary["step"] += elapsed
+        self._summary_steps += steps
+        self._reset_window()
+
+        if self.summary_every > 0 and global_step % self.summary_every == 0:
+            logger.info(f"Step time breakdown (last {self._summary_steps} steps)\n{self.summary()}")
+            self._summary = defaultdict(float)
+            self._summary_steps = 0
+        return metrics
+
+    def summary(self) -> str:
+        total = self._summary.get("step", 0.0)
+        steps = max(self._summary_steps, 1)
+        rows = [f"{'phase':<16}{'ms/step':>12}{'%':>8}"]
+        phases = sorted((k for k in self._summary if k != "step"), key=lambda k: -self._summary[k])
+        other = total - sum(self._summary[k] for k in phases)
+        for k, v in [(k, self._summary[k]) for k in phases] + [("other", other)]:
+            rows.append(f"{k:<16}{v * 1000 / steps:>12.2f}{100 * v / max(total, 1e-9):>8.1f}")
+        rows.append(f"{'step':<16}{total * 1000 / steps:>12.2f}{100.0:>8.1f}")
+        return "\n".join(rows)
@@ -6,6 +6,8 @@ import lightning as pl
 
 from common.utils import *
 from common.logging import logger
+from common.profiling import StepProfiler
+from common.checkpoint import AsyncCheckpointWriter, prune_checkpoints
 from omegaconf import OmegaConf
 from pathlib import Path
 
@@ -29,6 +31,15 @@ class Trainer:
         self.dataloader = dataloader
         self.global_step = int(config.get("global_step", 0))
         self.current_epoch = int(config.get("current_epoch", 0))
+        self.epoch_step = -1
+
+        self.checkpoint_writer = None
+        if config.trainer.get("async_checkpoint", False):
+            self.checkpoint_writer = AsyncCheckpointWriter(
+                keep_last_n=config.trainer.get("keep_last_n_checkpoints", -1),
+                checkpoint_dir=config.trainer.checkpoint_dir,
+            )
+            self.checkpoint_writer.activate()
 
     def prepare_logger(self):
         """Prepare the logger and log hyperparameters if the logger is not CSVLogger."""
@@ -126,6 +137,7 @@ class Trainer:
         metadata = {
             "global_step": str(self.global_step),
             "current_epoch": str(self.current_epoch),
+            "epoch_step": str(self.epoch_step),
         }
         
         # # save state if you want to use fabric.save
@@ -139,12 +151,40 @@ class Trainer:
         
         self.model.save_checkpoint(model_path, metadata)
         if not save_weights_only:
-            optimizer_state = {"optimizer": self.optimizer, **metadata}
-            self.fabric.save(model_path + "_optimizer.pt", optimizer_state)
+            self.save_optimizer(model_path + "_optimizer.pt", metadata)
+        if self.checkpoint_writer is None and self.fabric.is_global_zero:
+            prune_checkpoints(ckpt_dir, cfg.get("keep_last_n_checkpoints", -1))
             
         if "schedulefree" in self.optimizer.__class__.__name__.lower():
             self.optimizer.train()
 
+    def skip_batches(self, num_batches: int) -> bool:
+        """
+        Make the dataloader start after num_batches (per rank) batches of the current epoch,
+        without loading them. Returns False if the sampler can't do that.
+        """
+        sampler = getattr(self.dataloader, "sampler", None)
+        if not hasattr(sampler, "skip_batches"):
+            return False
+        sampler.skip_batches(num_batches, self.dataloader.batch_size or 1)
+        return True
+
+    def save_optimizer(self, path, metadata):
+        """
+        Save the optimizer state, in the background when async checkpointing is enabled.
+        Sharded strategies always go through fabric.save.
+        """
+        is_sharded = hasattr(self.fabric.strategy, "_deepspeed_engine") \
+            or hasattr(self.fabric.strategy, "_fsdp_kwargs")
+        if self.checkpoint_writer is None or is_sharded:
+            optimizer_state = {"optimizer": self.optimizer, **metadata}
+            self.fabric.save(path, optimizer_state)
+            return
+
+        if self.fabric.is_global_zero:
+            optimizer_state = {"optimizer": self.optimizer.state_dict(), **metadata}
+            self.checkpoint_writer.submit(path, optimizer_state, torch.save, slot="optimizer")
+
     def perform_sampling(self, is_last: bool = False):
         """
         Perform image/text sampling.
@@ -220,16 +260,19 @@ class Trainer:
                 logger.info(f"Loaded optimizer state from {opt_path}")
                 self.global_step = int(remainder.pop("global_step", self.global_step))
                 self.current_epoch = int(remainder.pop("current_epoch", self.current_epoch))
+                self.epoch_step = int(remainder.pop("epoch_step", self.epoch_step))
             else:
                 if latest_ckpt.endswith(".ckpt"):
                     sd = torch.load(latest_ckpt, map_location="cpu")
                     self.global_step = int(sd.pop("global_step", self.global_step))
                     self.current_epoch = int(sd.pop("current_epoch", self.current_epoch))
+                    self.epoch_step = int(sd.pop("epoch_step", self.epoch_step))
                 elif latest_ckpt.endswith(".safetensors"):
                     with safetensors.torch.safe_open(latest_ckpt, framework="pt") as f:
                         metadata = f.metadata()
                         self.global_step = int(metadata.get("global_step", self.global_step))
                         self.current_epoch = int(metadata.get("current_epoch", self.current_epoch))
+                        self.epoch_step = int(metadata.get("epoch_step", self.epoch_step))
                 
             logger.info(f"Resuming training from step {self.global_step} and epoch {self.current_epoch}")
         else:
@@ -240,6 +283,17 @@ class Trainer:
             should_stop = True
 
         self.prepare_logger()
+        log_every = cfg.get("log_every_n_steps", 1)
+        profiler = StepProfiler(
+            world_size=fabric.world_size, 
+            rank=fabric.global_rank, 
+            **cfg.get("profiling", {}),
+        )
+        profiler.activate()
+        
+        # losses are accumulated on device and only synced on log steps
+        loss_sum, loss_count = 0.0, 0
+        stat_str = ""
         loss_rec = LossRecorder()
         progress  = ProgressBar(
             total=len(self.dataloader) // config.trainer.accumulate_grad_batches,
@@ -247,9 +301,14 @@ class Trainer:
         )
         assert len(self.dataloader) > 0, "Dataloader is empty"
         
-        steps_per_epoch = len(self.dataloader) // config.trainer.accumulate_grad_batches
-        resume_epoch = self.global_step // steps_per_epoch
-        resume_step = self.global_step % steps_per_epoch
+        num_batches = len(self.dataloader)
+        steps_per_epoch = num_batches // config.trainer.accumulate_grad_batches
+        if self.epoch_step >= 0:
+            # exact position saved with the checkpoint
+            resume_epoch, resume_step = self.current_epoch, self.epoch_step
+        else:
+            resume_epoch = self.global_step // steps_per_epoch
+            resume_step = self.global_step % steps_per_epoch
         while not should_stop:
             desc = f"Epoch {self.current_epoch}"
             progress.update(desc, 0)
@@ -258,10 +317,21 @@ class Trainer:
             if "schedulefree" in self.optimizer.__class__.__name__.lower():
                 self.optimizer.train()
 
-            for batch_idx, batch in enumerate(self.dataloader):  
+            if hasattr(self.dataset, "set_epoch"):
+                self.dataset.set_epoch(self.current_epoch)
+
+            # start the dataloader at the first unseen batch if the sampler supports it,
+            # otherwise replay the epoch and skip the completed steps
+            batch_offset = 0
+            is_resumed_epoch = self.current_epoch == resume_epoch and resume_step > 0
+            if is_resumed_epoch and self.skip_batches(resume_step * grad_accum_steps):
+                batch_offset = resume_step * grad_accum_steps
+                logger.info(f"Skipped {batch_offset} batches of epoch {self.current_epoch} without loading them")
+
+            for batch_idx, batch in enumerate(profiler.iterate(self.dataloader, "data"), start=batch_offset):  
                 # Skip the completed steps in the current epoch
                 local_acc_step = batch_idx // grad_accum_steps + 1
-                if self.current_epoch == resume_epoch and local_acc_step < resume_step:
+                if is_resumed_epoch and not batch_offset and local_acc_step < resume_step:
                     continue
                 
                 local_step += 1    
@@ -277,49 +347,72 @@ class Trainer:
 
                 with fabric.no_backward_sync(fabric_module, enabled=is_accumulating):
                 # with torch.autograd.detect_anomaly():
-                    loss = self.model(batch)
-                    self.fabric.backward(loss / grad_accum_steps)
-
-                loss = loss.detach().item()
-                loss_rec.add(epoch=self.current_epoch, step=batch_idx, loss=loss)
+                    with profiler.phase("forward"):
+                        loss = self.model(batch)
+                    with profiler.phase("backward"):
+                        self.fabric.backward(loss / grad_accum_steps)
+
+                loss_sum = loss_sum + loss.detach()
+                loss_count += 1
+                profiler.count(batch)
                 metrics = {
-                    "train/loss": loss,
                     "trainer/step_t": time.perf_counter() - local_timer,
                 }
-                stat_str = f"train_loss: {loss:.3f}, avg_loss: {loss_rec.avg:.3f}"
                 progress.update(desc, local_acc_step, status=stat_str)
                     
                 # skip here if we are accumulating
                 if is_accumulating:
                     continue
 
-                if grad_clip_val > 0:
-                    grad_norm = self.fabric.clip_gradients(
-                        module=fabric_module, 
-                        optimizer=self.optimizer, 
-                        max_norm=grad_clip_val
-                    )
-                    if grad_norm is not None:
-                        metrics["train/grad_norm"] = grad_norm
-
-                if self.optimizer is not None:
-                    self.optimizer.step()
-                    self.optimizer.zero_grad(set_to_none=True)
-
-                if self.scheduler is not None:
-                    is_transformers_sch = "transformers" in config.scheduler.name
-                    fp_batch = self.current_epoch + batch_idx / len(self.dataloader)
-                    actual_step = self.global_step if is_transformers_sch else fp_batch
-                    self.scheduler.step(actual_step)
-
-                if fabric.logger:
-                    fabric.log_dict(metrics=metrics, step=self.global_step)
-
+                with profiler.phase("optimizer"):
+                    if grad_clip_val > 0:
+                        grad_norm = self.fabric.clip_gradients(
+                            module=fabric_module, 
+                            optimizer=self.optimizer, 
+                            max_norm=grad_clip_val
+                        )
+                        if grad_norm is not None:
+                            metrics["train/grad_norm"] = grad_norm
+
+                    if self.optimizer is not None:
+                        self.optimizer.step()
+                        # lightning hook (a no-op unless overridden), e.g. for EMA updates of the model
+                        self.model.on_before_zero_grad(self.optimizer)
+                        self.optimizer.zero_grad(set_to_none=True)
+
+                with profiler.phase("scheduler"):
+                    if self.scheduler is not None:
+                        is_transformers_sch = "transformers" in config.scheduler.name
+                        fp_batch = self.current_epoch + batch_idx / num_batches
+                        actual_step = self.global_step if is_transformers_sch else fp_batch
+                        self.scheduler.step(actual_step)
+
+                with profiler.phase("logging"):
+                    if self.global_step % log_every == 0:
+                        loss = (loss_sum / loss_count).item()
+                        loss_sum, loss_count = 0.0, 0
+                        loss_rec.add(epoch=self.current_epoch, step=(local_acc_step - 1) // log_every, loss=loss)
+                        metrics["train/loss"] = loss
+                        metrics.update(profiler.metrics(self.global_step))
+                        stat_str = f"train_loss: {loss:.3f}, avg_loss: {loss_rec.avg:.3f}"
+                        progress.update(desc, local_acc_step, status=stat_str)
+                        if fabric.logger:
+                            fabric.log_dict(metrics=metrics, step=self.global_step)
+
+                profiler.step(self.global_step)
                 self.global_step += 1
-                self.on_post_training_batch()
+                self.epoch_step = local_acc_step
+                with profiler.phase("post_step"):
+                    self.on_post_training_batch()
 
+            if batch_offset:
+                self.skip_batches(0)
             self.current_epoch += 1
+            self.epoch_step = 0
             if cfg.max_epochs > 0 and self.current_epoch >= cfg.max_epochs:
                 should_stop = True
 
             self.on_post_training_batch(is_last=True)
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
@@ -170,9 +170,14 @@ def get_class(name: str):
 def get_latest_checkpoint(checkpoint_dir: str):
     if not os.path.isdir(checkpoint_dir):
         return None
-    items = sorted(os.listdir(checkpoint_dir))
-    # remove all _optimizer.pt
-    items = [x for x in items if "_optimizer" not in x]
+    from common.checkpoint import MODEL_FILE_PATTERN
+
+    # only model files: skips _optimizer.pt, _loss_weight.pt and other sidecars and unfinished writes
+    items = []
+    for name in os.listdir(checkpoint_dir):
+        match = MODEL_FILE_PATTERN.match(name)
+        if match is not None:
+            items.append((int(match.group(2)), int(match.group(1)), name))
     if not items:
         return None
-    return os.path.join(checkpoint_dir, items[-1])
+    return os.path.join(checkpoint_dir, max(items)[2])
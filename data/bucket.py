@@ -3,31 +3,51 @@ import math
 import numpy as np
 import random
 import torch
-from collections import defaultdict
 
 from pathlib import Path
-from torch.utils.data import Dataset, get_worker_info
-from data.image_storage import DirectoryImageStore, Entry, LatentStore
+from torch.utils.data import Dataset
+from data.image_storage import DirectoryImageStore, Entry, LatentStore, PackedLatentStore
 from torchvision.transforms import Resize, InterpolationMode
 from common.logging import logger
-from common.utils import get_class
+from common.utils import get_class, get_world_size
+from IndexKits.index_kits.sampler import DistributedSamplerWithStartIndex
 
 image_suffix = set([".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".tif", ".webp"])
 
 
-def is_latent_folder(path: Path):
+def is_latent_folder(path: Path, suffix: str = ".h5"):
     # iterate over all files in the folder and find if any of them is a latent
     for p in path.iterdir():
         if p.is_dir():
             continue
-        if p.suffix == ".h5":
+        if p.suffix == suffix:
             return True
 
-def worker_init_fn(worker_id):
-    worker_info = get_worker_info()
-    dataset: RatioDataset = worker_info.dataset  # type: ignore
-    # random.seed(worker_info.seed)  # type: ignore
-    dataset.init_batches()
+def nearest_ratio_index(ratios: np.ndarray, bucket_ratios: np.ndarray) -> np.ndarray:
+    """
+    Vectorized equivalent of `np.argmin(np.abs(bucket_ratios - ratio))` for every ratio.
+    Ties (and duplicated bucket ratios) resolve to the lowest bucket index, same as argmin.
+    """
+    ratios = np.asarray(ratios, dtype=np.float64)
+    bucket_ratios = np.asarray(bucket_ratios, dtype=np.float64)
+    sorted_ratios, first_idx = np.unique(bucket_ratios, return_index=True)
+
+    pos = np.searchsorted(sorted_ratios, ratios)
+    left = np.clip(pos - 1, 0, len(sorted_ratios) - 1)
+    right = np.clip(pos, 0, len(sorted_ratios) - 1)
+    diff_left = np.abs(sorted_ratios[left] - ratios)
+    diff_right = np.abs(sorted_ratios[right] - ratios)
+    idx_left, idx_right = first_idx[left], first_idx[right]
+
+    pick_left = (diff_left < diff_right) | ((diff_left == diff_right) & (idx_left < idx_right))
+    return np.where(pick_left, idx_left, idx_right)
+
+
+def group_by_label(labels: np.ndarray, num_labels: int) -> list[np.ndarray]:
+    """Split range(len(labels)) into ascending index arrays, one per label."""
+    order = np.argsort(labels, kind="stable")
+    counts = np.bincount(labels, minlength=num_labels)
+    return np.split(order, np.cumsum(counts)[:-1])
 
 
 class RatioDataset(Dataset):
@@ -42,6 +62,9 @@ class RatioDataset(Dataset):
         use_central_crop=True,
         **kwargs,
     ):
+        self.seed = seed
+        self.rank = rank
+        self.epoch = 0
         self.rng = np.random.default_rng(seed)
         self.batch_size = batch_size
         self.num_workers = kwargs.get("num_workers", 4)
@@ -52,6 +75,8 @@ class RatioDataset(Dataset):
         
         if kwargs.get("store_cls"):
             store_class = get_class(kwargs["store_cls"])
+        elif is_latent_folder(root_path, ".pack"):
+            store_class = PackedLatentStore
         elif is_latent_folder(root_path):
             store_class = LatentStore
         else:
@@ -73,16 +98,32 @@ class RatioDataset(Dataset):
 
     def init_batches(self):
         self.assign_buckets()
+        self.set_epoch(0)
+
+    def set_epoch(self, epoch: int):
+        """
+        Shuffle the batches for an epoch. The order only depends on (seed, epoch),
+        so a resumed run can seek to its position instead of replaying the epoch.
+        """
+        self.epoch = epoch
+        self.rng = np.random.default_rng([self.seed, epoch])
         self.assign_batches()
 
     def init_dataloader(self, **kwargs):
+        # batches are already shuffled by set_epoch, the sampler only splits them
+        # across ranks and supports starting in the middle of an epoch
+        sampler = DistributedSamplerWithStartIndex(
+            self,
+            num_replicas=get_world_size(),
+            rank=self.rank,
+            shuffle=False,
+            drop_last=False,
+        )
         dataloader = torch.utils.data.DataLoader(
             self,
-            sampler=None,
+            sampler=sampler,
             batch_size=None,
             num_workers=self.num_workers,
-            worker_init_fn=worker_init_fn,
-            shuffle=True,
             pin_memory=True,
             **kwargs,
         )
@@ -116,7 +157,7 @@ class RatioDataset(Dataset):
     def assign_batches(self):
         self.batch_idxs = []
         for bucket in self.bucket_content:
-            if not bucket or len(bucket) == 0:
+            if bucket is None or len(bucket) == 0:
                 continue
             reminder = len(bucket) % self.batch_size
             bucket = np.array(bucket)
@@ -158,11 +199,10 @@ class AspectRatioDataset(RatioDataset):
         self.init_batches()
     
     def crop(self, entry: Entry, i: int) -> Entry:
-        assert self.to_ratio is not None, "to_ratio is not initialized"
+        assert self.to_bucket is not None, "to_bucket is not initialized"
         H, W = entry.pixel.shape[-2:]
         base_ratio = H / W
-        target_ratio = self.to_ratio[i]
-        h, w = self.ratio_to_bucket[target_ratio]
+        h, w = self.buckets_sizes[self.to_bucket[i]]
         if not entry.is_latent:
             resize_h, resize_w = self.fit_dimensions(base_ratio, h, w)
             interp = InterpolationMode.BILINEAR if resize_h < H else InterpolationMode.BICUBIC
@@ -203,17 +243,12 @@ class AspectRatioDataset(RatioDataset):
         self.ratio_to_bucket = {ratio: hw for ratio, hw in zip(self.bucket_ratios, self.buckets_sizes)}
 
     def assign_buckets(self):
-        img_res = np.array(self.store.raw_res)
+        img_res = np.array(self.store.raw_res).reshape(-1, 2)
         img_ratios = img_res[:, 0] / img_res[:, 1]
-        self.bucket_content = [[] for _ in range(len(self.buckets_sizes))]
-        self.to_ratio = {}
 
-        # Assign images to buckets
-        for idx, img_ratio in enumerate(img_ratios):
-            diff = np.abs(self.bucket_ratios - img_ratio)
-            bucket_idx = np.argmin(diff)
-            self.bucket_content[bucket_idx].append(idx)
-            self.to_ratio[idx] = self.bucket_ratios[bucket_idx]
+        # Assign images to buckets, to_bucket[idx] is the bucket index of image idx
+        self.to_bucket = nearest_ratio_index(img_ratios, self.bucket_ratios)
+        self.bucket_content = group_by_label(self.to_bucket, len(self.buckets_sizes))
 
 
 class AdaptiveSizeDataset(RatioDataset):
@@ -238,7 +273,7 @@ class AdaptiveSizeDataset(RatioDataset):
         self.init_batches()
     
     def crop(self, entry: Entry, i: int) -> Entry:
-        assert self.to_size is not None, "to_ratio is not initialized"
+        assert self.to_size is not None, "to_size is not initialized"
         H, W = entry.pixel.shape[-2:]
         h, w = self.to_size[i]
         bucket_width = w - w % self.divisible
@@ -268,24 +303,21 @@ class AdaptiveSizeDataset(RatioDataset):
         pass
     
     def assign_buckets(self):
-        img_res = np.array(self.store.raw_res)
-        self.to_size = {}
-        self.bucket_content = defaultdict(list)
-
-        # Assign images to buckets
-        for idx, (img_width, img_height) in enumerate(img_res):
-            img_area = img_width * img_height
-
-            # Check if the image needs to be resized (i.e., only allow downsizing)
-            if img_area > self.target_area:
-                scale_factor = math.sqrt(self.target_area / img_area)
-                img_width = math.floor(img_width * scale_factor / self.divisible) * self.divisible
-                img_height = math.floor(img_height * scale_factor / self.divisible) * self.divisible
-
-            bucket_width = img_width - img_width % self.divisible
-            bucket_height = img_height - img_height % self.divisible
-            reso = (bucket_width, bucket_height)
-            self.bucket_content[reso].append(idx)
-            self.to_size[idx] = (bucket_width, bucket_height)
-
-        self.bucket_content = [v for k, v in self.bucket_content.items()]
+        img_res = np.array(self.store.raw_res, dtype=np.int64).reshape(-1, 2)
+        img_width, img_height = img_res[:, 0], img_res[:, 1]
+        img_area = img_width * img_height
+
+        # Check if the image needs to be resized (i.e., only allow downsizing)
+        downsize = img_area > self.target_area
+        scale_factor = np.sqrt(self.target_area / img_area[downsize])
+        img_width[downsize] = np.floor(img_width[downsize] * scale_factor / self.divisible) * self.divisible
+        img_height[downsize] = np.floor(img_height[downsize] * scale_factor / self.divisible) * self.divisible
+
+        # Assign images to buckets, to_size[idx] is the bucket size of image idx
+        self.to_size = img_res - img_res % self.divisible
+
+        # buckets are kept in order of first appearance
+        sizes, first_idx, inverse = np.unique(self.to_size, axis=0, return_index=True, return_inverse=True)
+        rank = np.empty(len(sizes), dtype=np.int64)
+        rank[np.argsort(first_idx)] = np.arange(len(sizes))
+        self.bucket_content = group_by_label(rank[inverse.reshape(-1)], len(sizes))
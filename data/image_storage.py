@@ -13,6 +13,8 @@ from torch.utils.data import Dataset
 from typing import Callable, Generator, Optional  # type: ignore
 from torchvision import transforms
 from common.logging import logger
+from data.latent_pack import LatentPack
+from data.text_cache import T5EmbeddingCache, TextEmbeddingCache
 
 json_lib = json
 try:
@@ -95,11 +97,22 @@ class StoreBase(Dataset):
         self.raw_res: list[tuple[int, int]] = []
         self.curr_res: list[tuple[int, int]] = []
 
+        # precomputed text embeddings, read alongside the latents (see data/text_cache.py)
+        self.text_cache = None
+        if kwargs.get("text_cache_path"):
+            self.text_cache = TextEmbeddingCache(kwargs["text_cache_path"], key=kwargs.get("text_cache_key"))
+        self.t5_cache = None
+        if kwargs.get("t5_cache_path"):
+            self.t5_cache = T5EmbeddingCache(kwargs["t5_cache_path"], key=kwargs.get("t5_cache_key"))
+
         assert self.root_path.exists()
 
     def get_raw_entry(self, index) -> tuple[bool, np.ndarray, str, (int, int)]:
         raise NotImplementedError
 
+    def get_prompt(self, index) -> str:
+        raise NotImplementedError
+
     def fix_aspect_randomness(self, rng: np.random.Generator):
         raise NotImplementedError
     
@@ -156,7 +169,7 @@ class StoreBase(Dataset):
         original_sizes = torch.stack(original_sizes)
         crop_pos = torch.stack(crop_pos)
 
-        return {
+        batch = {
             "prompts": prompts,
             "pixels": pixel,
             "is_latent": is_latent,
@@ -165,6 +178,20 @@ class StoreBase(Dataset):
             "crop_coords_top_left": crop_pos,
             "extras": extras,
         }
+        if self.text_cache is not None:
+            cached = self.text_cache.lookup(prompts)
+            if cached is not None:
+                batch["cached_cond"] = {"key": self.text_cache.key, "outputs": cached}
+        if self.t5_cache is not None:
+            cached = self.t5_cache.lookup(prompts)
+            if cached is not None:
+                prompt_embeds, prompt_attention_mask = cached
+                batch["cached_t5"] = {
+                    "key": self.t5_cache.key,
+                    "prompt_embeds": prompt_embeds,
+                    "prompt_attention_mask": prompt_attention_mask,
+                }
+        return batch
 
     def __len__(self):
         return self.length
@@ -271,6 +298,9 @@ class LatentStore(StoreBase):
         for h5_path in self.h5_paths:
             self.h5_filehandles[h5_path] = h5.File(h5_path, "r", libver="latest")
 
+    def get_prompt(self, index) -> str:
+        return self.h5_keymap[self.keys[index]][1]["train_caption"]
+
     def get_raw_entry(self, index) -> tuple[bool, torch.tensor, str, (int, int)]:
         if len(self.h5_filehandles) == 0:
             self.setup_filehandles()
@@ -292,6 +322,45 @@ class LatentStore(StoreBase):
         return True, latent, prompt, original_size, dhdw, extras
 
 
+class PackedLatentStore(StoreBase):
+    """
+    LatentStore reading from .pack files (see scripts/pack_latents.py).
+    Latents are unscaled, stored contiguously per bucket and returned as views of a memory map.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pack_paths = sorted(dirwalk(self.root_path, lambda p: p.suffix == ".pack"))
+        assert pack_paths, f"No .pack files found in {self.root_path}"
+
+        self.packs = [LatentPack(p) for p in pack_paths]
+        self.keys = []
+        self.paths = []
+        for pack_idx, pack in enumerate(self.packs):
+            self.keys.extend((pack_idx, row) for row in range(len(pack)))
+            self.paths.extend(pack.paths)
+            self.raw_res.extend(map(tuple, pack.index[:, 2:4].tolist()))
+
+        self.length = len(self.keys)
+        logger.debug(f"Loaded {self.length} latent codes from {len(self.packs)} packs in {self.root_path}")
+
+        self.keys, self.raw_res, self.paths = self.repeat_entries(self.keys, self.raw_res, index=self.paths)
+        new_length = len(self.keys)
+        if new_length != self.length:
+            self.length = new_length
+            logger.debug(f"Using {self.length} entries after applied repeat strategy")
+
+    def get_prompt(self, index) -> str:
+        pack_idx, row = self.keys[index]
+        return self.packs[pack_idx].prompts[row]
+
+    def get_raw_entry(self, index) -> tuple[bool, torch.tensor, str, (int, int)]:
+        pack_idx, row = self.keys[index]
+        pack = self.packs[pack_idx]
+        latent = pack.get_latent(row).float()
+        extras = self.get_batch_extras(self.paths[index])
+        return True, latent, pack.prompts[row], pack.train_size(row), pack.dhdw(row), extras
+
+
 class DirectoryImageStore(StoreBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -344,6 +413,9 @@ class DirectoryImageStore(StoreBase):
             self.length = new_length
             logger.debug(f"Using {self.length} entries after applied repeat strategy")
 
+    def get_prompt(self, index) -> str:
+        return self.prompts[index]
+
     def get_raw_entry(self, index) -> tuple[bool, torch.tensor, str, (int, int)]:
         p = self.paths[index]
         prompt = self.prompts[index]
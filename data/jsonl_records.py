@@ -0,0 +1,102 @@
+import json
+import mmap
+import os
+import numpy as np
+
+from pathlib import Path
+from common.logging import logger
+
+
+def conversation_word_count(sample) -> int:
+    return sum(len(conv["value"].split()) for conv in sample.get("conversations", []))
+
+
+def build_jsonl_index(path, index_path):
+    """One pass over a jsonl file: byte offsets of the records plus the per-record stats used for length grouping."""
+    offsets, word_counts, has_image = [0], [], []
+    with open(path, "rb") as f:
+        for line in f:
+            if line.strip():
+                sample = json.loads(line)
+                word_counts.append(conversation_word_count(sample))
+                has_image.append("image" in sample)
+                offsets.append(offsets[-1] + len(line))
+            else:
+                # blank line, fold it into the previous record
+                offsets[-1] += len(line)
+
+    stat = os.stat(path)
+    tmp_path = f"{index_path}.{os.getpid()}.tmp.npz"
+    np.savez(
+        tmp_path,
+        offsets=np.asarray(offsets, dtype=np.int64),
+        word_counts=np.asarray(word_counts, dtype=np.int64),
+        has_image=np.asarray(has_image, dtype=bool),
+        source=np.asarray([stat.st_size, stat.st_mtime_ns], dtype=np.int64),
+    )
+    os.replace(tmp_path, index_path)
+
+
+def convert_json_to_jsonl(json_path, jsonl_path):
+    """Rewrite a json list of samples as jsonl (one sample per line) and index it."""
+    samples = json.loads(Path(json_path).read_text())
+    tmp_path = f"{jsonl_path}.tmp"
+    with open(tmp_path, "w") as f:
+        for sample in samples:
+            f.write(json.dumps(sample, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, jsonl_path)
+    build_jsonl_index(jsonl_path, JsonlRecords.index_path(jsonl_path))
+
+
+class JsonlRecords:
+    """
+    Read-only list-like view of a jsonl file.
+
+    Records are decoded on access from a memory map of the file, using a byte offset
+    index stored next to it (<path>.idx.npz, rebuilt when the file changes). Workers
+    share the file pages and the index arrays instead of holding a parsed copy of
+    every sample each.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        index_path = self.index_path(self.path)
+        if not self._is_fresh(index_path):
+            logger.info(f"Indexing {self.path}")
+            build_jsonl_index(self.path, index_path)
+
+        index = np.load(index_path)
+        self.offsets = index["offsets"]
+        self.word_counts = index["word_counts"]
+        self.has_image = index["has_image"]
+        self._mmap = None
+
+    @staticmethod
+    def index_path(path) -> Path:
+        return Path(f"{path}.idx.npz")
+
+    def _is_fresh(self, index_path) -> bool:
+        if not index_path.exists():
+            return False
+        stat = os.stat(self.path)
+        source = np.load(index_path)["source"]
+        return source[0] == stat.st_size and source[1] == stat.st_mtime_ns
+
+    def __getstate__(self):
+        # each worker maps the file on first access
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        return state
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if self._mmap is None:
+            with open(self.path, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return json.loads(self._mmap[self.offsets[i] : self.offsets[i + 1]])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,151 @@
+import json
+import mmap
+import os
+import struct
+import numpy as np
+import torch
+
+from pathlib import Path
+from typing import Callable
+
+# File layout (little endian):
+#   header        PACK_HEADER, fixed size
+#   buckets       one contiguous [n, c, h, w] array per latent shape, each aligned to PACK_ALIGN
+#   bucket table  int64 [num_buckets, len(BUCKET_FIELDS)]
+#   index         int64 [num_entries, len(INDEX_FIELDS)]
+#   meta          utf-8 json with keys, prompts and file paths
+PACK_MAGIC = b"NAIFULAT"
+PACK_VERSION = 1
+PACK_HEADER = struct.Struct("<8sIIQQQQQQ")
+PACK_ALIGN = 4096
+PACK_DTYPES = ["float32", "float16"]
+
+BUCKET_FIELDS = ("channels", "height", "width", "offset", "count")
+INDEX_FIELDS = ("bucket", "offset", "train_height", "train_width", "dh", "dw")
+
+
+def _align(f, alignment=PACK_ALIGN):
+    pos = f.tell()
+    pad = -pos % alignment
+    if pad:
+        f.write(b"\0" * pad)
+    return pos + pad
+
+
+def write_latent_pack(path, entries: list[dict], read_fn: Callable, dtype: str = "float32", progress=None):
+    """
+    Write a latent pack file.
+
+    entries: dicts with key, shape (c, h, w), prompt, file_path, train_height, train_width, dhdw
+    read_fn: entry -> unscaled latent array of entry["shape"]
+    """
+    assert dtype in PACK_DTYPES, f"dtype must be one of {PACK_DTYPES}"
+    np_dtype = np.dtype(dtype)
+    path = Path(path)
+    tmp_path = path.with_suffix(path.suffix + ".tmp")
+
+    # entries of the same shape are stored contiguously, buckets in order of first appearance.
+    # The index keeps the order of entries.
+    buckets = {}
+    for i, entry in enumerate(entries):
+        buckets.setdefault(tuple(entry["shape"]), []).append(i)
+
+    bucket_table = []
+    index = np.zeros((len(entries), len(INDEX_FIELDS)), dtype="<i8")
+    with open(tmp_path, "wb") as f:
+        f.write(b"\0" * PACK_HEADER.size)
+        for bucket_idx, (shape, rows) in enumerate(buckets.items()):
+            start = _align(f)
+            bucket_table.append((*shape, start, len(rows)))
+            nbytes = int(np.prod(shape)) * np_dtype.itemsize
+            for i, row in enumerate(rows):
+                entry = entries[row]
+                latent = np.ascontiguousarray(read_fn(entry), dtype=np_dtype)
+                assert latent.shape == shape, f"{entry['key']}: {latent.shape} != {shape}"
+                f.write(latent.tobytes())
+                dh, dw = entry.get("dhdw", (0, 0))
+                index[row] = (bucket_idx, start + i * nbytes, entry["train_height"], entry["train_width"], dh, dw)
+                if progress is not None:
+                    progress.update(1)
+
+        bucket_offset = _align(f, 8)
+        f.write(np.asarray(bucket_table, dtype="<i8").reshape(-1, len(BUCKET_FIELDS)).tobytes())
+        index_offset = f.tell()
+        f.write(index.tobytes())
+        meta_offset = f.tell()
+        meta = {
+            "keys": [e["key"] for e in entries],
+            "prompts": [e["prompt"] for e in entries],
+            "paths": [e["file_path"] for e in entries],
+        }
+        meta = json.dumps(meta).encode()
+        f.write(meta)
+
+        f.seek(0)
+        f.write(
+            PACK_HEADER.pack(
+                PACK_MAGIC,
+                PACK_VERSION,
+                PACK_DTYPES.index(dtype),
+                len(index),
+                len(bucket_table),
+                bucket_offset,
+                index_offset,
+                meta_offset,
+                len(meta),
+            )
+        )
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, path)
+
+
+class LatentPack:
+    """Read side of a latent pack, latents are returned as tensors viewing the memory map."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, "rb") as f:
+            header = f.read(PACK_HEADER.size)
+            magic, version, dtype, num_entries, num_buckets, bucket_offset, index_offset, meta_offset, meta_length = PACK_HEADER.unpack(header)
+            assert magic == PACK_MAGIC, f"{self.path} is not a latent pack"
+            assert version == PACK_VERSION, f"unsupported latent pack version {version}"
+
+            f.seek(bucket_offset)
+            self.buckets = np.frombuffer(f.read(num_buckets * len(BUCKET_FIELDS) * 8), dtype="<i8").reshape(num_buckets, -1)
+            f.seek(index_offset)
+            self.index = np.frombuffer(f.read(num_entries * len(INDEX_FIELDS) * 8), dtype="<i8").reshape(num_entries, -1)
+            f.seek(meta_offset)
+            meta = json.loads(f.read(meta_length))
+
+        self.dtype = getattr(torch, PACK_DTYPES[dtype])
+        self.keys, self.prompts, self.paths = meta["keys"], meta["prompts"], meta["paths"]
+        self.shapes = [tuple(int(x) for x in b[:3]) for b in self.buckets]
+        self.numels = [int(np.prod(s)) for s in self.shapes]
+        self._mmap = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # each worker maps the file on first access
+        state = self.__dict__.copy()
+        state["_mmap"] = None
+        return state
+
+    def get_latent(self, row) -> torch.Tensor:
+        if self._mmap is None:
+            with open(self.path, "rb") as f:
+                # copy-on-write mapping: writable for torch.frombuffer, pages stay shared
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        bucket, offset = self.index[row, 0], self.index[row, 1]
+        latent = torch.frombuffer(self._mmap, dtype=self.dtype, count=self.numels[bucket], offset=int(offset))
+        return latent.view(self.shapes[bucket])
+
+    def train_size(self, row) -> tuple[int, int]:
+        return int(self.index[row, 2]), int(self.index[row, 3])
+
+    def dhdw(self, row) -> tuple[int, int]:
+        return int(self.index[row, 4]), int(self.index[row, 5])
@@ -0,0 +1,103 @@
+import math
+import os
+import numpy as np
+import torch.distributed as dist
+
+from torch.utils.data.distributed import DistributedSampler
+
+
+def _default_replicas():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_world_size(), dist.get_rank()
+    return int(os.environ.get("WORLD_SIZE", 1)), int(os.environ.get("RANK", 0))
+
+
+class LengthGroupedSampler(DistributedSampler):
+    """
+    Distributed sampler that puts samples of similar length into the same step.
+
+    Every epoch the indices are shuffled and cut into megabatches of
+    num_replicas * batch_size * megabatch_mult samples. Each megabatch is sorted by
+    length and split into global batches, whose samples are dealt round-robin to the
+    ranks, so all ranks of a step get similar lengths. The order of the global batches
+    is shuffled again. With group_by_modality, lengths are signed (> 0 multimodal,
+    < 0 text only) and each modality is grouped on its own.
+
+    Yields this rank's indices; use with DataLoader(batch_size=batch_size). Being a
+    DistributedSampler, Fabric keeps it instead of injecting its own.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        batch_size: int,
+        lengths=None,
+        megabatch_mult: int = 50,
+        group_by_modality: bool = False,
+        num_replicas: int = None,
+        rank: int = None,
+        seed: int = 0,
+        drop_last: bool = False,
+    ):
+        default_replicas, default_rank = _default_replicas()
+        num_replicas = default_replicas if num_replicas is None else num_replicas
+        rank = default_rank if rank is None else rank
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=True, seed=seed, drop_last=drop_last)
+
+        self.lengths = np.asarray(dataset.lengths if lengths is None else lengths)
+        self.batch_size = batch_size
+        self.megabatch_mult = megabatch_mult
+        self.group_by_modality = group_by_modality
+
+        global_batch = self.num_replicas * self.batch_size
+        if self.drop_last:
+            num_batches = len(self.lengths) // global_batch
+        else:
+            num_batches = math.ceil(len(self.lengths) / global_batch)
+        self.num_samples = num_batches * self.batch_size
+        self.total_size = num_batches * global_batch
+
+    def _group(self, indices, rng):
+        """Split indices into global batches of similar length (the last one may be short)."""
+        global_batch = self.num_replicas * self.batch_size
+        megabatch = global_batch * self.megabatch_mult
+        indices = rng.permutation(indices)
+        batches = []
+        for i in range(0, len(indices), megabatch):
+            mb = indices[i : i + megabatch]
+            mb = mb[np.argsort(-np.abs(self.lengths[mb]), kind="stable")]
+            batches.extend(mb[j : j + global_batch] for j in range(0, len(mb), global_batch))
+        return batches
+
+    def global_batches(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        global_batch = self.num_replicas * self.batch_size
+        if self.group_by_modality:
+            groups = [np.flatnonzero(self.lengths > 0), np.flatnonzero(self.lengths <= 0)]
+        else:
+            groups = [np.arange(len(self.lengths))]
+
+        full, rest = [], []
+        for group in groups:
+            for batch in self._group(group, rng):
+                (full if len(batch) == global_batch else rest).append(batch)
+
+        # leftovers of each modality are mixed into the final batches
+        rest = np.concatenate(rest) if rest else np.zeros(0, dtype=np.int64)
+        rest = [rest[i : i + global_batch] for i in range(0, len(rest), global_batch)]
+        full.extend(b for b in rest if len(b) == global_batch)
+        order = rng.permutation(len(full))
+        batches = [full[i] for i in order] + [b for b in rest if len(b) < global_batch]
+
+        batches = batches[: self.total_size // global_batch]
+        if batches and len(batches[-1]) < global_batch:
+            # pad the last batch with samples from the start, like DistributedSampler
+            pad = np.resize(np.concatenate(batches), global_batch - len(batches[-1]))
+            batches[-1] = np.concatenate([batches[-1], pad])
+        return batches
+
+    def __iter__(self):
+        indices = []
+        for batch in self.global_batches():
+            indices.extend(batch[self.rank :: self.num_replicas].tolist())
+        return iter(indices)
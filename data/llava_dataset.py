@@ -1,6 +1,8 @@
 # copy from https://github.com/haotian-liu/LLaVA/blob/7440ec9ee37b0374c6b5548818e89878e38f3353/llava/train/train.py
 
 import copy
+import functools
+import numpy as np
 from models.llava.mm_utils import process_anyres_image, tokenizer_image_token
 from models.llava.constants import *
 from typing import Dict
@@ -15,9 +17,40 @@ from data.conversation import conv_templates
 from packaging import version
 import tokenizers
 from torch.nn.utils.rnn import pad_sequence
+from data.jsonl_records import JsonlRecords, conversation_word_count
+from data.length_sampler import LengthGroupedSampler
+from data.vision_feature_cache import open_vision_feature_cache, vision_feature_spec
 IS_TOKENIZER_GREATER_THAN_0_14 = version.parse(tokenizers.__version__) >= version.parse('0.14')
 
 
+def expand2square(pil_img, background_color):
+    width, height = pil_img.size
+    if width == height:
+        return pil_img
+    elif width > height:
+        result = Image.new(pil_img.mode, (width, width), background_color)
+        result.paste(pil_img, (0, (width - height) // 2))
+        return result
+    else:
+        result = Image.new(pil_img.mode, (height, height), background_color)
+        result.paste(pil_img, ((height - width) // 2, 0))
+        return result
+
+
+def load_image(image_file, image_folder, processor, image_aspect_ratio, image_grid_pinpoints=None):
+    """Open and preprocess an image as configured, returns the pixel values and the original (width, height)."""
+    image = Image.open(os.path.join(image_folder, image_file)).convert('RGB')
+    image_size = image.size
+    if image_aspect_ratio == 'pad':
+        image = expand2square(image, tuple(int(x*255) for x in processor.image_mean))
+        image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+    elif image_aspect_ratio == 'anyres':
+        image = process_anyres_image(image, processor, image_grid_pinpoints)
+    else:
+        image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
+    return image, image_size
+
+
 class LazySupervisedDataset(Dataset):
     """Dataset for supervised fine-tuning."""
 
@@ -34,7 +67,11 @@ class LazySupervisedDataset(Dataset):
         **kwargs
     ):
         super(LazySupervisedDataset, self).__init__()
-        list_data_dict = json.loads(open(data_path, "r").read())
+        if str(data_path).endswith(".jsonl"):
+            # decoded lazily from a memory map, see scripts/json_to_jsonl.py
+            list_data_dict = JsonlRecords(data_path)
+        else:
+            list_data_dict = json.loads(open(data_path, "r").read())
         self.default_conv = conv_templates[version] if version in conv_templates else conv_templates["vicuna_v1"]
         self.tokenizer = tokenizer
         self.mm_config = mm_config
@@ -46,63 +83,64 @@ class LazySupervisedDataset(Dataset):
         self.image_processor = image_processor
         self.is_multimodal = is_multimodel
         self.model_max_length = model_max_length
+        self.group_by_length = kwargs.get("group_by_length", False)
+        self.group_by_modality_length = kwargs.get("group_by_modality_length", False)
+
+        # precomputed vision tower outputs replace the images, see scripts/cache_vision_features.py
+        self.vision_features = None
+        if kwargs.get("vision_feature_cache"):
+            spec = vision_feature_spec(mm_config, image_folder)
+            self.vision_features = open_vision_feature_cache(kwargs["vision_feature_cache"], spec)
 
     def __len__(self):
         return len(self.list_data_dict)
 
-    @property
+    @functools.cached_property
+    def _word_counts(self):
+        # one pass over the json, shared by lengths and modality_lengths
+        if isinstance(self.list_data_dict, JsonlRecords):
+            return self.list_data_dict.word_counts, self.list_data_dict.has_image
+        word_counts = np.zeros(len(self.list_data_dict), dtype=np.int64)
+        has_image = np.zeros(len(self.list_data_dict), dtype=bool)
+        for i, sample in enumerate(self.list_data_dict):
+            word_counts[i] = conversation_word_count(sample)
+            has_image[i] = 'image' in sample
+        return word_counts, has_image
+
+    @functools.cached_property
     def lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            img_tokens = 128 if 'image' in sample else 0
-            length_list.append(sum(len(conv['value'].split()) for conv in sample['conversations']) + img_tokens)
-        return length_list
+        word_counts, has_image = self._word_counts
+        return (word_counts + 128 * has_image).tolist()
 
-    @property
+    @functools.cached_property
     def modality_lengths(self):
-        length_list = []
-        for sample in self.list_data_dict:
-            cur_len = sum(len(conv['value'].split()) for conv in sample['conversations'])
-            cur_len = cur_len if 'image' in sample else -cur_len
-            length_list.append(cur_len)
-        return length_list
+        word_counts, has_image = self._word_counts
+        return np.where(has_image, word_counts, -word_counts).tolist()
 
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
-        sources = self.list_data_dict[i]
-        if isinstance(i, int):
-            sources = [sources]
+        sample = self.list_data_dict[i]
+        sources = [sample] if isinstance(i, int) else sample
         assert len(sources) == 1, "Don't know why it is wrapped to a list"  # FIXME
         if 'image' in sources[0]:
-            image_file = self.list_data_dict[i]['image']
-            image_folder = self.image_folder
-            processor = self.image_processor
-            image = Image.open(os.path.join(image_folder, image_file)).convert('RGB')
-            image_size = image.size
-            if self.mm_config.image_aspect_ratio == 'pad':
-                def expand2square(pil_img, background_color):
-                    width, height = pil_img.size
-                    if width == height:
-                        return pil_img
-                    elif width > height:
-                        result = Image.new(pil_img.mode, (width, width), background_color)
-                        result.paste(pil_img, (0, (width - height) // 2))
-                        return result
-                    else:
-                        result = Image.new(pil_img.mode, (height, height), background_color)
-                        result.paste(pil_img, ((height - width) // 2, 0))
-                        return result
-                image = expand2square(image, tuple(int(x*255) for x in processor.image_mean))
-                image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
-            elif self.mm_config.image_aspect_ratio == 'anyres':
-                image = process_anyres_image(image, processor, self.mm_config.image_grid_pinpoints)
+            image_file = sources[0]['image']
+            if self.vision_features is not None:
+                image, image_size = self.vision_features[image_file]
+                if self.mm_config.image_aspect_ratio != 'anyres':
+                    image = image[0]
             else:
-                image = processor.preprocess(image, return_tensors='pt')['pixel_values'][0]
-                
+                image, image_size = load_image(
+                    image_file,
+                    self.image_folder,
+                    self.image_processor,
+                    self.mm_config.image_aspect_ratio,
+                    getattr(self.mm_config, "image_grid_pinpoints", None),
+                )
+
             sources = self.preprocess_multimodal(copy.deepcopy([e["conversations"] for e in sources]))
         else:
             sources = copy.deepcopy([e["conversations"] for e in sources])
             
-        data_dict = self.preprocess(sources, has_image=('image' in self.list_data_dict[i]))
+        data_dict = self.preprocess(sources, has_image=('image' in sample))
         if isinstance(i, int):
             data_dict = dict(
                 input_ids=data_dict["input_ids"][0],
@@ -110,9 +148,15 @@ class LazySupervisedDataset(Dataset):
             )
 
         # image exist in the data
-        if 'image' in self.list_data_dict[i]:
-            data_dict['image'] = image
+        image_key = 'image' if self.vision_features is None else 'image_features'
+        if 'image' in sample:
+            data_dict[image_key] = image
             data_dict['image_size'] = image_size
+        elif self.is_multimodal and self.vision_features is not None:
+            # placeholder features, text-only samples have no image token to put them at
+            crop_size = self.image_processor.crop_size
+            data_dict[image_key] = torch.zeros(self.vision_features.feature_shape, dtype=self.vision_features.dtype)
+            data_dict['image_size'] = (crop_size['height'], crop_size['width'])
         elif self.is_multimodal:
             # image does not exist in the data, but the model is multimodal
             crop_size = self.image_processor.crop_size
@@ -491,22 +535,30 @@ class LazySupervisedDataset(Dataset):
             attention_mask=input_ids.ne(self.tokenizer.pad_token_id),
         )
 
-        if 'image' in instances[0]:
-            images = [instance['image'] for instance in instances]
+        for key, batch_key in (('image', 'images'), ('image_features', 'image_features')):
+            if key not in instances[0]:
+                continue
+            images = [instance[key] for instance in instances]
             batch['image_sizes'] = [instance['image_size'] for instance in instances]
             
             if all(x is not None and x.shape == images[0].shape for x in images):
-                batch['images'] = torch.stack(images)
+                batch[batch_key] = torch.stack(images)
             else:
-                batch['images'] = images
+                batch[batch_key] = images
         return batch
                 
     def build_dataloader(self, batch_size: int, shuffle: bool = False):
+        sampler = None
+        if self.group_by_modality_length:
+            sampler = LengthGroupedSampler(self, batch_size, self.modality_lengths, group_by_modality=True)
+        elif self.group_by_length:
+            sampler = LengthGroupedSampler(self, batch_size, self.lengths)
         dataloader = torch.utils.data.DataLoader(
             self, 
             batch_size=batch_size, 
             num_workers=8,
-            shuffle=shuffle, 
+            shuffle=shuffle if sampler is None else False, 
+            sampler=sampler,
             collate_fn=self.padding_collate_fn
         )
         return dataloader
\ No newline at end of file
@@ -61,6 +61,8 @@ class PairedDataset(torch.utils.data.Dataset):
 
     def __getitem__(self, idx):
         example = self.dataset[idx]
+        # keys the per-sample noise and the precomputed reference losses
+        example["idx"] = idx
         return example
 
 
@@ -76,6 +78,7 @@ def collate_fn(examples):
         "crop_coords_top_left": torch.stack(crop_tup),
         "target_size_as_tuple": torch.stack(target_tup),
         "prompts": [e["prompts"] for e in examples],
+        "indices": torch.tensor([e["idx"] for e in examples]),
     }
     return return_d
 
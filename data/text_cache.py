@@ -0,0 +1,300 @@
+import atexit
+import hashlib
+import json
+import os
+import time
+import numpy as np
+import torch
+
+from pathlib import Path
+from common.logging import logger
+
+# embedder attributes that change the produced embeddings
+EMBEDDER_CONFIG_ATTRS = ("max_length", "layer", "layer_idx", "legacy", "return_pooled")
+
+
+def sha1sum(txt):
+    return hashlib.sha1(txt.encode()).hexdigest()
+
+
+def cacheable_embedders(conditioner) -> list[int]:
+    """Indices of the frozen prompt embedders of a GeneralConditioner, their outputs only depend on the prompt."""
+    return [
+        idx
+        for idx, embedder in enumerate(conditioner.embedders)
+        if not embedder.is_trainable and getattr(embedder, "input_key", None) == "prompts"
+    ]
+
+
+def text_cache_key(conditioner, tag: str = "") -> str:
+    """Identify the encoder config of the cacheable embedders, embeddings are only reused under the same key."""
+    spec = [tag]
+    for idx in cacheable_embedders(conditioner):
+        embedder = conditioner.embedders[idx]
+        attrs = {k: getattr(embedder, k, None) for k in EMBEDDER_CONFIG_ATTRS}
+        spec.append([idx, embedder.__class__.__name__, attrs])
+    return sha1sum(json.dumps(spec, sort_keys=True, default=str))[:16]
+
+
+class TextEmbeddingCache:
+    """
+    On-disk cache of the frozen text embedder outputs, keyed by sha1 of the prompt.
+
+    Layout: <path>/<key>/meta.json and one directory per shard holding keys.npy
+    plus one {embedder}.{output}.npy array per embedder output. Shards are written
+    once (renamed into place when complete) and read back memory-mapped, so the
+    cache can be filled offline, lazily by several training processes, and read by
+    dataloader workers at the same time.
+
+    New rows are buffered in host memory and written as a shard once flush_every rows
+    or flush_bytes bytes are pending, whichever comes first. The small default byte
+    limit bounds what every training rank holds (and loses if it dies before the
+    atexit flush); offline filling can raise it for fewer, larger shards.
+    """
+
+    def __init__(
+        self,
+        path,
+        key: str = None,
+        embedders: list[int] = None,
+        writable: bool = False,
+        flush_every: int = 4096,
+        flush_bytes: int = 64 << 20,
+        dtype: str = "float16",
+    ):
+        self.path = Path(path)
+        self.key = key
+        self.embedders = embedders
+        self.writable = writable
+        self.flush_every = flush_every
+        self.flush_bytes = flush_bytes
+        self.dtype = np.dtype(dtype)
+
+        self._index = None
+        self._shards = []
+        self._pending = {}
+        self._pending_bytes = 0
+        if writable:
+            assert key is not None and embedders is not None, "writable cache needs key and embedders"
+            self.root.mkdir(parents=True, exist_ok=True)
+            meta = {"key": key, "embedders": embedders, "dtype": self.dtype.name}
+            (self.root / "meta.json").write_text(json.dumps(meta))
+            atexit.register(self.flush)
+
+    @property
+    def root(self) -> Path:
+        return self.path / self.key
+
+    def __getstate__(self):
+        # memmaps and the index are reopened lazily in each worker
+        state = self.__dict__.copy()
+        state["_index"] = None
+        state["_shards"] = []
+        state["_pending"] = {}
+        state["_pending_bytes"] = 0
+        return state
+
+    def __len__(self):
+        self._load()
+        return len(self._index) + len(self._pending)
+
+    def _resolve_key(self) -> bool:
+        if self.key is not None:
+            return (self.root / "meta.json").exists()
+        candidates = sorted(self.path.glob("*/meta.json"), key=lambda p: p.stat().st_mtime)
+        if not candidates:
+            return False
+        if len(candidates) > 1:
+            logger.warning(f"Multiple text caches found in {self.path}, using the latest {candidates[-1].parent.name}")
+        self.key = candidates[-1].parent.name
+        return True
+
+    def _load(self):
+        if self._index is not None:
+            return
+        self._index = {}
+        if not self._resolve_key():
+            return
+        meta = json.loads((self.root / "meta.json").read_text())
+        self.embedders = meta["embedders"]
+        for shard in sorted(self.root.iterdir()):
+            if shard.is_dir() and not shard.name.startswith(".") and (shard / "keys.npy").exists():
+                self._add_shard(shard)
+
+    def _add_shard(self, shard: Path):
+        keys = np.load(shard / "keys.npy")
+        arrays = {}
+        for p in shard.glob("*.npy"):
+            if p.stem != "keys":
+                emb_idx, out_idx = map(int, p.stem.split("."))
+                arrays[(emb_idx, out_idx)] = np.load(p, mmap_mode="r")
+
+        shard_idx = len(self._shards)
+        self._shards.append(arrays)
+        for row, k in enumerate(keys.tolist()):
+            self._index.setdefault(k.decode(), (shard_idx, row))
+
+    def _get_row(self, hashkey):
+        if hashkey in self._pending:
+            return self._pending[hashkey]
+        shard_idx, row = self._index[hashkey]
+        return {k: arr[row] for k, arr in self._shards[shard_idx].items()}
+
+    def lookup(self, prompts: list[str]):
+        """
+        Return {embedder_idx: [output tensors]} stacked over the prompts, or None
+        unless every prompt is cached (a partial batch still needs the encoders).
+        """
+        self._load()
+        hashkeys = [sha1sum(p) for p in prompts]
+        if not all(k in self._index or k in self._pending for k in hashkeys):
+            return None
+
+        rows = [self._get_row(k) for k in hashkeys]
+        outputs = {}
+        for emb_idx, out_idx in sorted(rows[0].keys()):
+            arr = np.stack([r[(emb_idx, out_idx)] for r in rows])
+            outputs.setdefault(emb_idx, []).append(torch.from_numpy(arr).float())
+        return outputs
+
+    def add(self, prompts: list[str], outputs: dict):
+        """Buffer the raw embedder outputs collected by GeneralConditioner.forward."""
+        assert self.writable, "cache is opened read-only"
+        self._load()
+        for i, prompt in enumerate(prompts):
+            hashkey = sha1sum(prompt)
+            if hashkey in self._index or hashkey in self._pending:
+                continue
+            row = {}
+            for emb_idx in self.embedders:
+                emb_out = outputs[emb_idx]
+                if not isinstance(emb_out, (list, tuple)):
+                    emb_out = [emb_out]
+                for out_idx, emb in enumerate(emb_out):
+                    row[(emb_idx, out_idx)] = emb[i].detach().float().cpu().numpy().astype(self.dtype)
+            self._pending[hashkey] = row
+            self._pending_bytes += sum(arr.nbytes for arr in row.values())
+
+        if len(self._pending) >= self.flush_every or self._pending_bytes >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        name = f"{time.time_ns()}-{os.getpid()}"
+        tmp_dir = self.root / f".{name}"
+        tmp_dir.mkdir(parents=True)
+
+        hashkeys = list(self._pending.keys())
+        rows = [self._pending[k] for k in hashkeys]
+        for emb_idx, out_idx in rows[0].keys():
+            arr = np.stack([r[(emb_idx, out_idx)] for r in rows])
+            np.save(tmp_dir / f"{emb_idx}.{out_idx}.npy", arr)
+        np.save(tmp_dir / "keys.npy", np.array(hashkeys, dtype="S40"))
+
+        shard = self.root / name
+        os.rename(tmp_dir, shard)
+        self._pending = {}
+        self._pending_bytes = 0
+        self._add_shard(shard)
+        logger.debug(f"Wrote {len(hashkeys)} text embeddings to {shard}")
+
+
+def t5_cache_key(model_path, max_length: int) -> str:
+    return sha1sum(json.dumps(["t5", str(model_path), max_length]))[:16]
+
+
+class T5EmbeddingCache(TextEmbeddingCache):
+    """
+    TextEmbeddingCache for T5 last_hidden_state outputs (PixArt), keyed by sha1 of the prompt.
+
+    Only the real tokens of a prompt are stored: each shard holds keys.npy, an int64
+    offsets.npy and a flat [tokens, dim] embeds.npy. Lookups pad back to max_length
+    with zeros and rebuild the attention mask from the lengths; padded positions are
+    masked out of the cross attention, so the result matches the full encoder output.
+    """
+
+    def __init__(self, path, key: str = None, max_length: int = None, writable: bool = False, **kwargs):
+        super().__init__(path, key=key, embedders=[0], writable=writable, **kwargs)
+        self.max_length = max_length
+        if writable:
+            meta = {"key": key, "embedders": [0], "max_length": max_length, "dtype": self.dtype.name}
+            (self.root / "meta.json").write_text(json.dumps(meta))
+
+    def _load(self):
+        if self._index is not None:
+            return
+        super()._load()
+        if self.key is not None and (self.root / "meta.json").exists():
+            self.max_length = json.loads((self.root / "meta.json").read_text())["max_length"]
+
+    def _add_shard(self, shard: Path):
+        keys = np.load(shard / "keys.npy")
+        offsets = np.load(shard / "offsets.npy")
+        embeds = np.load(shard / "embeds.npy", mmap_mode="r")
+
+        shard_idx = len(self._shards)
+        self._shards.append((offsets, embeds))
+        for row, k in enumerate(keys.tolist()):
+            self._index.setdefault(k.decode(), (shard_idx, row))
+
+    def _get_row(self, hashkey):
+        if hashkey in self._pending:
+            return self._pending[hashkey]
+        shard_idx, row = self._index[hashkey]
+        offsets, embeds = self._shards[shard_idx]
+        return embeds[offsets[row] : offsets[row + 1]]
+
+    def lookup(self, prompts: list[str]):
+        """
+        Return (prompt_embeds [B, max_length, dim], attention_mask [B, max_length]) in the
+        storage dtype, or None unless every prompt is cached.
+        """
+        self._load()
+        hashkeys = [sha1sum(p) for p in prompts]
+        if not all(k in self._index or k in self._pending for k in hashkeys):
+            return None
+
+        rows = [self._get_row(k) for k in hashkeys]
+        prompt_embeds = np.zeros((len(rows), self.max_length, rows[0].shape[-1]), dtype=self.dtype)
+        attention_mask = np.zeros((len(rows), self.max_length), dtype=np.int64)
+        for i, row in enumerate(rows):
+            prompt_embeds[i, : len(row)] = row
+            attention_mask[i, : len(row)] = 1
+        return torch.from_numpy(prompt_embeds), torch.from_numpy(attention_mask)
+
+    def add(self, prompts: list[str], prompt_embeds, attention_mask):
+        assert self.writable, "cache is opened read-only"
+        self._load()
+        lengths = attention_mask.sum(dim=1).tolist()
+        for i, prompt in enumerate(prompts):
+            hashkey = sha1sum(prompt)
+            if hashkey in self._index or hashkey in self._pending:
+                continue
+            row = prompt_embeds[i, : lengths[i]].detach().float().cpu().numpy().astype(self.dtype)
+            self._pending[hashkey] = row
+            self._pending_bytes += row.nbytes
+
+        if len(self._pending) >= self.flush_every or self._pending_bytes >= self.flush_bytes:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        name = f"{time.time_ns()}-{os.getpid()}"
+        tmp_dir = self.root / f".{name}"
+        tmp_dir.mkdir(parents=True)
+
+        hashkeys = list(self._pending.keys())
+        rows = [self._pending[k] for k in hashkeys]
+        offsets = np.concatenate([[0], np.cumsum([len(r) for r in rows])]).astype(np.int64)
+        np.save(tmp_dir / "embeds.npy", np.concatenate(rows))
+        np.save(tmp_dir / "offsets.npy", offsets)
+        np.save(tmp_dir / "keys.npy", np.array(hashkeys, dtype="S40"))
+
+        shard = self.root / name
+        os.rename(tmp_dir, shard)
+        self._pending = {}
+        self._pending_bytes = 0
+        self._add_shard(shard)
+        logger.debug(f"Wrote {len(hashkeys)} T5 embeddings to {shard}")
@@ -1,15 +1,192 @@
+import bisect
+import functools
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pad_sequence
 from datasets import load_dataset
+from common.logging import logger
 from common.utils import get_class
+from data.length_sampler import LengthGroupedSampler
+from data.token_cache import open_token_cache, source_fingerprint
 from typing import Optional, Callable, Dict, Any
 
 def padding_collate_fn(batch):
     input_ids = pad_sequence([x['input_ids'] for x in batch], batch_first=True, padding_value=0)
     attention_mask = pad_sequence([x['attention_mask'] for x in batch], batch_first=True, padding_value=0)
     labels = pad_sequence([x['labels'] for x in batch], batch_first=True, padding_value=-100)
-    return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': labels}
+    return {'input_ids': input_ids.long(), 'attention_mask': attention_mask, 'labels': labels.long()}
+
+def packed_collate_fn(batch, attention="block_mask"):
+    """
+    Stack packed blocks. attention="block_mask" adds a [B, 1, L, L] boolean mask that is
+    causal within each example; attention="position_ids" instead adds cu_seqlens/max_seqlen
+    for varlen attention (flash_attention_2 also derives them from the position ids).
+    """
+    input_ids = torch.stack([x['input_ids'] for x in batch])
+    labels = torch.stack([x['labels'] for x in batch])
+    position_ids = torch.stack([x['position_ids'] for x in batch])
+    out = {'input_ids': input_ids, 'labels': labels, 'position_ids': position_ids}
+
+    block_len = input_ids.shape[1]
+    if attention == "block_mask":
+        seq_ids = torch.stack([
+            torch.repeat_interleave(torch.arange(len(x['seq_lens'])), x['seq_lens']) for x in batch
+        ])
+        causal = torch.ones(block_len, block_len, dtype=torch.bool).tril()
+        out['attention_mask'] = ((seq_ids[:, :, None] == seq_ids[:, None, :]) & causal)[:, None]
+    elif attention == "position_ids":
+        seq_lens = torch.cat([x['seq_lens'] for x in batch])
+        out['cu_seqlens'] = torch.nn.functional.pad(seq_lens.cumsum(0), (1, 0)).int()
+        out['max_seqlen'] = int(seq_lens.max())
+    else:
+        raise ValueError(f"Unknown packing attention {attention}")
+    return out
+
+def prepare_packed_inputs(batch, dtype, inverted=True, varlen=False):
+    """
+    Turn a (packed) batch into model kwargs: drop the varlen metadata unless the model takes
+    it (varlen=True), and convert a boolean block mask to dtype, as the additive (inverted)
+    mask HF models take for 4D attention masks, or as 1/0 for models that invert it
+    themselves (_prepare_4d_causal_attention_mask).
+    """
+    if not varlen:
+        batch = {k: v for k, v in batch.items() if k not in ('cu_seqlens', 'max_seqlen')}
+    attention_mask = batch.get('attention_mask')
+    if attention_mask is not None and attention_mask.dim() == 4 and attention_mask.dtype == torch.bool:
+        if inverted:
+            additive = torch.zeros(attention_mask.shape, dtype=dtype, device=attention_mask.device)
+            batch['attention_mask'] = additive.masked_fill_(~attention_mask, torch.finfo(dtype).min)
+        else:
+            batch['attention_mask'] = attention_mask.to(dtype)
+    return batch
+
+class PackedDataset(Dataset):
+    """
+    Packs the tokenized examples of a text dataset into blocks of pack_len tokens.
+
+    Examples are assigned to blocks best-fit-decreasing by length, so padding is only
+    needed at the end of a block. Each example keeps its own position ids and its
+    (prompt-masked) labels; its first label is ignored, so no token learns to predict
+    across an example boundary, same as the unpacked loss.
+
+    Blocks are planned from the exact token counts of the dataset's token cache
+    (dataset.lengths), so the dataset needs token_cache set.
+    """
+    def __init__(
+        self,
+        dataset: Dataset,
+        pack_len: int = 2048,
+        attention: str = "block_mask",
+        ignore_index: int = -100,
+        pad_token_id: int = 0,
+        seed: int = 0,
+        **kwargs,
+    ):
+        self.dataset = dataset
+        self.pack_len = pack_len
+        self.attention = attention
+        self.ignore_index = ignore_index
+        self.pad_token_id = pad_token_id
+        self.seed = seed
+
+        if getattr(dataset, "token_cache", None) is None:
+            raise ValueError(
+                "packing needs the exact token counts of a token cache, set dataset.token_cache "
+                "(see scripts/pretokenize.py)"
+            )
+        self.lengths = np.asarray(dataset.lengths)
+        self.packed_blocks = self.pack(np.minimum(self.lengths, pack_len), pack_len)
+        self.set_epoch(0)
+
+        self.efficiency = np.minimum(self.lengths, pack_len).sum() / max(len(self.blocks) * pack_len, 1)
+        logger.info(
+            f"Packed {len(self.lengths)} examples into {len(self.blocks)} blocks of {pack_len} tokens, "
+            f"packing efficiency {self.efficiency:.1%}"
+        )
+
+    def set_epoch(self, epoch):
+        # called by the trainer before each epoch; same seed on every rank, so the samplers still split one order
+        self.blocks = list(self.packed_blocks)
+        np.random.default_rng(self.seed + epoch).shuffle(self.blocks)
+
+    @staticmethod
+    def pack(lengths, capacity):
+        """Best-fit-decreasing bin packing, returns the example indices of each block."""
+        blocks = []
+        free_sizes = []  # sorted distinct free capacities of the open blocks
+        open_blocks = {}  # free capacity -> indices of blocks with that capacity
+        for idx in np.argsort(-lengths, kind="stable"):
+            length = int(lengths[idx])
+            pos = bisect.bisect_left(free_sizes, length)
+            if pos < len(free_sizes):
+                free = free_sizes[pos]
+                block = open_blocks[free].pop()
+                if not open_blocks[free]:
+                    del open_blocks[free]
+                    free_sizes.pop(pos)
+            else:
+                free = capacity
+                block = len(blocks)
+                blocks.append([])
+            blocks[block].append(int(idx))
+
+            free -= length
+            if free > 0:
+                if free not in open_blocks:
+                    open_blocks[free] = []
+                    bisect.insort(free_sizes, free)
+                open_blocks[free].append(block)
+        return blocks
+
+    def padding_efficiency(self, batch_size: int):
+        """Fraction of real tokens when batches of the unpacked dataset are padded to their longest example."""
+        lengths = self.lengths
+        padded = sum(len(lengths[i:i + batch_size]) * lengths[i:i + batch_size].max() for i in range(0, len(lengths), batch_size))
+        return lengths.sum() / max(padded, 1)
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __getitem__(self, idx):
+        input_ids, labels, position_ids, seq_lens = [], [], [], []
+        for example_idx in self.blocks[idx]:
+            example = self.dataset[example_idx]
+            ids = torch.as_tensor(example['input_ids'])[:self.pack_len]
+            lbl = torch.as_tensor(example['labels'])[:self.pack_len].clone()
+            lbl[0] = self.ignore_index
+            input_ids.append(ids)
+            labels.append(lbl)
+            position_ids.append(torch.arange(len(ids)))
+            seq_lens.append(len(ids))
+
+        pad = self.pack_len - sum(seq_lens)
+        if pad > 0:
+            # the padding forms its own sequence, attending only to itself
+            input_ids.append(torch.full((pad,), self.pad_token_id, dtype=torch.long))
+            labels.append(torch.full((pad,), self.ignore_index, dtype=torch.long))
+            position_ids.append(torch.arange(pad))
+            seq_lens.append(pad)
+
+        return {
+            'input_ids': torch.cat(input_ids).long(),
+            'labels': torch.cat(labels).long(),
+            'position_ids': torch.cat(position_ids),
+            'seq_lens': torch.tensor(seq_lens),
+        }
+
+    def build_dataloader(self, batch_size: int, shuffle: bool = False):
+        logger.info(
+            f"Packing efficiency {self.efficiency:.1%}, "
+            f"padded batches of {batch_size} would be {self.padding_efficiency(batch_size):.1%}"
+        )
+        dataloader = torch.utils.data.DataLoader(
+            self,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            collate_fn=functools.partial(packed_collate_fn, attention=self.attention)
+        )
+        return dataloader
 
 class SimpleTextDataset(Dataset):
     """A custom dataset that serves 1024-token blocks as input_ids == labels"""
@@ -22,21 +199,53 @@ class SimpleTextDataset(Dataset):
         eot_token_id = 50256, # gpt2
         **kwargs
     ):
-        self.data = load_dataset('text', data_files=dataset_path)
+        self.data = load_dataset('text', data_files=dataset_path)['train']
         self.dataset_path = dataset_path
         self.tokenizer = tokenizer
         self.eot_token_id = eot_token_id
         self.batch_size = batch_size
         self.block_len = block_len
-        self.data = self.data.shuffle()['train']
+        # shuffled through an index so cached tokens stay aligned with the lines
+        self.order = np.random.permutation(len(self.data))
 
-    def __getitem__(self, idx):
+        self.group_by_length = kwargs.get("group_by_length", False)
+        self.token_cache = None
+        if kwargs.get("token_cache"):
+            self.token_cache = open_token_cache(kwargs["token_cache"], self, kwargs.get("token_cache_workers"))
+
+    def cache_spec(self):
+        return {
+            "class": self.__class__.__name__,
+            "dataset_path": self.dataset_path,
+            "source": source_fingerprint(self.data),
+            "tokenizer": getattr(self.tokenizer, "name_or_path", str(self.tokenizer)),
+            "block_len": self.block_len,
+            "eot_token_id": self.eot_token_id,
+        }
+
+    @functools.cached_property
+    def lengths(self):
+        """Token counts from the token cache, else word counts, in sample order."""
+        if self.token_cache is not None:
+            return np.diff(self.token_cache.offsets)[self.order]
+        word_counts = np.array([len(line.split()) + 1 for line in self.data["text"]])
+        if self.block_len > 0:
+            word_counts = np.minimum(word_counts, self.block_len)
+        return word_counts[self.order]
+
+    def encode(self, idx):
         line = self.data[idx]["text"]
         input_ids = self.tokenizer.encode(line.strip())
         input_ids = input_ids[:self.block_len-1] if self.block_len > 0 else input_ids
         input_ids.append(self.eot_token_id)  # Ensure the end token is added
-                
-        input_ids = torch.tensor(input_ids, dtype=torch.long)
+        return {'input_ids': input_ids, 'labels': input_ids}
+
+    def __getitem__(self, idx):
+        idx = int(self.order[idx])
+        if self.token_cache is not None:
+            return self.token_cache[idx]
+
+        input_ids = torch.tensor(self.encode(idx)['input_ids'], dtype=torch.long)
         attention_mask = torch.ones(len(input_ids), dtype=torch.long)
         return {'input_ids': input_ids, 'attention_mask': attention_mask, 'labels': input_ids}
         
@@ -44,10 +253,12 @@ class SimpleTextDataset(Dataset):
         return len(self.data)
     
     def build_dataloader(self, batch_size: int, shuffle: bool = False):
+        sampler = LengthGroupedSampler(self, batch_size) if self.group_by_length else None
         dataloader = torch.utils.data.DataLoader(
             self, 
             batch_size=batch_size, 
-            shuffle=shuffle, 
+            shuffle=shuffle if sampler is None else False, 
+            sampler=sampler,
             collate_fn=padding_collate_fn
         )
         return dataloader
@@ -65,12 +276,44 @@ class TextDataset(Dataset):
         **kwargs,
     ):
         self.data = load_dataset(**dataset_args)
+        self.dataset_args = dataset_args
         self.tokenizer = tokenizer
         self.mask_prompt = mask_prompt
         self.ignore_index = ignore_index
         self.transform = transform
         self.cutoff_len = cutoff_len
         self.prompt_style = get_class(prompt_style["name"])(**prompt_style)
+        self.prompt_style_args = prompt_style
+
+        self.group_by_length = kwargs.get("group_by_length", False)
+        self.token_cache = None
+        if kwargs.get("token_cache"):
+            self.token_cache = open_token_cache(kwargs["token_cache"], self, kwargs.get("token_cache_workers"))
+
+    def cache_spec(self):
+        # note: a transform is not part of the key, use a new cache directory when changing it
+        return {
+            "class": self.__class__.__name__,
+            "dataset_args": dict(self.dataset_args),
+            "source": source_fingerprint(self.data),
+            "tokenizer": getattr(self.tokenizer, "name_or_path", str(self.tokenizer)),
+            "prompt_style": dict(self.prompt_style_args),
+            "mask_prompt": self.mask_prompt,
+            "cutoff_len": self.cutoff_len,
+        }
+
+    @functools.cached_property
+    def lengths(self):
+        """Token counts from the token cache, else word counts of prompt and response."""
+        if self.token_cache is not None:
+            return np.diff(self.token_cache.offsets)
+        word_counts = []
+        for example in self.data:
+            if self.transform is not None:
+                example = self.transform(example)
+            prompt, outputs = self.prompt_style.apply(example)
+            word_counts.append(len((prompt + outputs).split()))
+        return np.minimum(word_counts, self.cutoff_len)
         
     def tokenize(self, prompt: str, add_eos: bool = False):
         result = self.tokenizer(
@@ -92,10 +335,12 @@ class TextDataset(Dataset):
         return result
     
     def build_dataloader(self, batch_size: int, shuffle: bool = False):
+        sampler = LengthGroupedSampler(self, batch_size) if self.group_by_length else None
         dataloader = torch.utils.data.DataLoader(
             self, 
             batch_size=batch_size, 
-            shuffle=shuffle, 
+            shuffle=shuffle if sampler is None else False, 
+            sampler=sampler,
             collate_fn=padding_collate_fn
         )
         return dataloader
@@ -104,6 +349,15 @@ class TextDataset(Dataset):
         return len(self.data)
     
     def __getitem__(self, idx: int):
+        if self.token_cache is not None:
+            return self.token_cache[idx]
+
+        encoded = self.encode(idx)
+        for k in encoded.keys():
+            encoded[k] = torch.LongTensor(encoded[k])
+        return encoded
+
+    def encode(self, idx: int):
         example = self.data[idx]
         if self.transform is not None:
             example = self.transform(example)
@@ -119,10 +373,7 @@ class TextDataset(Dataset):
             encoded_prompt_and_response["labels"] = \
                 [-100] * prompt_len + encoded_prompt_and_response["labels"][prompt_len:]
 
-        for k in encoded_prompt_and_response.keys():
-            encoded_prompt_and_response[k] = torch.LongTensor(encoded_prompt_and_response[k])
-        
-        return encoded_prompt_and_response
+        return dict(encoded_prompt_and_response)
 
 # https://github.com/OpenAccess-AI-Collective/axolotl/raw/d485a083938e995979d1a566bb6a2f876075c667/src/axolotl/utils/chat_templates.py
 def build_chat_template(user_choice: str):
@@ -169,6 +420,34 @@ class ChatMLDataset(Dataset):
         self.cached_data_dict = {}
         self.cache_prompts = cache_prompts
         self.mask_inputs = mask_inputs
+        self.dataset_args = dataset_args
+
+        self.group_by_length = kwargs.get("group_by_length", False)
+        # the on-disk token cache replaces the per-worker cached_data_dict
+        self.token_cache = None
+        if kwargs.get("token_cache"):
+            self.token_cache = open_token_cache(kwargs["token_cache"], self, kwargs.get("token_cache_workers"))
+
+    def cache_spec(self):
+        return {
+            "class": self.__class__.__name__,
+            "dataset_args": dict(self.dataset_args),
+            "source": source_fingerprint(self.data),
+            "tokenizer": getattr(self.tokenizer, "name_or_path", str(self.tokenizer)),
+            "chat_template": getattr(self.tokenizer, "chat_template", None),
+            "max_seq_length": self.max_seq_length,
+            "mask_inputs": self.mask_inputs,
+        }
+
+    @functools.cached_property
+    def lengths(self):
+        """Token counts from the token cache, else word counts of the conversation."""
+        if self.token_cache is not None:
+            return np.diff(self.token_cache.offsets)
+        return np.array([sum(len(t["value"].split()) for t in example["conversations"]) for example in self.data])
+
+    def encode(self, i):
+        return self.preprocess([self.data[i]])
         
     def get_conversation_thread(self, prompt):
         conversations = prompt[0]["conversations"]
@@ -213,10 +492,12 @@ class ChatMLDataset(Dataset):
         )
 
     def build_dataloader(self, batch_size: int, shuffle: bool = False):
+        sampler = LengthGroupedSampler(self, batch_size) if self.group_by_length else None
         dataloader = torch.utils.data.DataLoader(
             self, 
             batch_size=batch_size, 
-            shuffle=shuffle, 
+            shuffle=shuffle if sampler is None else False, 
+            sampler=sampler,
             collate_fn=padding_collate_fn
         )
         return dataloader
@@ -225,6 +506,8 @@ class ChatMLDataset(Dataset):
         return len(self.data)
     
     def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        if self.token_cache is not None:
+            return self.token_cache[i]
         if i in self.cached_data_dict:
             return self.cached_data_dict[i]
 
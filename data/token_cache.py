@@ -0,0 +1,139 @@
+import json
+import multiprocessing
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from pathlib import Path
+from tqdm import tqdm
+from common.logging import logger
+from data.text_cache import sha1sum
+
+_worker_dataset = None
+
+
+def token_cache_key(spec: dict) -> str:
+    """Identify the tokenization settings of a dataset, cached tokens are only reused under the same key."""
+    return sha1sum(json.dumps(spec, sort_keys=True, default=str))[:16]
+
+
+def source_fingerprint(data):
+    """
+    Identify the loaded source data of a dataset: the fingerprint `datasets` derives from the
+    data files (mtime of local files, etag of remote ones, revision of hub datasets) and the split.
+    """
+    if hasattr(data, "_fingerprint"):
+        return data._fingerprint
+    if isinstance(data, dict):
+        return {split: source_fingerprint(d) for split, d in data.items()}
+    return None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _encode_chunk(indices):
+    lengths, tokens, labels = [], [], []
+    for idx in indices:
+        example = _worker_dataset.encode(idx)
+        input_ids = np.asarray(example["input_ids"], dtype=np.int32)
+        tokens.append(input_ids)
+        labels.append(np.asarray(example["labels"], dtype=np.int32))
+        lengths.append(len(input_ids))
+    return np.asarray(lengths, dtype=np.int64), np.concatenate(tokens), np.concatenate(labels)
+
+
+def build_token_cache(path, dataset, num_workers: int = None, chunk_size: int = 256):
+    """
+    Tokenize every example of dataset (through dataset.encode) on a process pool and write
+    flat int32 tokens.bin/labels.bin with an int64 offsets.npy index into path.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}-{os.getpid()}")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+
+    num_workers = num_workers or os.cpu_count()
+    chunks = [range(i, min(i + chunk_size, len(dataset))) for i in range(0, len(dataset), chunk_size)]
+    offsets = [np.zeros(1, dtype=np.int64)]
+    total = 0
+
+    ctx = multiprocessing.get_context("fork")
+    with open(tmp_path / "tokens.bin", "wb") as ft, open(tmp_path / "labels.bin", "wb") as fl:
+        with ctx.Pool(num_workers, initializer=_init_worker, initargs=(dataset,)) as pool:
+            results = pool.imap(_encode_chunk, chunks)
+            for lengths, tokens, labels in tqdm(results, total=len(chunks), desc="Tokenizing", ascii=True):
+                ft.write(tokens.tobytes())
+                fl.write(labels.tobytes())
+                offsets.append(total + np.cumsum(lengths))
+                total += int(lengths.sum())
+
+    np.save(tmp_path / "offsets.npy", np.concatenate(offsets))
+    (tmp_path / "meta.json").write_text(json.dumps({"num_examples": len(dataset), "num_tokens": total}))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished the same cache first
+        for p in tmp_path.iterdir():
+            p.unlink()
+        tmp_path.rmdir()
+    logger.info(f"Wrote {total} tokens of {len(dataset)} examples to {path}")
+
+
+class TokenCache:
+    """
+    Read side of a token cache: examples are slices of the memory-mapped token and label
+    arrays, so no tokenization happens and the pages are shared between dataloader workers.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.offsets = np.load(self.path / "offsets.npy")
+        self._tokens = None
+        self._labels = None
+
+    @staticmethod
+    def exists(path) -> bool:
+        return (Path(path) / "meta.json").exists()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getstate__(self):
+        # each worker maps the files on first access
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        state["_labels"] = None
+        return state
+
+    def __getitem__(self, idx):
+        if self._tokens is None:
+            # copy-on-write mapping: writable for torch.from_numpy, pages stay shared
+            self._tokens = np.memmap(self.path / "tokens.bin", dtype=np.int32, mode="c")
+            self._labels = np.memmap(self.path / "labels.bin", dtype=np.int32, mode="c")
+
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        # views of the mapping, widened to int64 when batches are collated
+        input_ids = torch.from_numpy(self._tokens[start:end])
+        labels = torch.from_numpy(self._labels[start:end])
+        return {
+            "input_ids": input_ids,
+            "labels": labels,
+            "attention_mask": torch.ones(end - start, dtype=torch.long),
+        }
+
+
+def open_token_cache(root, dataset, num_workers: int = None):
+    """
+    Open the cache of dataset under root, tokenizing the dataset first if it is not cached yet.
+    In distributed runs local rank 0 builds the cache while the other ranks wait at a barrier.
+    """
+    path = Path(root) / token_cache_key(dataset.cache_spec())
+    if int(os.environ.get("LOCAL_RANK", 0)) == 0 and not TokenCache.exists(path):
+        logger.info(f"Building token cache {path}")
+        build_token_cache(path, dataset, num_workers)
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+    return TokenCache(path)
@@ -0,0 +1,157 @@
+import json
+import os
+import numpy as np
+import torch
+
+from pathlib import Path
+from tqdm import tqdm
+from common.logging import logger
+from data.text_cache import sha1sum
+
+# numpy has no bfloat16, those features are stored as their raw 16 bit patterns
+_STORAGE_DTYPES = {
+    "float32": np.float32,
+    "float16": np.float16,
+    "bfloat16": np.int16,
+}
+
+
+def vision_feature_spec(mm_config, image_folder) -> dict:
+    """Settings that determine the vision tower output of an image, cached features are only reused under the same spec."""
+    spec = {
+        "vision_tower": mm_config.mm_vision_tower,
+        "select_layer": mm_config.mm_vision_select_layer,
+        "select_feature": mm_config.get("mm_vision_select_feature", "patch"),
+        "image_aspect_ratio": mm_config.get("image_aspect_ratio", "square"),
+        "image_folder": str(Path(image_folder).resolve()),
+    }
+    if spec["image_aspect_ratio"] == "anyres":
+        spec["image_grid_pinpoints"] = [list(p) for p in mm_config.image_grid_pinpoints]
+    return spec
+
+
+def vision_feature_key(spec: dict) -> str:
+    return sha1sum(json.dumps(spec, sort_keys=True, default=str))[:16]
+
+
+class _ImageFiles(torch.utils.data.Dataset):
+    def __init__(self, image_files, load_image):
+        self.image_files = image_files
+        self.load_image = load_image
+
+    def __len__(self):
+        return len(self.image_files)
+
+    def __getitem__(self, idx):
+        image, image_size = self.load_image(self.image_files[idx])
+        # [crops, 3, h, w], a single crop unless anyres
+        return image if image.ndim == 4 else image[None], image_size
+
+
+def _collate_crops(batch):
+    return [image for image, _ in batch], [image_size for _, image_size in batch]
+
+
+def build_vision_feature_cache(
+    path, image_files, load_image, vision_tower, batch_size: int = 32, num_workers: int = 8
+):
+    """
+    Run the (frozen) vision tower over every image and write the selected features as one
+    flat features.bin of [crops, patches, dim] rows, with an int64 offsets.npy giving the
+    crops of each image, sizes.npy with the original (width, height) and images.json with
+    the image paths in row order.
+
+    load_image maps an image path to its preprocessed pixel values and size, the same way
+    the dataset would load it.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}-{os.getpid()}")
+    tmp_path.mkdir(parents=True, exist_ok=True)
+
+    param = next(vision_tower.parameters())
+    dataloader = torch.utils.data.DataLoader(
+        _ImageFiles(image_files, load_image),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=_collate_crops,
+    )
+    offsets, sizes = [0], []
+    feature_shape, dtype = None, None
+    with open(tmp_path / "features.bin", "wb") as f:
+        for images, image_sizes in tqdm(dataloader, desc="Encoding images", ascii=True):
+            counts = [image.shape[0] for image in images]
+            pixel_values = torch.cat(images).to(param.device, param.dtype)
+            features = vision_tower(pixel_values).cpu().contiguous()
+            feature_shape, dtype = list(features.shape[1:]), str(features.dtype).removeprefix("torch.")
+            raw = features.view(torch.int16) if features.dtype == torch.bfloat16 else features
+            f.write(raw.numpy().tobytes())
+            offsets.extend(offsets[-1] + np.cumsum(counts))
+            sizes.extend(image_sizes)
+
+    np.save(tmp_path / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    np.save(tmp_path / "sizes.npy", np.asarray(sizes, dtype=np.int64).reshape(-1, 2))
+    (tmp_path / "images.json").write_text(json.dumps(list(image_files)))
+    meta = {"num_images": len(image_files), "num_crops": int(offsets[-1]), "feature_shape": feature_shape, "dtype": dtype}
+    (tmp_path / "meta.json").write_text(json.dumps(meta))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process finished the same cache first
+        for p in tmp_path.iterdir():
+            p.unlink()
+        tmp_path.rmdir()
+    logger.info(f"Wrote features of {len(image_files)} images ({offsets[-1]} crops) to {path}")
+
+
+class VisionFeatureCache:
+    """
+    Read side of a vision feature cache: features of an image are a slice of the memory-mapped
+    feature array, so neither the image decode nor the vision tower forward happens in training.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        meta = json.loads((self.path / "meta.json").read_text())
+        self.feature_shape = tuple(meta["feature_shape"])
+        self.dtype = getattr(torch, meta["dtype"])
+        self._storage_dtype = _STORAGE_DTYPES[meta["dtype"]]
+        self.offsets = np.load(self.path / "offsets.npy")
+        self.sizes = np.load(self.path / "sizes.npy")
+        images = json.loads((self.path / "images.json").read_text())
+        self.rows = {image_file: i for i, image_file in enumerate(images)}
+        self._features = None
+
+    @staticmethod
+    def exists(path) -> bool:
+        return (Path(path) / "meta.json").exists()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, image_file):
+        return image_file in self.rows
+
+    def __getstate__(self):
+        # each worker maps the file on first access
+        state = self.__dict__.copy()
+        state["_features"] = None
+        return state
+
+    def __getitem__(self, image_file):
+        """Returns the [crops, patches, dim] features and the (width, height) of an image."""
+        if self._features is None:
+            # copy-on-write mapping: writable for torch.from_numpy, pages stay shared
+            features = np.memmap(self.path / "features.bin", dtype=self._storage_dtype, mode="c")
+            self._features = features.reshape(-1, *self.feature_shape)
+
+        row = self.rows[image_file]
+        start, end = self.offsets[row], self.offsets[row + 1]
+        features = torch.from_numpy(self._features[start:end]).view(self.dtype)
+        return features, tuple(self.sizes[row].tolist())
+
+
+def open_vision_feature_cache(root, spec: dict):
+    path = Path(root) / vision_feature_key(spec)
+    if not VisionFeatureCache.exists(path):
+        raise FileNotFoundError(f"No vision feature cache at {path}, build it with scripts/cache_vision_features.py")
+    return VisionFeatureCache(path)
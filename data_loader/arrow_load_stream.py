@@ -35,6 +35,10 @@ class TextImageArrowStream(Dataset):
                  uncond_p_t5=0.0,
                  rank=0,
                  dtype=torch.float32,
+                 table_cache_size=1,
+                 table_cache_bytes=None,
+                 locality=0,
+                 seed=0,
                  **kwarges
                  ):
         self.args = args
@@ -50,6 +54,11 @@ class TextImageArrowStream(Dataset):
         self.multireso = multireso
         self.batch_size = batch_size
         self.world_size = world_size
+        # arrow files kept mapped per index, and the locality-aware reshuffle of every epoch (0: keep the index order)
+        self.table_cache_size = table_cache_size
+        self.table_cache_bytes = table_cache_bytes
+        self.locality = locality
+        self.seed = seed
         self.index_manager = self.load_index()
 
         # clip params
@@ -96,22 +105,31 @@ class TextImageArrowStream(Dataset):
                 if len(index_file) > 1:
                     raise ValueError(f"When enabling multireso, index_file should be a single file, but got {index_file}")
                 index_file = index_file[0]
-            index_manager = MultiResolutionBucketIndexV2(index_file, batch_size, world_size)
+            index_manager = MultiResolutionBucketIndexV2(index_file, batch_size, world_size,
+                                                         table_cache_size=self.table_cache_size,
+                                                         table_cache_bytes=self.table_cache_bytes)
             self.log_fn(f"Using MultiResolutionBucketIndexV2: {len(index_manager):,}")
         else:
             if isinstance(index_file, str):
                 index_file = [index_file]
             if len(index_file) == 1:
-                index_manager = ArrowIndexV2(index_file[0])
+                index_manager = ArrowIndexV2(index_file[0], table_cache_size=self.table_cache_size,
+                                             table_cache_bytes=self.table_cache_bytes)
                 self.log_fn(f"Using ArrowIndexV2: {len(index_manager):,}")
             else:
-                index_manager = MultiIndexV2(index_file)
+                index_manager = MultiIndexV2(index_file, table_cache_size=self.table_cache_size,
+                                             table_cache_bytes=self.table_cache_bytes)
                 self.log_fn(f"Using MultiIndexV2: {len(index_manager):,}")
 
         return index_manager
 
-    def shuffle(self, seed, fast=False):
-        self.index_manager.shuffle(seed, fast=fast)
+    def shuffle(self, seed, fast=False, locality=0):
+        self.index_manager.shuffle(seed, fast=fast, locality=locality)
+
+    def set_epoch(self, epoch):
+        # called by the trainer before each epoch; same seed on every rank, so the samplers still split one order
+        if self.locality > 0:
+            self.shuffle(self.seed + epoch, locality=self.locality)
 
     def get_raw_image(self, index, image_key="image"):
         try:
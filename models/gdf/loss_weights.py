@@ -86,16 +86,39 @@ class SigmoidLossWeight(BaseLossWeight):
     def weight(self, logSNR):
         return (logSNR * self.s).sigmoid()
 
-class AdaptiveLossWeight(BaseLossWeight):
-    def __init__(self, logsnr_range=[-10, 10], buckets=300, weight_range=[1e-7, 1e7]):
-        self.bucket_ranges = torch.linspace(logsnr_range[0], logsnr_range[1], buckets-1)
-        self.bucket_losses = torch.ones(buckets)
+class AdaptiveLossWeight(BaseLossWeight, torch.nn.Module):
+    # buckets are buffers: moved to the training device once, saved with state_dict()
+    def __init__(self, logsnr_range=[-10, 10], buckets=300, weight_range=[1e-7, 1e7], sync_every=100):
+        torch.nn.Module.__init__(self)
+        self.register_buffer("bucket_ranges", torch.linspace(logsnr_range[0], logsnr_range[1], buckets-1))
+        self.register_buffer("bucket_losses", torch.ones(buckets))
         self.weight_range = weight_range
+        self.sync_every = sync_every
+        self.updates = 0
 
     def weight(self, logSNR):
-        indices = torch.searchsorted(self.bucket_ranges.to(logSNR.device), logSNR)
-        return (1/self.bucket_losses.to(logSNR.device)[indices]).clamp(*self.weight_range)
+        if self.bucket_losses.device != logSNR.device:
+            self.to(logSNR.device)
+        indices = torch.searchsorted(self.bucket_ranges, logSNR)
+        return (1/self.bucket_losses[indices]).clamp(*self.weight_range)
 
+    @torch.no_grad()
     def update_buckets(self, logSNR, loss, beta=0.99):
-        indices = torch.searchsorted(self.bucket_ranges.to(logSNR.device), logSNR).cpu()
-        self.bucket_losses[indices] = self.bucket_losses[indices]*beta + loss.detach().cpu() * (1-beta)
+        if self.bucket_losses.device != logSNR.device:
+            self.to(logSNR.device)
+        indices = torch.searchsorted(self.bucket_ranges, logSNR)
+        # one EMA step per bucket hit in this batch, towards the mean loss of its samples
+        batch_losses = self.bucket_losses.scatter_reduce(0, indices, loss.detach().float(), reduce="mean", include_self=False)
+        hit = torch.bincount(indices, minlength=len(self.bucket_losses)) > 0
+        self.bucket_losses.copy_(torch.where(hit, self.bucket_losses*beta + batch_losses*(1-beta), self.bucket_losses))
+
+        self.updates += 1
+        if self.updates % self.sync_every == 0:
+            self.sync()
+
+    @torch.no_grad()
+    def sync(self):
+        # average the buckets over the ranks, so all of them weight the loss the same way
+        if torch.distributed.is_available() and torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1:
+            torch.distributed.all_reduce(self.bucket_losses)
+            self.bucket_losses /= torch.distributed.get_world_size()
@@ -1,5 +1,6 @@
 """k-diffusion transformer diffusion models, version 2."""
 
+from collections import OrderedDict
 from dataclasses import dataclass
 from functools import lru_cache, reduce
 import math
@@ -31,6 +32,10 @@ if flags.get_use_compile():
     torch._dynamo.config.suppress_errors = True
 
 
+# Number of resolutions whose position grids and window masks are kept around
+POS_CACHE_SIZE = 32
+
+
 # Helpers
 
 def zero_init(layer):
@@ -53,6 +58,22 @@ def downscale_pos(pos):
     return torch.mean(pos, dim=-2)
 
 
+# cached tensors are built outside of inference mode, a sampling pass may fill the caches for training
+
+@lru_cache(maxsize=POS_CACHE_SIZE)
+@torch.inference_mode(False)
+def make_pos_pyramid(h, w, n_levels, device=None):
+    """Axial positions of every level of the hourglass, finest first."""
+    pos = make_axial_pos(h, w, device=device).view(h, w, 2)
+    poses = [pos]
+    for _ in range(n_levels - 1):
+        poses.append(downscale_pos(poses[-1]))
+    for level, pos in enumerate(poses):
+        # identifies the grid for the theta cache of AxialRoPE
+        pos._pos_key = (h, w, level, pos.device)
+    return tuple(poses)
+
+
 # Param tags
 
 def tag_param(param, tag):
@@ -221,6 +242,11 @@ def apply_rotary_emb_(x, theta):
     return ApplyRotaryEmbeddingInplace.apply(x, theta, False)
 
 
+# theta tables of the make_pos_pyramid grids, shared by all blocks with the same head layout
+# (freqs is a fixed function of dim and n_heads), least recently used entries are dropped
+_theta_cache = OrderedDict()
+
+
 class AxialRoPE(nn.Module):
     def __init__(self, dim, n_heads):
         super().__init__()
@@ -232,11 +258,28 @@ class AxialRoPE(nn.Module):
     def extra_repr(self):
         return f"dim={self.freqs.shape[1] * 4}, n_heads={self.freqs.shape[0]}"
 
-    def forward(self, pos):
+    def make_theta(self, pos):
         theta_h = pos[..., None, 0:1] * self.freqs.to(pos.dtype)
         theta_w = pos[..., None, 1:2] * self.freqs.to(pos.dtype)
         return torch.cat((theta_h, theta_w), dim=-1)
 
+    def forward(self, pos, dtype=None):
+        """Theta of pos computed in dtype (default pos.dtype), cached for the make_pos_pyramid grids."""
+        dtype = pos.dtype if dtype is None else dtype
+        if torch.compiler.is_compiling() or pos.requires_grad or not hasattr(pos, "_pos_key"):
+            return self.make_theta(pos.to(dtype))
+        key = (pos._pos_key, tuple(self.freqs.shape), self.freqs.device, dtype)
+        theta = _theta_cache.get(key)
+        if theta is None:
+            with torch.inference_mode(False):
+                theta = self.make_theta(pos.to(dtype))
+            _theta_cache[key] = theta
+            if len(_theta_cache) > POS_CACHE_SIZE * 8:
+                _theta_cache.popitem(last=False)
+        else:
+            _theta_cache.move_to_end(key)
+        return theta
+
 
 # Shifted window attention
 
@@ -272,7 +315,8 @@ def shifted_unwindow(window_shift, x):
     return x
 
 
-@lru_cache
+@lru_cache(maxsize=POS_CACHE_SIZE * 4)
+@torch.inference_mode(False)
 def make_shifted_window_masks(n_h_w, n_w_w, w_h, w_w, shift, device=None):
     ph_coords = torch.arange(n_h_w, device=device)
     pw_coords = torch.arange(n_w_w, device=device)
@@ -303,7 +347,7 @@ def make_shifted_window_masks(n_h_w, n_w_w, w_h, w_w, shift, device=None):
     m_top = ~is_left_patch & is_top_patch & (q_above_shift == k_above_shift)
     m_rest = ~is_left_patch & ~is_top_patch
     m = m_corner | m_left | m_top | m_rest
-    return m
+    return torch.reshape(m, (n_h_w, n_w_w, w_h * w_w, w_h * w_w))
 
 
 def apply_window_attention(window_size, window_shift, q, k, v, scale=None):
@@ -316,7 +360,6 @@ def apply_window_attention(window_size, window_shift, q, k, v, scale=None):
     q_seqs = torch.reshape(q_windows, (b, heads, h, w, wh * ww, d_head))
     k_seqs = torch.reshape(k_windows, (b, heads, h, w, wh * ww, d_head))
     v_seqs = torch.reshape(v_windows, (b, heads, h, w, wh * ww, d_head))
-    mask = torch.reshape(mask, (h, w, wh * ww, wh * ww))
 
     # do the attention here
     flops.op(flops.op_attention, q_seqs.shape, k_seqs.shape, v_seqs.shape)
@@ -361,8 +404,8 @@ class SelfAttentionBlock(nn.Module):
         skip = x
         x = self.norm(x, cond)
         qkv = self.qkv_proj(x)
-        pos = rearrange(pos, "... h w e -> ... (h w) e").to(qkv.dtype)
-        theta = self.pos_emb(pos)
+        theta = self.pos_emb(pos, dtype=qkv.dtype)
+        theta = rearrange(theta, "... h w nh e -> ... (h w) nh e")
         if use_flash_2(qkv):
             qkv = rearrange(qkv, "n h w (t nh e) -> n (h w) t nh e", t=3, e=self.d_head)
             qkv = scale_for_cosine_sim_qkv(qkv, self.scale, 1e-6)
@@ -647,7 +690,9 @@ class MappingSpec:
 class ImageTransformerDenoiserModelV2(nn.Module):
     def __init__(self, levels, mapping, in_channels, out_channels, patch_size, num_classes=0, mapping_cond_dim=0):
         super().__init__()
+        self.in_channels = in_channels
         self.num_classes = num_classes
+        self.mapping_cond_dim = mapping_cond_dim
 
         self.patch_in = TokenMerge(in_channels, levels[0].width, patch_size)
 
@@ -703,7 +748,7 @@ class ImageTransformerDenoiserModelV2(nn.Module):
         x = x.movedim(-3, -1)
         x = self.patch_in(x)
         # TODO: pixel aspect ratio for nonsquare patches
-        pos = make_axial_pos(x.shape[-3], x.shape[-2], device=x.device).view(x.shape[-3], x.shape[-2], 2)
+        poses = make_pos_pyramid(x.shape[-3], x.shape[-2], len(self.merges) + 1, device=x.device)
 
         # Mapping network
         if class_cond is None and self.class_emb is not None:
@@ -720,15 +765,13 @@ class ImageTransformerDenoiserModelV2(nn.Module):
         cond = self.mapping(time_emb + aug_emb + class_emb + mapping_emb)
 
         # Hourglass transformer
-        skips, poses = [], []
-        for down_level, merge in zip(self.down_levels, self.merges):
+        skips = []
+        for down_level, merge, pos in zip(self.down_levels, self.merges, poses):
             x = down_level(x, pos, cond)
             skips.append(x)
-            poses.append(pos)
             x = merge(x)
-            pos = downscale_pos(pos)
 
-        x = self.mid_level(x, pos, cond)
+        x = self.mid_level(x, poses[-1], cond)
 
         for up_level, split, skip, pos in reversed(list(zip(self.up_levels, self.splits, skips, poses))):
             x = split(x, skip)
@@ -739,4 +782,38 @@ class ImageTransformerDenoiserModelV2(nn.Module):
         x = self.patch_out(x)
         x = x.movedim(-1, -3)
 
-        return x
\ No newline at end of file
+        return x
+
+    def levels(self):
+        return [*self.down_levels, self.mid_level, *self.up_levels]
+
+    def compile_levels(self, **kwargs):
+        """torch.compile each level, the rest of the model (patching, mapping) stays eager."""
+        for level in self.levels():
+            level.compile(**kwargs)
+
+    def precompile(self, resolutions, batch_size=1, dtype=None, backward=True):
+        """
+        Run a dummy step at each (height, width) so the compiled graphs, position tables and window
+        masks of every bucket resolution exist before training starts, instead of stalling the first
+        step that hits a new aspect ratio. Call after compile_levels and after moving the model.
+        """
+        resolutions = sorted(set((int(h), int(w)) for h, w in resolutions))
+        n_graphs = len(self.levels()) * len(resolutions)
+        torch._dynamo.config.cache_size_limit = max(n_graphs, torch._dynamo.config.cache_size_limit)
+        torch._dynamo.config.accumulated_cache_size_limit = max(
+            n_graphs, torch._dynamo.config.accumulated_cache_size_limit
+        )
+        param = next(self.parameters())
+        device, dtype = param.device, dtype or param.dtype
+        for h, w in resolutions:
+            x = torch.zeros(batch_size, self.in_channels, h, w, device=device, dtype=dtype)
+            sigma = torch.ones(batch_size, device=device, dtype=dtype)
+            class_cond = torch.zeros(batch_size, dtype=torch.long, device=device) if self.num_classes else None
+            mapping_cond = x.new_zeros(batch_size, self.mapping_cond_dim) if self.mapping_cond_dim else None
+            with torch.set_grad_enabled(backward), torch.autocast(device.type, dtype, enabled=dtype != param.dtype):
+                out = self(x, sigma, class_cond=class_cond, mapping_cond=mapping_cond)
+            if backward:
+                out.float().sum().backward()
+        if backward:
+            self.zero_grad(set_to_none=True)
\ No newline at end of file
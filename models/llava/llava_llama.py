@@ -136,23 +136,32 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM):
     
     def get_vision_tower(self):
         return self.model.vision_tower
+
+    def encode_images(self, images, precomputed=False):
+        # precomputed: images already are vision tower features, only the projector runs
+        image_features = images if precomputed else self.model.vision_tower(images)
+        return self.model.mm_projector(image_features)
             
     def prepare_inputs(
         self, input_ids, position_ids, attention_mask, past_key_values, labels,
-        images, image_sizes=None
+        images, image_sizes=None, image_features=None
     ):
         vision_tower = self.model.vision_tower
+        precomputed = image_features is not None
+        if precomputed:
+            images = image_features
         if vision_tower is None or images is None or input_ids.shape[1] == 1:
             return input_ids, position_ids, attention_mask, past_key_values, None, labels
 
-        if type(images) is list or images.ndim == 5:
+        # a crop is [3, h, w] as pixels and [patches, dim] as precomputed features
+        crop_ndim = 2 if precomputed else 3
+        if type(images) is list or images.ndim == crop_ndim + 2:
             if type(images) is list:
-                images = [x.unsqueeze(0) if x.ndim == 3 else x for x in images]
+                images = [x.unsqueeze(0) if x.ndim == crop_ndim else x for x in images]
 
             # Concatenate all images along the first dimension and encode them
             concat_images = torch.cat([image for image in images], dim=0)
-            image_features = self.model.vision_tower(concat_images)
-            image_features = self.model.mm_projector(image_features)
+            image_features = self.encode_images(concat_images, precomputed)
             
             split_sizes = [image.shape[0] for image in images]
             image_features = torch.split(image_features, split_sizes, dim=0)
@@ -209,7 +218,7 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM):
             else:
                 raise ValueError(f"Unexpected mm_patch_merge_type: {self.config.mm_patch_merge_type}")
         else:
-            image_features = self.encode_images(images)
+            image_features = self.encode_images(images, precomputed)
 
         # TODO: image start / end is not implemented here to support pretraining.
         if getattr(self.config, 'tune_mm_mlp_adapter', False) and getattr(self.config, 'mm_use_im_start_end', False):
@@ -343,6 +352,7 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM):
         labels: Optional[torch.LongTensor] = None,
         images: Optional[torch.FloatTensor] = None,
         image_sizes: Optional[List[List[int]]] = None,
+        image_features: Optional[torch.FloatTensor] = None,
         **kwargs
     ) -> Union[Tuple, CausalLMOutputWithPast]:
 
@@ -361,7 +371,8 @@ class LlavaLlamaForCausalLM(LlamaForCausalLM):
                 past_key_values,
                 labels,
                 images,
-                image_sizes
+                image_sizes,
+                image_features
             )
 
         return super().forward(
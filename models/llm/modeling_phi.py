@@ -314,6 +314,7 @@ class PhiAttention(nn.Module):
         past_key_value: Optional[Cache] = None,
         output_attentions: bool = False,
         use_cache: bool = False,
+        **kwargs,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         bsz, q_len, _ = hidden_states.size()
 
@@ -510,7 +511,15 @@ class PhiFlashAttention2(PhiAttention):
             value_states = value_states.to(target_dtype)
 
         attn_output = self._flash_attention_forward(
-            query_states, key_states, value_states, attention_mask, q_len, dropout=attn_dropout, softmax_scale=None
+            query_states,
+            key_states,
+            value_states,
+            attention_mask,
+            q_len,
+            dropout=attn_dropout,
+            softmax_scale=None,
+            cu_seqlens=kwargs.get("cu_seqlens"),
+            max_seqlen=kwargs.get("max_seqlen"),
         )
 
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
@@ -523,7 +532,16 @@ class PhiFlashAttention2(PhiAttention):
 
     # Copied from transformers.models.llama.modeling_llama.LlamaFlashAttention2._flash_attention_forward
     def _flash_attention_forward(
-        self, query_states, key_states, value_states, attention_mask, query_length, dropout=0.0, softmax_scale=None
+        self,
+        query_states,
+        key_states,
+        value_states,
+        attention_mask,
+        query_length,
+        dropout=0.0,
+        softmax_scale=None,
+        cu_seqlens=None,
+        max_seqlen=None,
     ):
         """
         Calls the forward method of Flash Attention - if the input hidden states contain at least one padding token
@@ -543,6 +561,11 @@ class PhiFlashAttention2(PhiAttention):
                 Attention dropout
             softmax_scale (`float`, *optional*):
                 The scaling of QK^T before applying softmax. Default to 1 / sqrt(head_dim)
+            cu_seqlens (`torch.Tensor`, *optional*):
+                Cumulative lengths of the sequences packed into the (flattened) batch, each one attends only to
+                itself. Used instead of the padding mask.
+            max_seqlen (`int`, *optional*):
+                Length of the longest packed sequence.
         """
         if not self._flash_attn_uses_top_left_mask:
             causal = self.is_causal
@@ -550,8 +573,24 @@ class PhiFlashAttention2(PhiAttention):
             # TODO: Remove the `query_length != 1` check once Flash Attention for RoCm is bumped to 2.1. For details, please see the comment in LlamaFlashAttention2 __init__.
             causal = self.is_causal and query_length != 1
 
+        # Packed sequences, attention stays within each of them
+        if cu_seqlens is not None:
+            batch_size, _, num_heads, head_dim = query_states.shape
+            attn_output = flash_attn_varlen_func(
+                query_states.reshape(-1, num_heads, head_dim),
+                key_states.reshape(-1, key_states.shape[2], head_dim),
+                value_states.reshape(-1, value_states.shape[2], head_dim),
+                cu_seqlens_q=cu_seqlens,
+                cu_seqlens_k=cu_seqlens,
+                max_seqlen_q=max_seqlen,
+                max_seqlen_k=max_seqlen,
+                dropout_p=dropout,
+                softmax_scale=softmax_scale,
+                causal=causal,
+            )
+            attn_output = attn_output.reshape(batch_size, query_length, num_heads, head_dim)
         # Contains at least one padding token in the sequence
-        if attention_mask is not None:
+        elif attention_mask is not None:
             batch_size = query_states.shape[0]
             query_states, key_states, value_states, indices_q, cu_seq_lens, max_seq_lens = self._upad_input(
                 query_states, key_states, value_states, attention_mask, query_length
@@ -643,6 +682,8 @@ class PhiDecoderLayer(nn.Module):
         output_attentions: Optional[bool] = False,
         use_cache: Optional[bool] = False,
         past_key_value: Optional[Tuple[torch.Tensor]] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         """
         Args:
@@ -660,6 +701,8 @@ class PhiDecoderLayer(nn.Module):
                 If set to `True`, `past_key_values` key value states are returned and can be used to speed up decoding
                 (see `past_key_values`).
             past_key_value (`Tuple(torch.FloatTensor)`, *optional*): cached past key and value projection states
+            cu_seqlens (`torch.Tensor`, *optional*): cumulative lengths of packed sequences (flash attention only)
+            max_seqlen (`int`, *optional*): length of the longest packed sequence
         """
 
         residual = hidden_states
@@ -674,6 +717,8 @@ class PhiDecoderLayer(nn.Module):
             past_key_value=past_key_value,
             output_attentions=output_attentions,
             use_cache=use_cache,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
         )
         attn_outputs = self.resid_dropout(attn_outputs)
 
@@ -849,6 +894,8 @@ class PhiModel(PhiPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -895,6 +942,11 @@ class PhiModel(PhiPreTrainedModel):
 
         inputs_embeds = self.embed_dropout(inputs_embeds)
 
+        if cu_seqlens is not None:
+            if not self._use_flash_attention_2:
+                raise ValueError("cu_seqlens (packed sequences) needs attn_implementation='flash_attention_2'")
+            max_seqlen = int(max_seqlen)
+
         # Attention mask.
         if self._use_flash_attention_2:
             # 2d mask is passed through the layers
@@ -922,8 +974,11 @@ class PhiModel(PhiPreTrainedModel):
                     hidden_states,
                     attention_mask,
                     position_ids,
-                    past_key_values,
                     output_attentions,
+                    use_cache,
+                    past_key_values,
+                    cu_seqlens,
+                    max_seqlen,
                 )
             else:
                 layer_outputs = decoder_layer(
@@ -933,6 +988,8 @@ class PhiModel(PhiPreTrainedModel):
                     past_key_value=past_key_values,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    cu_seqlens=cu_seqlens,
+                    max_seqlen=max_seqlen,
                 )
 
             hidden_states = layer_outputs[0]
@@ -1013,6 +1070,8 @@ class PhiForCausalLM(PhiPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cu_seqlens: Optional[torch.Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1020,6 +1079,9 @@ class PhiForCausalLM(PhiPreTrainedModel):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            cu_seqlens (`torch.Tensor` of shape `(num_sequences + 1,)`, *optional*):
+                Cumulative lengths of the sequences packed into the flattened batch, with flash_attention_2 each
+                sequence then attends only to itself. `max_seqlen` is the length of the longest one.
 
         Returns:
 
@@ -1057,6 +1119,8 @@ class PhiForCausalLM(PhiPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max_seqlen,
         )
 
         hidden_states = outputs[0]
@@ -178,19 +178,30 @@ class GeneralConditioner(nn.Module):
             embedders.append(embedder)
         self.embedders = nn.ModuleList(embedders)
 
-    def forward(self, batch: Dict, force_zero_embeddings=None):
+    def forward(self, batch: Dict, force_zero_embeddings=None, cached_outputs=None, collect_outputs=None):
+        """
+        cached_outputs: {embedder index: outputs} used in place of running those embedders
+        collect_outputs: dict filled with the raw (before ucg) outputs of the embedders that ran
+        """
         output = dict()
         if force_zero_embeddings is None:
             force_zero_embeddings = []
+        if cached_outputs is None:
+            cached_outputs = {}
             
-        for embedder in self.embedders:
+        for n, embedder in enumerate(self.embedders):
             # print(embedder.__class__.__name__, embedder.input_key if hasattr(embedder, "input_key") else None)
             embedding_context = nullcontext if embedder.is_trainable else torch.no_grad
-            with embedding_context():
-                if hasattr(embedder, "input_key") and (embedder.input_key is not None):
-                    emb_out = embedder(batch[embedder.input_key])
-                elif hasattr(embedder, "input_keys"):
-                    emb_out = embedder(*[batch[k] for k in embedder.input_keys])
+            if n in cached_outputs:
+                emb_out = cached_outputs[n]
+            else:
+                with embedding_context():
+                    if hasattr(embedder, "input_key") and (embedder.input_key is not None):
+                        emb_out = embedder(batch[embedder.input_key])
+                    elif hasattr(embedder, "input_keys"):
+                        emb_out = embedder(*[batch[k] for k in embedder.input_keys])
+                if collect_outputs is not None:
+                    collect_outputs[n] = emb_out
                     
             assert isinstance(emb_out, (torch.Tensor, list, tuple)) \
                 , f"encoder outputs must be tensors or a sequence, but got {type(emb_out)}"
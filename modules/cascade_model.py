@@ -92,6 +92,9 @@ class StableCascadeModel(pl.LightningModule):
             loss_weight=AdaptiveLossWeight() if self.config.adaptive_loss_weight else P2LossWeight(),
         )
         self.to(self.target_device)
+        if isinstance(self.gdf.loss_weight, torch.nn.Module):
+            # not a submodule of this model, the adaptive loss buckets live on the device
+            self.gdf.loss_weight.to(self.target_device)
         self.previewer.requires_grad_(False).eval()
         self.effnet.requires_grad_(False).eval()
         self.text_encoder.requires_grad_(False).eval()
@@ -241,6 +244,8 @@ class StableCascadeModel(pl.LightningModule):
         cfg = self.config.trainer
         if self.config.advanced.get("train_text_encoder"):
             self.text_encoder.save_pretrained(f"{model_path}_text_encoder")
+        if isinstance(self.gdf.loss_weight, torch.nn.Module):
+            torch.save(self.gdf.loss_weight.state_dict(), f"{model_path}_loss_weight.pt")
 
         state_dict = self.stage_c.state_dict()
         # check if any keys startswith modules. if so, remove the modules. prefix
@@ -0,0 +1,60 @@
+import json
+import os
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def sample_seed(seed: int, idx: int) -> int:
+    return int(np.random.SeedSequence([seed, idx]).generate_state(1)[0])
+
+
+def seeded_noise_and_timesteps(indices, seed, shape, timestep_start, timestep_end, device, dtype):
+    """
+    Noise and timestep of each pair drawn from a generator seeded by (seed, dataset index),
+    so a reference pass and any later training step see the same ones for a sample.
+    """
+    noise, timesteps = [], []
+    for idx in indices.tolist():
+        generator = torch.Generator().manual_seed(sample_seed(seed, idx))
+        timesteps.append(torch.randint(timestep_start, timestep_end, (1,), generator=generator))
+        noise.append(torch.randn(shape, generator=generator))
+    noise = torch.stack(noise).to(device, dtype, non_blocking=True)
+    timesteps = torch.cat(timesteps).to(device, non_blocking=True)
+    return noise, timesteps
+
+
+def per_sample_mse(pred, target):
+    loss = F.mse_loss(pred.float(), target.float(), reduction="none")
+    return loss.mean(dim=list(range(1, len(loss.shape))))
+
+
+def ref_loss_spec(config) -> dict:
+    """Everything the reference losses depend on, a stored table is only used under the same spec."""
+    advanced = config.get("advanced", {})
+    return {
+        "model_path": str(config.trainer.model_path),
+        "dataset": str(config.dataset.name),
+        "dataset_split": str(config.dataset.get("dataset_split")),
+        "resolution": config.dataset.resolution,
+        "seed": config.trainer.seed,
+        "timestep_start": advanced.get("timestep_start", 0),
+        "timestep_end": advanced.get("timestep_end", 1000),
+        "v_parameterization": advanced.get("v_parameterization", False),
+    }
+
+
+def save_ref_losses(path, ref_losses, spec):
+    """ref_losses: [num_pairs, 2] float array of the (winner, loser) reference losses."""
+    tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, ref_losses=np.asarray(ref_losses, dtype=np.float32), spec=json.dumps(spec, sort_keys=True))
+    os.replace(tmp_path, path)
+
+
+def load_ref_losses(path, spec, device=None) -> torch.Tensor:
+    stored = np.load(path)
+    if json.loads(str(stored["spec"])) != spec:
+        raise ValueError(
+            f"{path} was computed with {str(stored['spec'])}, rerun scripts/precompute_dpo_ref_losses.py for the current config"
+        )
+    return torch.from_numpy(stored["ref_losses"]).to(device)
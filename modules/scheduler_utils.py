@@ -1,14 +1,67 @@
 import torch
 
+
+class NoiseScheduleTables:
+    """
+    Per-timestep tables of a DDPM-style noise schedule, kept on the training device.
+
+    Lookups are gathers with the (device) timestep tensor, so adding noise, building
+    the v-target and weighting the loss never wait on the host.
+    """
+
+    def __init__(self, alphas_cumprod: torch.Tensor, device=None):
+        alphas_cumprod = alphas_cumprod.to(device=device, dtype=torch.float32)
+        self.alphas_cumprod = alphas_cumprod
+        self.sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
+        self.sqrt_one_minus_alphas_cumprod = torch.sqrt(1.0 - alphas_cumprod)
+        self.snr = (self.sqrt_alphas_cumprod / self.sqrt_one_minus_alphas_cumprod) ** 2
+        # k-diffusion / EulerDiscreteScheduler sigmas, in timestep order
+        self.sigmas = ((1 - alphas_cumprod) / alphas_cumprod) ** 0.5
+
+    @staticmethod
+    def gather(table, timesteps, n_dim=1):
+        """table[timesteps], reshaped to broadcast against a n_dim tensor."""
+        out = table[timesteps.to(table.device, non_blocking=True)]
+        return out.reshape(-1, *([1] * (n_dim - 1)))
+
+    def add_noise(self, original_samples, noise, timesteps):
+        sqrt_alpha = self.gather(self.sqrt_alphas_cumprod, timesteps, original_samples.ndim)
+        sqrt_one_minus_alpha = self.gather(self.sqrt_one_minus_alphas_cumprod, timesteps, original_samples.ndim)
+        noisy_samples = sqrt_alpha * original_samples + sqrt_one_minus_alpha * noise
+        return noisy_samples.to(original_samples.dtype)
+
+    def get_velocity(self, sample, noise, timesteps):
+        sqrt_alpha = self.gather(self.sqrt_alphas_cumprod, timesteps, sample.ndim)
+        sqrt_one_minus_alpha = self.gather(self.sqrt_one_minus_alphas_cumprod, timesteps, sample.ndim)
+        velocity = sqrt_alpha * noise - sqrt_one_minus_alpha * sample
+        return velocity.to(sample.dtype)
+
+    def snr_weight(self, timesteps, gamma, v_prediction=False):
+        """Min-SNR-gamma loss weight per timestep."""
+        snr = self.gather(self.snr, timesteps)
+        min_snr_gamma = torch.clamp(snr, max=gamma)
+        return min_snr_gamma / (snr + 1) if v_prediction else min_snr_gamma / snr
+
+
 def cache_snr_values(noise_scheduler, device):
-    alphas_cumprod = noise_scheduler.alphas_cumprod
-    sqrt_alphas_cumprod = torch.sqrt(alphas_cumprod)
-    sqrt_one_minus_alphas_cumprod = torch.sqrt(1.0 - alphas_cumprod)
-    alpha = sqrt_alphas_cumprod
-    sigma = sqrt_one_minus_alphas_cumprod
-    all_snr = (alpha / sigma) ** 2
+    tables = NoiseScheduleTables(noise_scheduler.alphas_cumprod, device)
+    noise_scheduler.tables = tables
+    noise_scheduler.all_snr = tables.snr
+
+
+def get_sigmas(sch, timesteps, n_dim=4, dtype=torch.float32, device="cuda:0"):
+    """sch.sigmas at the positions of timesteps in sch.timesteps, without a host sync per timestep."""
+    sigmas = sch.sigmas.to(device=device, dtype=dtype)
+    schedule_timesteps = sch.timesteps.to(device)
+    timesteps = timesteps.to(device)
+
+    # index of the first match, same as (schedule_timesteps == t).nonzero() for each t
+    step_indices = (schedule_timesteps[None, :] == timesteps[:, None]).int().argmax(dim=1)
 
-    noise_scheduler.all_snr = all_snr.to(device)
+    sigma = sigmas[step_indices].flatten()
+    while len(sigma.shape) < n_dim:
+        sigma = sigma.unsqueeze(-1)
+    return sigma
 
 def apply_zero_terminal_snr(noise_scheduler):
     # fix beta: zero terminal SNR
@@ -48,11 +101,9 @@ def apply_zero_terminal_snr(noise_scheduler):
     noise_scheduler.alphas_cumprod = alphas_cumprod
 
 def apply_snr_weight(loss, timesteps, noise_scheduler, gamma, v_prediction=False):
-    snr = torch.stack([noise_scheduler.all_snr[t] for t in timesteps])
-    min_snr_gamma = torch.minimum(snr, torch.full_like(snr, gamma))
-    if v_prediction:
-        snr_weight = torch.div(min_snr_gamma, snr + 1).float().to(loss.device)
-    else:
-        snr_weight = torch.div(min_snr_gamma, snr).float().to(loss.device)
+    tables = getattr(noise_scheduler, "tables", None)
+    if tables is None:
+        tables = noise_scheduler.tables = NoiseScheduleTables(noise_scheduler.alphas_cumprod, loss.device)
+    snr_weight = tables.snr_weight(timesteps, gamma, v_prediction).float().to(loss.device)
     loss = loss * snr_weight
     return loss
\ No newline at end of file
@@ -70,12 +70,14 @@ class StableDiffusionModel(pl.LightningModule):
     def get_module(self):
         return self.unet
     
-    def encode_pixels(self, inputs):
+    def encode_pixels(self, inputs, sample=True):
+        # sample=False takes the posterior mode, for losses that have to be reproducible
         feed_pixel_values = inputs
         latents = []
         for i in range(0, feed_pixel_values.shape[0], self.vae_encode_bsz):
             with torch.autocast("cuda", enabled=False):
-                lat = self.vae.encode(feed_pixel_values[i : i + self.vae_encode_bsz]).latent_dist.sample()
+                latent_dist = self.vae.encode(feed_pixel_values[i : i + self.vae_encode_bsz]).latent_dist
+                lat = latent_dist.sample() if sample else latent_dist.mode()
             latents.append(lat)
         latents = torch.cat(latents, dim=0)
         latents = latents * self.vae.config.scaling_factor
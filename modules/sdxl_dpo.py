@@ -8,6 +8,7 @@ import torch.nn.functional as F
 from common.utils import get_class
 from common.logging import logger
 from modules.sdxl_model import StableDiffusionModel
+from modules.dpo_utils import load_ref_losses, per_sample_mse, ref_loss_spec, seeded_noise_and_timesteps
 from modules.sdxl_dpo_diffusers import setup_hf_dataloader
 from lightning.pytorch.utilities.model_summary import ModelSummary
 
@@ -53,6 +54,14 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
 class SupervisedFineTune(StableDiffusionModel):
     def init_model(self):
         super().init_model()
+        self.ref_losses = None
+        ref_losses_path = self.config.get("advanced", {}).get("dpo_ref_losses")
+        if ref_losses_path and os.path.exists(ref_losses_path):
+            # reference losses precomputed by scripts/precompute_dpo_ref_losses.py, no reference unet
+            self.ref_losses = load_ref_losses(ref_losses_path, ref_loss_spec(self.config), self.target_device)
+            logger.info(f"Using {len(self.ref_losses)} precomputed reference losses from {ref_losses_path}")
+            return
+
         # clone frozen unet as ref
         self.unet_ref = copy.deepcopy(self.model)
         self.unet_ref.eval().requires_grad_(False)
@@ -62,13 +71,15 @@ class SupervisedFineTune(StableDiffusionModel):
     def encode_batch(self, batch):
         self.conditioner.to(self.target_device)
         return self.conditioner(batch)
-        
-    def forward(self, batch):
+
+    def prepare_inputs(self, batch):
         advanced = self.config.get("advanced", {})
+        # with stored reference losses, latents, noise and timesteps have to be reproducible per sample
+        seeded = bool(advanced.get("dpo_ref_losses"))
         self.first_stage_model.to(self.target_device)
 
         feed_pixel_values = torch.cat(batch["pixels"].chunk(2, dim=1))
-        latents = self.encode_first_stage(feed_pixel_values.to(self.first_stage_model.dtype))
+        latents = self.encode_first_stage(feed_pixel_values.to(self.first_stage_model.dtype), sample=not seeded)
         if torch.any(torch.isnan(latents)):
             logger.info("NaN found in latents, replacing with zeros")
             latents = torch.where(
@@ -82,33 +93,52 @@ class SupervisedFineTune(StableDiffusionModel):
             "vector": cond["vector"].to(model_dtype).repeat(2, 1),
         }
 
-        # Sample noise that we'll add to the latents
-        noise = torch.randn_like(latents, dtype=model_dtype).chunk(2)[0].repeat(2, 1, 1, 1)
         bsz = latents.shape[0] // 2
-
-        # Sample a random timestep for each image
-        timesteps = torch.randint(
-            advanced.get("timestep_start", 0),
-            advanced.get("timestep_end", 1000),
-            (bsz,),
-            dtype=torch.int64,
-            device=latents.device,
-        ).repeat(2)
+        timestep_start = advanced.get("timestep_start", 0)
+        timestep_end = advanced.get("timestep_end", 1000)
+        if seeded:
+            noise, timesteps = seeded_noise_and_timesteps(
+                batch["indices"], self.config.trainer.seed, latents.shape[1:],
+                timestep_start, timestep_end, latents.device, model_dtype,
+            )
+            noise, timesteps = noise.repeat(2, 1, 1, 1), timesteps.repeat(2)
+        else:
+            # Sample noise that we'll add to the latents
+            noise = torch.randn_like(latents, dtype=model_dtype).chunk(2)[0].repeat(2, 1, 1, 1)
+
+            # Sample a random timestep for each image
+            timesteps = torch.randint(
+                timestep_start,
+                timestep_end,
+                (bsz,),
+                dtype=torch.int64,
+                device=latents.device,
+            ).repeat(2)
 
         # Add noise to the latents according to the noise magnitude at each timestep
         # (this is the forward diffusion process)
-        noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
-
-        # Predict the noise residual
-        noise_pred = self.model(noisy_latents, timesteps, cond)
+        noisy_latents = self.noise_scheduler.tables.add_noise(latents, noise, timesteps)
 
         # Get the target for loss depending on the prediction type
         is_v = advanced.get("v_parameterization", False)
-        target = noise if not is_v else self.noise_scheduler.get_velocity(latents, noise, timesteps)
+        target = noise if not is_v else self.noise_scheduler.tables.get_velocity(latents, noise, timesteps)
+        return noisy_latents, timesteps, cond, target
+
+    @torch.no_grad()
+    def reference_losses(self, noisy_latents, timesteps, cond, target):
+        ref_d = next(self.unet_ref.parameters()).dtype
+        cond_d = {k: v.to(ref_d) for k, v in cond.items()}
+        ref_preds = self.unet_ref(noisy_latents.to(ref_d), timesteps, cond_d)
+        return per_sample_mse(ref_preds, target)
+        
+    def forward(self, batch):
+        noisy_latents, timesteps, cond, target = self.prepare_inputs(batch)
+
+        # Predict the noise residual
+        noise_pred = self.model(noisy_latents, timesteps, cond)
 
         # Compute losses.
-        model_losses = F.mse_loss(noise_pred.float(), target.float(), reduction="none")
-        model_losses = model_losses.mean(dim=list(range(1, len(model_losses.shape))))
+        model_losses = per_sample_mse(noise_pred, target)
         model_losses_w, model_losses_l = model_losses.chunk(2)
 
         # For logging
@@ -116,11 +146,10 @@ class SupervisedFineTune(StableDiffusionModel):
         model_diff = model_losses_w - model_losses_l  # These are both LBS (as is t)
 
         with torch.no_grad():
-            ref_d = next(self.unet_ref.parameters()).dtype
-            cond_d = {k: v.to(ref_d) for k, v in cond.items()}
-            ref_preds = self.unet_ref(noisy_latents.to(ref_d), timesteps, cond_d)
-            ref_loss = F.mse_loss(ref_preds.float(), target.float(), reduction="none")
-            ref_loss = ref_loss.mean(dim=list(range(1, len(ref_loss.shape))))
+            if self.ref_losses is not None:
+                ref_loss = self.ref_losses[batch["indices"].to(self.ref_losses.device)].T.flatten()
+            else:
+                ref_loss = self.reference_losses(noisy_latents, timesteps, cond, target)
 
             ref_losses_w, ref_losses_l = ref_loss.chunk(2)
             ref_diff = ref_losses_w - ref_losses_l
@@ -9,6 +9,7 @@ from data.paired_wds import setup_hf_dataloader
 from common.utils import get_class
 from common.logging import logger
 from modules.sdxl_model_diffusers import StableDiffusionModel
+from modules.dpo_utils import load_ref_losses, per_sample_mse, ref_loss_spec, seeded_noise_and_timesteps
 from lightning.pytorch.utilities.model_summary import ModelSummary
 
 
@@ -56,18 +57,28 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
 class SupervisedFineTune(StableDiffusionModel):
     def init_model(self):
         super().init_model()
+        self.ref_losses = None
+        ref_losses_path = self.config.get("advanced", {}).get("dpo_ref_losses")
+        if ref_losses_path and os.path.exists(ref_losses_path):
+            # reference losses precomputed by scripts/precompute_dpo_ref_losses.py, no reference unet
+            self.ref_losses = load_ref_losses(ref_losses_path, ref_loss_spec(self.config), self.target_device)
+            logger.info(f"Using {len(self.ref_losses)} precomputed reference losses from {ref_losses_path}")
+            return
+
         # clone frozen unet as ref
         self.unet_ref = copy.deepcopy(self.unet)
         self.unet_ref.eval().requires_grad_(False)
         # since we're in dpo, unet_ref in 16bit is ok
         self.unet_ref.to(torch.float16)
-        
-    def forward(self, batch):
+
+    def prepare_inputs(self, batch):
         advanced = self.config.get("advanced", {})
+        # with stored reference losses, latents, noise and timesteps have to be reproducible per sample
+        seeded = bool(advanced.get("dpo_ref_losses"))
         self.vae.to(self.target_device)
 
         feed_pixel_values = torch.cat(batch["pixels"].chunk(2, dim=1))
-        latents = self.encode_pixels(feed_pixel_values)
+        latents = self.encode_pixels(feed_pixel_values, sample=not seeded)
         if torch.any(torch.isnan(latents)):
             logger.info("NaN found in latents, replacing with zeros")
             latents = torch.where(
@@ -85,42 +96,62 @@ class SupervisedFineTune(StableDiffusionModel):
         bs = batch["original_size_as_tuple"]
         bc = batch["crop_coords_top_left"]
         bt = batch["target_size_as_tuple"]
-        add_time_ids = torch.cat(
-            [self.compute_time_ids(s, c, t) for s, c, t in zip(bs, bc, bt)]
-        ).repeat(2, 1)
+        add_time_ids = self.compute_time_ids(bs, bc, bt).repeat(2, 1)
 
-        # Sample noise that we'll add to the latents
-        noise = torch.randn_like(latents, dtype=model_dtype).chunk(2)[0].repeat(2, 1, 1, 1)
         bsz = latents.shape[0] // 2
-
-        # Sample a random timestep for each image
-        timesteps = torch.randint(
-            advanced.get("timestep_start", 0),
-            advanced.get("timestep_end", 1000),
-            (bsz,),
-            dtype=torch.int64,
-            device=latents.device,
-        ).repeat(2)
+        timestep_start = advanced.get("timestep_start", 0)
+        timestep_end = advanced.get("timestep_end", 1000)
+        if seeded:
+            noise, timesteps = seeded_noise_and_timesteps(
+                batch["indices"], self.config.trainer.seed, latents.shape[1:],
+                timestep_start, timestep_end, latents.device, model_dtype,
+            )
+            noise, timesteps = noise.repeat(2, 1, 1, 1), timesteps.repeat(2)
+        else:
+            # Sample noise that we'll add to the latents
+            noise = torch.randn_like(latents, dtype=model_dtype).chunk(2)[0].repeat(2, 1, 1, 1)
+
+            # Sample a random timestep for each image
+            timesteps = torch.randint(
+                timestep_start,
+                timestep_end,
+                (bsz,),
+                dtype=torch.int64,
+                device=latents.device,
+            ).repeat(2)
 
         # Add noise to the latents according to the noise magnitude at each timestep
         # (this is the forward diffusion process)
-        noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
+        noisy_latents = self.noise_scheduler.tables.add_noise(latents, noise, timesteps)
 
-        # Predict the noise residual
-        noise_pred = self.unet(
-            sample=noisy_latents,
+        # Get the target for loss depending on the prediction type
+        is_v = advanced.get("v_parameterization", False)
+        target = noise if not is_v else self.noise_scheduler.tables.get_velocity(latents, noise, timesteps)
+        cond = {
+            "encoder_hidden_states": text_embedding,
+            "added_cond_kwargs": {"text_embeds": pooled, "time_ids": add_time_ids},
+        }
+        return noisy_latents, timesteps, cond, target
+
+    @torch.no_grad()
+    def reference_losses(self, noisy_latents, timesteps, cond, target):
+        ref_d = next(self.unet_ref.parameters()).dtype
+        ref_preds = self.unet_ref(
+            sample=noisy_latents.to(ref_d),
             timestep=timesteps,
-            encoder_hidden_states=text_embedding,
-            added_cond_kwargs={"text_embeds": pooled, "time_ids": add_time_ids},
+            encoder_hidden_states=cond["encoder_hidden_states"].to(ref_d),
+            added_cond_kwargs=cond["added_cond_kwargs"],
         ).sample
+        return per_sample_mse(ref_preds, target)
+        
+    def forward(self, batch):
+        noisy_latents, timesteps, cond, target = self.prepare_inputs(batch)
 
-        # Get the target for loss depending on the prediction type
-        is_v = advanced.get("v_parameterization", False)
-        target = noise if not is_v else self.noise_scheduler.get_velocity(latents, noise, timesteps)
+        # Predict the noise residual
+        noise_pred = self.unet(sample=noisy_latents, timestep=timesteps, **cond).sample
 
         # Compute losses.
-        model_losses = F.mse_loss(noise_pred.float(), target.float(), reduction="none")
-        model_losses = model_losses.mean(dim=list(range(1, len(model_losses.shape))))
+        model_losses = per_sample_mse(noise_pred, target)
         model_losses_w, model_losses_l = model_losses.chunk(2)
 
         # For logging
@@ -128,16 +159,10 @@ class SupervisedFineTune(StableDiffusionModel):
         model_diff = model_losses_w - model_losses_l  # These are both LBS (as is t)
 
         with torch.no_grad():
-            ref_d = next(self.unet_ref.parameters()).dtype
-            ref_preds = self.unet_ref(
-                sample=noisy_latents.to(ref_d),
-                timestep=timesteps,
-                encoder_hidden_states=text_embedding.to(ref_d),
-                added_cond_kwargs={"text_embeds": pooled, "time_ids": add_time_ids},
-            ).sample
-
-            ref_loss = F.mse_loss(ref_preds.float(), target.float(), reduction="none")
-            ref_loss = ref_loss.mean(dim=list(range(1, len(ref_loss.shape))))
+            if self.ref_losses is not None:
+                ref_loss = self.ref_losses[batch["indices"].to(self.ref_losses.device)].T.flatten()
+            else:
+                ref_loss = self.reference_losses(noisy_latents, timesteps, cond, target)
 
             ref_losses_w, ref_losses_l = ref_loss.chunk(2)
             ref_diff = ref_losses_w - ref_losses_l
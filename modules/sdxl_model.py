@@ -13,11 +13,13 @@ from modules.sdxl_utils import disabled_train, UnetWrapper, AutoencoderKLWrapper
 from modules.scheduler_utils import apply_zero_terminal_snr, cache_snr_values
 from common.utils import get_class, load_torch_file, EmptyInitWrapper, get_world_size
 from common.logging import logger
+from common.profiling import profile_phase
+from common.checkpoint import get_checkpoint_writer, save_state_dict
 
 from diffusers import DDPMScheduler
 from lightning.pytorch.utilities import rank_zero_only
-from safetensors.torch import save_file
 from modules.config_sdxl_base import model_config
+from data.text_cache import TextEmbeddingCache, cacheable_embedders, text_cache_key
 
 # define the LightningModule
 class StableDiffusionModel(pl.LightningModule):
@@ -112,12 +114,42 @@ class StableDiffusionModel(pl.LightningModule):
         if hasattr(self.noise_scheduler, "alphas_cumprod"):
             cache_snr_values(self.noise_scheduler, self.target_device)
 
+        self.text_cache = None
+        text_cache_path = self.config.dataset.get("text_cache_path")
+        if text_cache_path and cacheable_embedders(self.conditioner):
+            self.text_cache = TextEmbeddingCache(
+                text_cache_path,
+                key=text_cache_key(self.conditioner, Path(self.model_path).name),
+                embedders=cacheable_embedders(self.conditioner),
+                writable=self.config.dataset.get("text_cache_fill", True),
+            )
+            logger.info(f"Using text embedding cache {self.text_cache.root} ({len(self.text_cache)} prompts)")
+
     def get_module(self):
         return self.model
 
+    @profile_phase("conditioner")
     def encode_batch(self, batch):
         self.conditioner.to(self.target_device)
-        return self.conditioner(batch)
+        prompts = batch.get("prompts")
+        if self.text_cache is None or not isinstance(prompts, list):
+            return self.conditioner(batch)
+
+        # embeddings prefetched by the dataloader, or looked up here (includes lazily filled entries)
+        cached = batch.get("cached_cond")
+        if cached is not None and cached["key"] != self.text_cache.key:
+            cached = None
+        cached = cached["outputs"] if cached is not None else self.text_cache.lookup(prompts)
+        if cached is not None:
+            cached = {k: [emb.to(self.target_device) for emb in v] for k, v in cached.items()}
+            return self.conditioner(batch, cached_outputs=cached)
+
+        if not self.text_cache.writable:
+            return self.conditioner(batch)
+        collected = {}
+        cond = self.conditioner(batch, collect_outputs=collected)
+        self.text_cache.add(prompts, collected)
+        return cond
     
     def _denormlize(self, latents):
         if hasattr(self, "latents_mean"):
@@ -143,13 +175,16 @@ class StableDiffusionModel(pl.LightningModule):
         return out
 
     @torch.no_grad()
-    def encode_first_stage(self, x):
+    @profile_phase("vae")
+    def encode_first_stage(self, x, sample=True):
+        # sample=False takes the posterior mode, for losses that have to be reproducible
         latents = []
         self.first_stage_model = self.first_stage_model.float()
         with torch.autocast("cuda", enabled=False):
             for i in range(0, x.shape[0], self.vae_encode_bsz):
                 o = x[i : i + self.vae_encode_bsz]
-                latents.append(self.first_stage_model.encode(o).sample())
+                posterior = self.first_stage_model.encode(o)
+                latents.append(posterior.sample() if sample else posterior.mode())
         z = torch.cat(latents, dim=0)
         return self._normliaze(z)
 
@@ -350,9 +385,21 @@ class StableDiffusionModel(pl.LightningModule):
                 
         else:
             weight_to_save = self.state_dict()
+
+        if not self.config.trainer.get("save_frozen", True):
+            # frozen weights are loaded from model_path again when resuming
+            prefixes = tuple(self.frozen_prefixes())
+            weight_to_save = {k: v for k, v in weight_to_save.items() if not k.startswith(prefixes)}
                 
         self._save_checkpoint(model_path, weight_to_save, metadata)
 
+    def frozen_prefixes(self):
+        prefixes = ["first_stage_model."]
+        for i, embedder in enumerate(self.conditioner.embedders):
+            if not embedder.is_trainable:
+                prefixes.append(f"conditioner.embedders.{i}.")
+        return prefixes
+
     @rank_zero_only
     def _save_checkpoint(self, model_path, state_dict, metadata):
         cfg = self.config.trainer
@@ -362,14 +409,9 @@ class StableDiffusionModel(pl.LightningModule):
                 key.replace("module.", ""): value for key, value in state_dict.items()
             }
 
-        if cfg.get("save_format") == "safetensors":
-            model_path += ".safetensors"
-            save_file(state_dict, model_path, metadata=metadata)
-        else:
-            state_dict = {"state_dict": state_dict, **metadata}
-            model_path += ".ckpt"
-            torch.save(state_dict, model_path)
-        logger.info(f"Saved model to {model_path}")
+        model_path = save_state_dict(state_dict, model_path, metadata, cfg.get("save_format"))
+        if get_checkpoint_writer() is None:
+            logger.info(f"Saved model to {model_path}")
 
     def forward(self, batch):
         raise NotImplementedError
@@ -101,12 +101,14 @@ class StableDiffusionModel(pl.LightningModule):
             latents = scaling_factor * latents
         return latents
              
-    def encode_pixels(self, inputs):
+    def encode_pixels(self, inputs, sample=True):
+        # sample=False takes the posterior mode, for losses that have to be reproducible
         feed_pixel_values = inputs
         latents = []
         for i in range(0, feed_pixel_values.shape[0], self.vae_encode_bsz):
             with torch.autocast("cuda", enabled=False):
-                lat = self.vae.encode(feed_pixel_values[i : i + self.vae_encode_bsz]).latent_dist.sample()
+                latent_dist = self.vae.encode(feed_pixel_values[i : i + self.vae_encode_bsz]).latent_dist
+                lat = latent_dist.sample() if sample else latent_dist.mode()
             latents.append(lat)
         latents = torch.cat(latents, dim=0)
         return self._normliaze(latents)
@@ -126,7 +128,8 @@ class StableDiffusionModel(pl.LightningModule):
     
     def compute_time_ids(self, original_size, crops_coords_top_left, target_size):
         # Adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids
-        add_time_ids = torch.cat([original_size, crops_coords_top_left, target_size])
+        # works on one sample ([2] each) or a whole batch ([B, 2] each, giving [B, 6])
+        add_time_ids = torch.cat([original_size, crops_coords_top_left, target_size], dim=-1)
         add_time_ids = add_time_ids.to(self.target_device)
         return add_time_ids
     
@@ -54,6 +54,9 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
             if latest_ckpt.endswith(".safetensors"):
                 remainder = safetensors.safe_open(latest_ckpt, "pt").metadata()
             model.load_state_dict(sd.get("state_dict", sd))
+            loss_weight_path = f"{os.path.splitext(latest_ckpt)[0]}_loss_weight.pt"
+            if os.path.exists(loss_weight_path):
+                model.gdf.loss_weight.load_state_dict(torch.load(loss_weight_path, map_location=model.target_device))
             config.global_step = remainder.get("global_step", 0)
             config.current_epoch = remainder.get("current_epoch", 0)
 
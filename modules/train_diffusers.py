@@ -82,9 +82,7 @@ class SupervisedFineTune(StableDiffusionModel):
         bs = batch["original_size_as_tuple"]
         bc = batch["crop_coords_top_left"]
         bt = batch["target_size_as_tuple"]
-        add_time_ids = torch.cat(
-            [self.compute_time_ids(s, c, t) for s, c, t in zip(bs, bc, bt)]
-        )
+        add_time_ids = self.compute_time_ids(bs, bc, bt)
 
         # Sample noise that we'll add to the latents
         noise = torch.randn_like(latents, dtype=model_dtype)
@@ -3,6 +3,7 @@ import os
 import lightning as pl
 from omegaconf import OmegaConf
 from common.utils import get_class
+from data.text_dataset import PackedDataset, prepare_packed_inputs
 from common.logging import logger
 from lightning.pytorch.utilities.model_summary import ModelSummary
 from transformers import AutoTokenizer, AutoModelForCausalLM
@@ -82,6 +83,8 @@ class LLMModel(pl.LightningModule):
             tokenizer=self.tokenizer,
             **config.dataset,
         )
+        if config.dataset.get("packing"):
+            train_dataset = PackedDataset(train_dataset, **config.dataset.packing)
         bsz = config.trainer.batch_size
         train_dataloader = train_dataset.build_dataloader(batch_size=bsz)
         self.val_dataset = val_dataset
@@ -90,8 +93,10 @@ class LLMModel(pl.LightningModule):
 
     def forward(self, batch):
         for k, v in batch.items():
-            batch[k] = v.to(self.target_device)
+            if torch.is_tensor(v):
+                batch[k] = v.to(self.target_device)
 
+        batch = prepare_packed_inputs(batch, self.model.dtype)
         out = self.model(**batch)
         loss = out["loss"]
         return loss
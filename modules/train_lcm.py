@@ -4,7 +4,8 @@ import os
 import lightning as pl
 import numpy as np
 from omegaconf import OmegaConf
-from common.utils import get_class
+from common.utils import get_class, get_latest_checkpoint, load_torch_file
+from common.checkpoint import save_state_dict
 from common.logging import logger
 from modules.sdxl_model_diffusers import StableDiffusionModel
 from lightning.pytorch.utilities.model_summary import ModelSummary
@@ -44,6 +45,16 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
             optimizer, **config.scheduler.params
         )
 
+    if model.target_unet is not None and config.trainer.get("resume"):
+        latest_ckpt = get_latest_checkpoint(config.trainer.checkpoint_dir)
+        if latest_ckpt:
+            target_path = f"{os.path.splitext(latest_ckpt)[0]}_target_unet.safetensors"
+            if os.path.exists(target_path):
+                model.target_unet.load_state_dict(load_torch_file(target_path))
+                logger.info(f"Loaded EMA target unet from {target_path}")
+            else:
+                logger.warning(f"No EMA target unet next to {latest_ckpt}, starting it from the student")
+
     model.vae.to(torch.float32)
     if fabric.is_global_zero and os.name != "nt":
         print(f"\n{ModelSummary(model, max_depth=1)}\n")
@@ -170,9 +181,34 @@ class SupervisedFineTune(StableDiffusionModel):
             timesteps=self.noise_scheduler.config.num_train_timesteps,
             ddim_timesteps=50,
         )
-        alpha_cumprods = self.noise_scheduler.alphas_cumprod
-        self.alphas = torch.sqrt(alpha_cumprods).to(self.target_device)
-        self.sigmas = torch.sqrt(1 - alpha_cumprods).to(self.target_device)
+        self.alphas = self.noise_scheduler.tables.sqrt_alphas_cumprod
+        self.sigmas = self.noise_scheduler.tables.sqrt_one_minus_alphas_cumprod
+
+        # optional EMA of the student as the target network (LCM paper), else the teacher
+        self.target_ema_decay = self.config.get("advanced", {}).get("lcm_target_ema_decay")
+        self.target_unet = None
+        if self.target_ema_decay is not None:
+            self.target_unet = copy.deepcopy(self.lcm_unet)
+            self.target_unet.eval().requires_grad_(False)
+        self._uncond_embedding = None
+
+    def uncond_embedding(self, dtype):
+        """Empty-prompt embedding and pooled output, encoded once unless the text encoders are trained."""
+        advanced = self.config.get("advanced", {})
+        trains_te = advanced.get("train_text_encoder_1") or advanced.get("train_text_encoder_2")
+        if self._uncond_embedding is None or trains_te:
+            with torch.no_grad():
+                text_embedding, pooled = self.encode_prompt({"prompts": [""]})
+            self._uncond_embedding = (text_embedding.to(dtype), pooled.to(dtype))
+        return self._uncond_embedding
+
+    @torch.no_grad()
+    def on_before_zero_grad(self, optimizer):
+        # called by the trainer after each optimizer step
+        if self.target_unet is not None:
+            target_params = list(self.target_unet.parameters())
+            student_params = [p.to(target_params[0].dtype) for p in self.lcm_unet.parameters()]
+            torch._foreach_lerp_(target_params, student_params, 1 - self.target_ema_decay)
 
     def forward(self, batch):
         advanced = self.config.get("advanced", {})
@@ -199,9 +235,7 @@ class SupervisedFineTune(StableDiffusionModel):
         bs = batch["original_size_as_tuple"]
         bc = batch["crop_coords_top_left"]
         bt = batch["target_size_as_tuple"]
-        add_time_ids = torch.cat(
-            [self.compute_time_ids(s, c, t) for s, c, t in zip(bs, bc, bt)]
-        )
+        add_time_ids = self.compute_time_ids(bs, bc, bt)
 
         # Sample noise that we'll add to the latents
         noise = torch.randn_like(latents, dtype=model_dtype)
@@ -235,7 +269,7 @@ class SupervisedFineTune(StableDiffusionModel):
 
         # Add noise to the latents according to the noise magnitude at each timestep
         # (this is the forward diffusion process)
-        noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
+        noisy_latents = self.noise_scheduler.tables.add_noise(latents, noise, timesteps)
 
         # Predict the noise residual
         noise_pred = self.lcm_unet(
@@ -256,38 +290,30 @@ class SupervisedFineTune(StableDiffusionModel):
         )
         model_pred = c_skip_start * noisy_latents + c_out_start * pred_x_0
 
+        uncond_embedding, uncond_pooled = self.uncond_embedding(model_dtype)
         with torch.no_grad(), torch.autocast("cuda"):
-            # teacher unet (frozen)
-            cond_teacher_output = self.unet(
-                noisy_latents,
-                start_timesteps,
-                encoder_hidden_states=text_embedding,
-                added_cond_kwargs={"text_embeds": pooled, "time_ids": add_time_ids},
+            # teacher unet (frozen), cond and uncond in one 2B batch
+            teacher_latents = noisy_latents.repeat(2, 1, 1, 1)
+            teacher_timesteps = start_timesteps.repeat(2)
+            teacher_output = self.unet(
+                teacher_latents,
+                teacher_timesteps,
+                encoder_hidden_states=torch.cat([text_embedding, uncond_embedding.expand_as(text_embedding)]),
+                added_cond_kwargs={
+                    "text_embeds": torch.cat([pooled, uncond_pooled.expand_as(pooled)]),
+                    "time_ids": add_time_ids.repeat(2, 1),
+                },
             ).sample
-            cond_pred_x0 = predicted_origin(
-                cond_teacher_output,
-                start_timesteps,
-                noisy_latents,
-                self.noise_scheduler.config.prediction_type,
-                self.alphas,
-                self.sigmas,
-            )
-            # Get teacher model prediction on noisy_latents and unconditional embedding
-            # teacher unet (frozen)
-            uncond_teacher_output = self.unet(
-                noisy_latents,
-                start_timesteps,
-                encoder_hidden_states=text_embedding,
-                added_cond_kwargs={"text_embeds": pooled, "time_ids": add_time_ids},
-            ).sample
-            uncond_pred_x0 = predicted_origin(
-                uncond_teacher_output,
-                start_timesteps,
-                noisy_latents,
+            teacher_pred_x0 = predicted_origin(
+                teacher_output,
+                teacher_timesteps,
+                teacher_latents,
                 self.noise_scheduler.config.prediction_type,
                 self.alphas,
                 self.sigmas,
             )
+            cond_teacher_output, uncond_teacher_output = teacher_output.chunk(2)
+            cond_pred_x0, uncond_pred_x0 = teacher_pred_x0.chunk(2)
 
             # 20.4.11. Perform "CFG" to get x_prev estimate (using the LCM paper's CFG formulation)
             pred_x0 = cond_pred_x0 + w * (cond_pred_x0 - uncond_pred_x0)
@@ -297,14 +323,17 @@ class SupervisedFineTune(StableDiffusionModel):
             x_prev = self.solver.ddim_step(pred_x0, pred_noise, index)
 
         with torch.no_grad(), torch.autocast("cuda"):
-            # algo.1 step.3 alternative - same as above
-            # with self.ema.average_parameters():
-            target_noise_pred = self.unet(
-                x_prev.float(),
-                timesteps,
+            # algo.1 step.3: target network, the EMA of the student or the teacher
+            target_kwargs = dict(
                 encoder_hidden_states=text_embedding,
                 added_cond_kwargs={"text_embeds": pooled, "time_ids": add_time_ids},
-            ).sample
+            )
+            if self.target_unet is not None:
+                target_noise_pred = self.target_unet(
+                    x_prev.float(), timesteps, timestep_cond=w_embedding, **target_kwargs
+                ).sample
+            else:
+                target_noise_pred = self.unet(x_prev.float(), timesteps, **target_kwargs).sample
             pred_x_0 = predicted_origin(
                 target_noise_pred,
                 timesteps,
@@ -339,3 +368,7 @@ class SupervisedFineTune(StableDiffusionModel):
         )
         pipeline.save_pretrained(model_path)
         logger.info(f"Saved model to {model_path}")
+        if self.target_unet is not None:
+            # the EMA target is not part of the pipeline, keep it next to it for resuming
+            target_path = save_state_dict(self.target_unet.state_dict(), f"{model_path}_target_unet", metadata)
+            logger.info(f"Saved EMA target unet to {target_path}")
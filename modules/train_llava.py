@@ -142,6 +142,8 @@ class LLaVAModel(pl.LightningModule):
         use_q_lora = config.get("q_lora", False)
         use_lora = config.get("use_lora", False) or use_q_lora
         config.dataset.update({"version": mm_config.pop("version")})
+        if config.dataset.get("vision_feature_cache") and mm_config.get("tune_mm_vision_tower"):
+            raise ValueError("dataset.vision_feature_cache needs a frozen vision tower, set model_config.tune_mm_vision_tower: false")
         q_config = BitsAndBytesConfig(
             load_in_4bit=True,
             bnb_4bit_use_double_quant=True,
@@ -3,6 +3,7 @@ import os
 import lightning as pl
 from omegaconf import OmegaConf
 from common.utils import get_class
+from data.text_dataset import PackedDataset, prepare_packed_inputs
 from lightning.pytorch.utilities import rank_zero_only
 from common.logging import logger
 from lightning.pytorch.utilities.model_summary import ModelSummary
@@ -38,9 +39,19 @@ class PhiModel(pl.LightningModule):
         self.config = config
         self.model_path = model_path
         self.target_device = device
+        attn_implementation = "flash_attention_2" if is_flash_attn_2_available() else None
+        packing = config.dataset.get("packing")
+        if packing:
+            # the flash path only takes 2D padding masks: block masks need eager attention,
+            # packed position ids need flash_attention_2 for cu_seqlens
+            attention = packing.get("attention", "block_mask")
+            if attention == "block_mask":
+                attn_implementation = "eager"
+            elif not is_flash_attn_2_available():
+                raise ValueError(f"packing with attention: {attention} needs flash_attn, use attention: block_mask")
         self.model = PhiForCausalLM.from_pretrained(
             model_path,
-            attn_implementation="flash_attention_2" if is_flash_attn_2_available() else None,
+            attn_implementation=attn_implementation,
             torch_dtype=torch.bfloat16 if is_flash_attn_2_available() else torch.float32,
             **config.get("model_params", {})
         )
@@ -64,6 +75,8 @@ class PhiModel(pl.LightningModule):
             tokenizer=self.tokenizer,
             **config.dataset,
         )
+        if config.dataset.get("packing"):
+            train_dataset = PackedDataset(train_dataset, **config.dataset.packing)
         bsz = config.trainer.batch_size
         train_dataloader = train_dataset.build_dataloader(batch_size=bsz)
         self.val_dataset = val_dataset
@@ -72,8 +85,10 @@ class PhiModel(pl.LightningModule):
 
     def forward(self, batch):
         for k, v in batch.items():
-            batch[k] = v.to(self.target_device)
+            if torch.is_tensor(v):
+                batch[k] = v.to(self.target_device)
 
+        batch = prepare_packed_inputs(batch, self.model.dtype, inverted=False, varlen=True)
         out = self.model(**batch)
         loss = out["loss"]
         return loss
@@ -13,6 +13,7 @@ from lightning.pytorch.utilities import rank_zero_only
 
 from common.utils import load_torch_file, get_class
 from common.logging import logger
+from data.text_cache import T5EmbeddingCache, t5_cache_key
 
 from models.pixart.alpha import DiT_XL_2, get_model_kwargs, sample  
 from models.pixart.diffusion import (
@@ -60,6 +61,8 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
 
 
 class DiffusionModel(pl.LightningModule):
+    max_token_length = 120
+
     def __init__(self, model_path, config, device):
         super().__init__()
         self.config = config
@@ -74,19 +77,28 @@ class DiffusionModel(pl.LightningModule):
         vae_model_path = self.config.trainer.get(
             "vae_model_path", "stabilityai/sd-vae-ft-mse"
         )
+        self.t5_model_path = t5_model_path
         self.tokenizer = T5Tokenizer.from_pretrained(
             t5_model_path, legacy=False, subfolder="tokenizer"
         )
-        self.text_encoder = T5EncoderModel.from_pretrained(
-            t5_model_path,
-            torch_dtype=torch.bfloat16,
-            use_safetensors=True,
-            subfolder="text_encoder",
-        )
         self.vae = AutoencoderKL.from_pretrained(vae_model_path)
-        self.text_encoder.requires_grad_(False)
         self.vae.requires_grad_(False)
 
+        # precomputed T5 outputs (scripts/cache_t5_embeddings.py), the encoder is only loaded on a miss
+        self.text_encoder = None
+        self.t5_cache = None
+        t5_cache_path = self.config.dataset.get("t5_cache_path")
+        if t5_cache_path:
+            self.t5_cache = T5EmbeddingCache(
+                t5_cache_path,
+                key=t5_cache_key(t5_model_path, self.max_token_length),
+                max_length=self.max_token_length,
+                writable=self.config.dataset.get("t5_cache_fill", True),
+            )
+            logger.info(f"Using T5 embedding cache {self.t5_cache.root} ({len(self.t5_cache)} prompts)")
+        else:
+            self.load_text_encoder()
+
         dit_state_dict = load_torch_file(self.model_path)
         betas = get_named_beta_schedule(
             schedule_name="linear", num_diffusion_timesteps=1000
@@ -111,14 +123,33 @@ class DiffusionModel(pl.LightningModule):
         result = self.model.load_state_dict(dit_state_dict, strict=False)
         logger.info(result)
 
+    def load_text_encoder(self):
+        if self.text_encoder is None:
+            self.text_encoder = T5EncoderModel.from_pretrained(
+                self.t5_model_path,
+                torch_dtype=torch.bfloat16,
+                use_safetensors=True,
+                subfolder="text_encoder",
+            )
+            self.text_encoder.requires_grad_(False)
+        return self.text_encoder
+
     @torch.no_grad()
-    def encode_tokens(self, prompts):
-        self.text_encoder.to(self.target_device)
+    def encode_tokens(self, prompts, cached=None):
+        if self.t5_cache is not None:
+            # embeddings prefetched by the dataloader, or looked up here (includes lazily filled entries)
+            if cached is not None and cached["key"] == self.t5_cache.key:
+                return cached["prompt_embeds"], cached["prompt_attention_mask"]
+            cached = self.t5_cache.lookup(prompts)
+            if cached is not None:
+                return cached
+
+        self.load_text_encoder().to(self.target_device)
         with torch.autocast("cuda", enabled=False):
             text_inputs = self.tokenizer(
                 prompts,
                 padding="max_length",
-                max_length=120,
+                max_length=self.max_token_length,
                 truncation=True,
                 add_special_tokens=True,
                 return_tensors="pt",
@@ -129,11 +160,14 @@ class DiffusionModel(pl.LightningModule):
                 attention_mask=prompt_attention_mask.to(self.target_device),
                 return_dict=True
             )['last_hidden_state']
-            return prompt_embeds, prompt_attention_mask
+
+        if self.t5_cache is not None and self.t5_cache.writable:
+            self.t5_cache.add(prompts, prompt_embeds, prompt_attention_mask)
+        return prompt_embeds, prompt_attention_mask
 
     def forward(self, batch):
         prompts = batch["prompts"]
-        prompt_embeds, prompt_attention_mask = self.encode_tokens(prompts)
+        prompt_embeds, prompt_attention_mask = self.encode_tokens(prompts, batch.get("cached_t5"))
 
         if not batch["is_latent"]:
             self.vae.to(self.target_device)
@@ -181,12 +215,13 @@ class DiffusionModel(pl.LightningModule):
         self.model.eval()
         current_device = self.vae.device
         self.vae.to(self.target_device)
+        text_encoder = self.load_text_encoder().to(self.target_device)
         
         for idx, prompt in tqdm(enumerate(prompts), desc="Sampling", leave=False, total=len(prompts)):
             image = sample(
                 model=self.model,
                 vae=self.vae,
-                text_encoder=self.text_encoder,
+                text_encoder=text_encoder,
                 tokenizer=self.tokenizer,
                 prompt=[prompt],
                 negative_prompt="bad quality, low quality",
@@ -204,6 +239,9 @@ class DiffusionModel(pl.LightningModule):
             logger.log_image(key="samples", images=images, caption=prompts, step=global_step)
         
         self.vae.to(current_device)
+        if self.t5_cache is not None:
+            # training reads the cache, keep the encoder off the gpu between samples
+            text_encoder.cpu()
         self.model.train()
 
     def save_checkpoint(self, model_path, metadata):
@@ -6,7 +6,7 @@ from omegaconf import OmegaConf
 from common.utils import get_class, get_latest_checkpoint, load_torch_file
 from common.logging import logger
 from modules.sdxl_model import StableDiffusionModel
-from modules.scheduler_utils import apply_snr_weight
+from modules.scheduler_utils import apply_snr_weight, get_sigmas
 from lightning.pytorch.utilities.model_summary import ModelSummary
 
 def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
@@ -56,7 +56,7 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
             remainder = sd = load_torch_file(ckpt=latest_ckpt, extract=False)
             if latest_ckpt.endswith(".safetensors"):
                 remainder = safetensors.safe_open(latest_ckpt, "pt").metadata()
-            model.load_state_dict(sd.get("state_dict", sd))
+            model.load_state_dict(sd.get("state_dict", sd), strict=config.trainer.get("save_frozen", True))
             config.global_step = remainder.get("global_step", 0)
             config.current_epoch = remainder.get("current_epoch", 0)
         
@@ -81,18 +81,6 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
     model._fabric_wrapped = fabric
     return model, dataset, dataloader, optimizer, scheduler
 
-def get_sigmas(sch, timesteps, n_dim=4, dtype=torch.float32, device="cuda:0"):
-    sigmas = sch.sigmas.to(device=device, dtype=dtype)
-    schedule_timesteps = sch.timesteps.to(device)
-    timesteps = timesteps.to(device)
-
-    step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
-
-    sigma = sigmas[step_indices].flatten()
-    while len(sigma.shape) < n_dim:
-        sigma = sigma.unsqueeze(-1)
-    return sigma
-
 class SupervisedFineTune(StableDiffusionModel):    
     def forward(self, batch):
         
@@ -144,7 +132,7 @@ class SupervisedFineTune(StableDiffusionModel):
  
         # Add noise to the latents according to the noise magnitude at each timestep
         # (this is the forward diffusion process)
-        noisy_latents = self.noise_scheduler.add_noise(latents, noise, timesteps)
+        noisy_latents = self.noise_scheduler.tables.add_noise(latents, noise, timesteps)
 
         # Predict the noise residual
         noisy_latents = noisy_latents.to(model_dtype)
@@ -153,7 +141,7 @@ class SupervisedFineTune(StableDiffusionModel):
         # Get the target for loss depending on the prediction type
         is_v = advanced.get("v_parameterization", False)
         if is_v:
-            target = self.noise_scheduler.get_velocity(latents, noise, timesteps)
+            target = self.noise_scheduler.tables.get_velocity(latents, noise, timesteps)
         else:
             target = noise
         
@@ -60,7 +60,7 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
             remainder = sd = load_torch_file(ckpt=latest_ckpt, extract=False)
             if latest_ckpt.endswith(".safetensors"):
                 remainder = safetensors.safe_open(latest_ckpt, "pt").metadata()
-            model.load_state_dict(sd.get("state_dict", sd))
+            model.load_state_dict(sd.get("state_dict", sd), strict=config.trainer.get("save_frozen", True))
             config.global_step = remainder.get("global_step", 0)
             config.current_epoch = remainder.get("current_epoch", 0)
         
@@ -181,6 +181,7 @@ class EDMLoss:
             sigma_data=1.0, 
             min_value=1e-3, #0.002, 
             max_value=1e3, #120.0
+            device=y.device,
         )
         self.sigma_data = 1.0
         self.precond = EDMPrecond()
@@ -6,7 +6,7 @@ from omegaconf import OmegaConf
 from common.utils import get_class, get_latest_checkpoint, load_torch_file
 from common.logging import logger
 from modules.sdxl_model_ipadapter import IPAdapter_SDXL
-from modules.scheduler_utils import apply_snr_weight
+from modules.scheduler_utils import apply_snr_weight, get_sigmas
 from lightning.pytorch.utilities.model_summary import ModelSummary
 from torch.utils.data import DataLoader
 import itertools
@@ -40,6 +40,10 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
                                    multireso=config.dataset.multireso,
                                    batch_size=config.trainer.batch_size,
                                    world_size=world_size,
+                                   table_cache_size=config.dataset.get("table_cache_size", 1),
+                                   table_cache_bytes=config.dataset.get("table_cache_bytes"),
+                                   locality=config.dataset.get("locality", 0),
+                                   seed=config.trainer.get("seed", 0),
                                 #    random_shrink_size_cond=config.trainer.batch_size.random_shrink_size_cond,
                                 #    merge_src_cond=config.trainer.batch_size.merge_src_cond,
                                 #    uncond_p=args.uncond_p,
@@ -102,18 +106,6 @@ def setup(fabric: pl.Fabric, config: OmegaConf) -> tuple:
     model._fabric_wrapped = fabric
     return model, dataset, dataloader, optimizer, scheduler
 
-def get_sigmas(sch, timesteps, n_dim=4, dtype=torch.float32, device="cuda:0"):
-    sigmas = sch.sigmas.to(device=device, dtype=dtype)
-    schedule_timesteps = sch.timesteps.to(device)
-    timesteps = timesteps.to(device)
-
-    step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps]
-
-    sigma = sigmas[step_indices].flatten()
-    while len(sigma.shape) < n_dim:
-        sigma = sigma.unsqueeze(-1)
-    return sigma
-
 class SupervisedFineTune(IPAdapter_SDXL):    
     def forward(self, batch):
 
@@ -198,7 +190,7 @@ class SupervisedFineTune(IPAdapter_SDXL):
 
         # Add noise to the latents according to the noise magnitude at each timestep
         # (this is the forward diffusion process)
-        noisy_model_input = self.noise_scheduler.add_noise(latents, noise, timesteps).to(model_dtype)
+        noisy_model_input = self.noise_scheduler.tables.add_noise(latents, noise, timesteps).to(model_dtype)
 
         # Predict the noise residual
             
@@ -209,7 +201,7 @@ class SupervisedFineTune(IPAdapter_SDXL):
         # Get the target for loss depending on the prediction type
         is_v = advanced.get("v_parameterization", False)
         if is_v:
-            target = self.noise_scheduler.get_velocity(latents, noise, timesteps)
+            target = self.noise_scheduler.tables.get_velocity(latents, noise, timesteps)
         else:
             target = noise
         
@@ -0,0 +1,96 @@
+import argparse
+import sys
+import time
+import torch
+
+from pathlib import Path
+from diffusers import DDPMScheduler
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from modules.scheduler_utils import NoiseScheduleTables, get_sigmas
+
+
+def loss_path_reference(scheduler, all_snr, latents, noise, pred, timesteps, gamma):
+    # previous implementation: diffusers add_noise/get_velocity and a per-timestep snr lookup
+    scheduler.add_noise(latents, noise, timesteps)
+    target = scheduler.get_velocity(latents, noise, timesteps)
+    loss = torch.nn.functional.mse_loss(pred, target, reduction="none").mean([1, 2, 3])
+    snr = torch.stack([all_snr[t] for t in timesteps])
+    min_snr_gamma = torch.minimum(snr, torch.full_like(snr, gamma))
+    return (loss * torch.div(min_snr_gamma, snr + 1)).mean()
+
+
+def loss_path_tables(tables, latents, noise, pred, timesteps, gamma):
+    tables.add_noise(latents, noise, timesteps)
+    target = tables.get_velocity(latents, noise, timesteps)
+    loss = torch.nn.functional.mse_loss(pred, target, reduction="none").mean([1, 2, 3])
+    return (loss * tables.snr_weight(timesteps, gamma, v_prediction=True)).mean()
+
+
+def get_sigmas_reference(sch, timesteps, device):
+    sigmas = sch.sigmas.to(device)
+    schedule_timesteps = sch.timesteps.to(device)
+    step_indices = [(schedule_timesteps == t).nonzero().item() for t in timesteps.to(device)]
+    return sigmas[step_indices]
+
+
+def bench(fn, steps, device):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) * 1000 / steps
+
+
+def main(args):
+    device = torch.device(args.device)
+    scheduler = DDPMScheduler(
+        beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", num_train_timesteps=1000, clip_sample=False
+    )
+    tables = NoiseScheduleTables(scheduler.alphas_cumprod, device)
+
+    shape = (args.batch_size, 4, args.size // 8, args.size // 8)
+    latents = torch.randn(shape, device=device)
+    noise = torch.randn(shape, device=device)
+    pred = torch.randn(shape, device=device)
+    timesteps = torch.randint(0, 1000, (args.batch_size,), device=device)
+
+    ref = loss_path_reference(scheduler, tables.snr, latents, noise, pred, timesteps, args.gamma)
+    new = loss_path_tables(tables, latents, noise, pred, timesteps, args.gamma)
+    print(f"loss: reference {ref.item():.6f}, tables {new.item():.6f}")
+
+    ref_ms = bench(lambda: loss_path_reference(scheduler, tables.snr, latents, noise, pred, timesteps, args.gamma), args.steps, device)
+    new_ms = bench(lambda: loss_path_tables(tables, latents, noise, pred, timesteps, args.gamma), args.steps, device)
+    print(f"loss path: reference {ref_ms:.3f} ms, tables {new_ms:.3f} ms")
+
+    sigma_sch = DDPMScheduler.from_config(scheduler.config)
+    sigma_sch.sigmas = tables.sigmas.flip(0).cpu()
+    sigma_sch.timesteps = torch.arange(999, -1, -1)
+    assert torch.equal(get_sigmas(sigma_sch, timesteps, n_dim=1, device=device), get_sigmas_reference(sigma_sch, timesteps, device))
+    ref_ms = bench(lambda: get_sigmas_reference(sigma_sch, timesteps, device), args.steps, device)
+    new_ms = bench(lambda: get_sigmas(sigma_sch, timesteps, n_dim=4, device=device), args.steps, device)
+    print(f"get_sigmas: reference {ref_ms:.3f} ms, vectorized {new_ms:.3f} ms")
+
+    if device.type == "cuda":
+        # any synchronizing call in the loss path raises here
+        torch.cuda.set_sync_debug_mode("error")
+        loss_path_tables(tables, latents, noise, pred, timesteps, args.gamma)
+        torch.cuda.set_sync_debug_mode("default")
+        print("loss path: no host syncs")
+    else:
+        print("run with --device cuda to check for host syncs")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", "-b", type=int, default=16)
+    parser.add_argument("--size", type=int, default=1024, help="image size, latents are size // 8")
+    parser.add_argument("--gamma", type=float, default=5.0)
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    main(args)
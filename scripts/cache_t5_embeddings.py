@@ -0,0 +1,76 @@
+import argparse
+import sys
+import torch
+
+from pathlib import Path
+from omegaconf import OmegaConf
+from tqdm import tqdm
+from transformers import T5EncoderModel, T5Tokenizer
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.utils import get_class
+from data.text_cache import T5EmbeddingCache, t5_cache_key
+
+
+@torch.no_grad()
+def main(args):
+    config = OmegaConf.load(args.config)
+    cache_path = args.output or config.dataset.get("t5_cache_path")
+    assert cache_path, "set dataset.t5_cache_path in the config or pass --output"
+
+    # same encoder settings as DiffusionModel of the pixart modules
+    max_length = get_class(config.target.rsplit(".", 1)[0] + ".DiffusionModel").max_token_length
+    t5_model_path = config.trainer.get("t5_model_path", "PixArt-alpha/PixArt-XL-2-1024-MS")
+    device = torch.device(args.device)
+    tokenizer = T5Tokenizer.from_pretrained(t5_model_path, legacy=False, subfolder="tokenizer")
+    text_encoder = T5EncoderModel.from_pretrained(
+        t5_model_path, torch_dtype=torch.bfloat16, use_safetensors=True, subfolder="text_encoder"
+    ).to(device)
+    cache = T5EmbeddingCache(
+        cache_path,
+        key=t5_cache_key(t5_model_path, max_length),
+        max_length=max_length,
+        writable=True,
+        flush_every=args.flush_every,
+        flush_bytes=args.flush_mb << 20,
+    )
+
+    # note: prompts are cached as stored, randomized process_batch_fn outputs will miss the cache
+    dataset_class = get_class(config.dataset.get("name", "data.AspectRatioDataset"))
+    dataset = dataset_class(batch_size=1, rank=0, dtype=torch.float32, **config.dataset)
+    prompts = list(dict.fromkeys(dataset.store.get_prompt(i) for i in range(len(dataset.store))))
+    print(f"Found {len(prompts)} unique prompts, {len(cache)} already cached")
+
+    for i in tqdm(range(0, len(prompts), args.batch_size), desc="Encoding prompts", ascii=True):
+        chunk = prompts[i : i + args.batch_size]
+        if cache.lookup(chunk) is not None:
+            continue
+        text_inputs = tokenizer(
+            chunk,
+            padding="max_length",
+            max_length=max_length,
+            truncation=True,
+            add_special_tokens=True,
+            return_tensors="pt",
+        )
+        prompt_embeds = text_encoder(
+            input_ids=text_inputs.input_ids.to(device),
+            attention_mask=text_inputs.attention_mask.to(device),
+            return_dict=True,
+        )["last_hidden_state"]
+        cache.add(chunk, prompt_embeds, text_inputs.attention_mask)
+
+    cache.flush()
+    print(f"Cached {len(cache)} prompts in {cache.root}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", type=str, required=True, help="pixart training config, dataset and t5_model_path are taken from it")
+    parser.add_argument("--output", "-o", type=str, default=None, help="cache directory (default: dataset.t5_cache_path)")
+    parser.add_argument("--batch_size", "-b", type=int, default=32)
+    parser.add_argument("--flush_every", type=int, default=4096)
+    parser.add_argument("--flush_mb", type=int, default=2048, help="also write a shard once this many MB are pending")
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+    main(args)
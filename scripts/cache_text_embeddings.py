@@ -0,0 +1,79 @@
+import argparse
+import sys
+import torch
+
+from pathlib import Path
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.utils import get_class, load_torch_file
+from data.text_cache import TextEmbeddingCache, cacheable_embedders, text_cache_key
+from models.sgm import GeneralConditioner
+from modules.config_sdxl_base import model_config
+
+
+def build_conditioner(config, device):
+    # same setup as StableDiffusionModel.build_models, without the unet and vae
+    cond_config = model_config.model.params.conditioner_config.params
+    for conditioner in cond_config.emb_models:
+        if "CLIPEmbedder" not in conditioner.target:
+            continue
+        conditioner.params["device"] = str(device)
+        conditioner.params["max_length"] = config.dataset.get("max_token_length", 75) + 2
+
+    conditioner = GeneralConditioner(**cond_config).to(device)
+    sd = load_torch_file(config.trainer.model_path, device=str(device))
+    sd = {k[len("conditioner."):]: v for k, v in sd.items() if k.startswith("conditioner.")}
+    missing, _ = conditioner.load_state_dict(sd, strict=False)
+    if missing:
+        print(f"Missing Keys: {missing}")
+    return conditioner
+
+
+@torch.no_grad()
+def main(args):
+    config = OmegaConf.load(args.config)
+    cache_path = args.output or config.dataset.get("text_cache_path")
+    assert cache_path, "set dataset.text_cache_path in the config or pass --output"
+
+    device = torch.device(args.device)
+    conditioner = build_conditioner(config, device)
+    cache = TextEmbeddingCache(
+        cache_path,
+        key=text_cache_key(conditioner, Path(config.trainer.model_path).name),
+        embedders=cacheable_embedders(conditioner),
+        writable=True,
+        flush_every=args.flush_every,
+        flush_bytes=args.flush_mb << 20,
+    )
+
+    # note: prompts are cached as stored, randomized process_batch_fn outputs will miss the cache
+    dataset_class = get_class(config.dataset.get("name", "data.AspectRatioDataset"))
+    dataset = dataset_class(batch_size=1, rank=0, dtype=torch.float32, **config.dataset)
+    prompts = list(dict.fromkeys(dataset.store.get_prompt(i) for i in range(len(dataset.store))))
+    print(f"Found {len(prompts)} unique prompts, {len(cache)} already cached")
+
+    for i in tqdm(range(0, len(prompts), args.batch_size), desc="Encoding prompts", ascii=True):
+        chunk = prompts[i : i + args.batch_size]
+        if cache.lookup(chunk) is not None:
+            continue
+        outputs = {}
+        for idx in cache.embedders:
+            outputs[idx] = conditioner.embedders[idx](chunk)
+        cache.add(chunk, outputs)
+
+    cache.flush()
+    print(f"Cached {len(cache)} prompts in {cache.root}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", type=str, required=True, help="training config, dataset and model_path are taken from it")
+    parser.add_argument("--output", "-o", type=str, default=None, help="cache directory (default: dataset.text_cache_path)")
+    parser.add_argument("--batch_size", "-b", type=int, default=32)
+    parser.add_argument("--flush_every", type=int, default=4096)
+    parser.add_argument("--flush_mb", type=int, default=2048, help="also write a shard once this many MB are pending")
+    parser.add_argument("--device", type=str, default="cuda")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,61 @@
+import argparse
+import functools
+import json
+import sys
+import torch
+
+from pathlib import Path
+from omegaconf import OmegaConf
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from data.jsonl_records import JsonlRecords
+from data.llava_dataset import load_image
+from data.vision_feature_cache import (
+    VisionFeatureCache,
+    build_vision_feature_cache,
+    vision_feature_key,
+    vision_feature_spec,
+)
+from models.llava.llava_llama import CLIPVisionTower
+
+
+def main(args):
+    config = OmegaConf.load(args.config)
+    root = args.output or config.dataset.get("vision_feature_cache")
+    assert root, "set dataset.vision_feature_cache in the config or pass --output"
+    mm_config, image_folder = config.model_config, config.dataset.image_folder
+    if mm_config.get("tune_mm_vision_tower"):
+        print("warning: tune_mm_vision_tower is set, cached features go stale as soon as the tower is trained")
+
+    path = Path(root) / vision_feature_key(vision_feature_spec(mm_config, image_folder))
+    if VisionFeatureCache.exists(path):
+        print(f"{path} already exists")
+        return
+
+    # same records the dataset reads, every image is encoded once
+    data_path = config.dataset.data_path
+    samples = JsonlRecords(data_path) if str(data_path).endswith(".jsonl") else json.loads(Path(data_path).read_text())
+    image_files = list(dict.fromkeys(sample["image"] for sample in samples if "image" in sample))
+
+    vision_tower = CLIPVisionTower(mm_config).to(args.device, getattr(torch, args.dtype)).eval()
+    loader = functools.partial(
+        load_image,
+        image_folder=image_folder,
+        processor=vision_tower.image_processor,
+        image_aspect_ratio=mm_config.get("image_aspect_ratio", "square"),
+        image_grid_pinpoints=OmegaConf.to_container(mm_config.image_grid_pinpoints) if "image_grid_pinpoints" in mm_config else None,
+    )
+    build_vision_feature_cache(path, image_files, loader, vision_tower, args.batch_size, args.num_workers)
+    print(f"{len(image_files)} images in {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", type=str, required=True, help="training config, model_config and dataset are taken from it")
+    parser.add_argument("--output", "-o", type=str, default=None, help="cache directory (default: dataset.vision_feature_cache)")
+    parser.add_argument("--batch_size", "-b", type=int, default=32, help="images per vision tower forward")
+    parser.add_argument("--num_workers", "-j", type=int, default=8, help="image loading workers")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--dtype", type=str, default="bfloat16", choices=["float32", "float16", "bfloat16"])
+    args = parser.parse_args()
+    main(args)
@@ -1,7 +1,10 @@
 import argparse
 import functools
 import hashlib
+import io
 import math
+import os
+import sys
 import cv2
 import h5py as h5
 import json
@@ -17,9 +20,15 @@ from diffusers import AutoencoderKL
 from torch.utils.data import DataLoader, Dataset
 from typing import Callable, Generator, Optional
 
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from data.bucket import nearest_ratio_index
+
 
 def load_entry(p: Path, label_ext: str = ".txt"):
-    _img = Image.open(p)
+    # read the file once, the same bytes are decoded and hashed
+    raw = p.read_bytes()
+    sha1 = hashlib.sha1(raw).hexdigest()
+    _img = Image.open(io.BytesIO(raw))
     with p.with_suffix(label_ext).open("r") as f:
         prompt = f.read()
     if _img.mode == "RGB":
@@ -31,12 +40,7 @@ def load_entry(p: Path, label_ext: str = ".txt"):
         img = np.array(baimg)
     else:
         img = np.array(_img.convert("RGB"))
-    return img, prompt
-
-
-def get_sha1(path: Path):
-    with open(path, "rb") as f:
-        return hashlib.sha1(f.read()).hexdigest()
+    return img, prompt, sha1
 
 
 image_suffix = set([".jpg", ".jpeg", ".png", ".gif", ".bmp", ".tiff", ".tif", ".webp"])
@@ -64,7 +68,7 @@ def dirwalk(path: Path, cond: Optional[Callable] = None) -> Generator[Path, None
 
 
 class LatentEncodingDataset(Dataset):
-    def __init__(self, root: str | Path, dtype=torch.float32, no_upscale=False):
+    def __init__(self, root: str | Path, dtype=torch.float32, no_upscale=False, skip_paths=None):
         self.tr = transforms.Compose(
             [
                 transforms.ToTensor(),
@@ -73,6 +77,9 @@ class LatentEncodingDataset(Dataset):
         )
         self.paths = sorted(list(dirwalk(Path(root), is_img)))
         print(f"Found {len(self.paths)} images")
+        if skip_paths:
+            self.paths = [p for p in self.paths if str(p) not in skip_paths]
+            print(f"Skipping already encoded images, {len(self.paths)} left")
         self.dtype = dtype
         self.raw_res = []
 
@@ -95,6 +102,7 @@ class LatentEncodingDataset(Dataset):
         self.length = len(self.raw_res)
         print(f"Loaded {self.length} image sizes")
         
+        self.no_upscale = no_upscale
         self.fit_bucket_func = self.fit_bucket
         if no_upscale:
             self.fit_bucket_func = self.fit_bucket_no_upscale
@@ -127,17 +135,35 @@ class LatentEncodingDataset(Dataset):
         }
 
     def assign_buckets(self):
-        img_res = np.array(self.raw_res)
+        img_res = np.array(self.raw_res, dtype=np.int64).reshape(-1, 2)
         img_ratios = img_res[:, 0] / img_res[:, 1]
-        self.bucket_content = [[] for _ in range(len(self.buckets_sizes))]
-        self.to_ratio = {}
+        self.to_bucket = nearest_ratio_index(img_ratios, self.bucket_ratios)
 
-        # Assign images to buckets
-        for idx, img_ratio in enumerate(img_ratios):
-            diff = np.abs(self.bucket_ratios - img_ratio)
-            bucket_idx = np.argmin(diff)
-            self.bucket_content[bucket_idx].append(idx)
-            self.to_ratio[idx] = self.bucket_ratios[bucket_idx]
+        # to_size[idx] is the (h, w) of the encoded image idx, used to batch images of the same size
+        if not self.no_upscale:
+            self.to_size = self.buckets_sizes[self.to_bucket]
+        else:
+            h, w = img_res[:, 0].copy(), img_res[:, 1].copy()
+            img_area = h * w
+            downsize = img_area > self.target_area
+            scale_factor = np.sqrt(self.target_area / img_area[downsize])
+            w[downsize] = np.floor(w[downsize] * scale_factor / self.divisible) * self.divisible
+            h[downsize] = np.floor(h[downsize] * scale_factor / self.divisible) * self.divisible
+            self.to_size = np.stack([h - h % self.divisible, w - w % self.divisible], axis=1)
+
+    def bucket_batches(self, batch_size: int) -> list[list[int]]:
+        """Group the indices of images with the same encoded size into batches."""
+        if len(self.to_size) == 0:
+            return []
+        _, inverse = np.unique(self.to_size, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(inverse, kind="stable")
+        buckets = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+        return [
+            bucket[i : i + batch_size].tolist()
+            for bucket in buckets
+            for i in range(0, len(bucket), batch_size)
+        ]
 
     @staticmethod
     @functools.cache
@@ -165,8 +191,7 @@ class LatentEncodingDataset(Dataset):
     def fit_bucket(self, idx, img: np.ndarray) -> np.ndarray:
         h, w = img.shape[:2]
         base_ratio = h / w
-        target_ratio = self.to_ratio[idx]
-        target_h, target_w = self.ratio_to_bucket[target_ratio]
+        target_h, target_w = self.buckets_sizes[self.to_bucket[idx]]
         resize_h, resize_w = self.fit_dimensions(base_ratio, target_h, target_w)
         interp = cv2.INTER_AREA if resize_h < h else cv2.INTER_CUBIC
         img = cv2.resize(img, (resize_w, resize_h), interpolation=interp)
@@ -200,11 +225,10 @@ class LatentEncodingDataset(Dataset):
 
     def __getitem__(self, index) -> tuple[list[torch.Tensor], str, str, (int, int)]:
         try:
-            img, prompt = load_entry(self.paths[index])
+            img, prompt, sha1 = load_entry(self.paths[index])
             original_size = img.shape[:2]
             img, dhdw = self.fit_bucket_func(index, img) 
             img = self.tr(img).to(self.dtype)
-            sha1 = get_sha1(self.paths[index])
         except Exception as e:
             print(f"\033[31mError processing {self.paths[index]}: {e}\033[0m")
             return None, self.paths[index], None, None, None, None
@@ -214,6 +238,44 @@ class LatentEncodingDataset(Dataset):
         return len(self.paths)
 
 
+def load_mapping(opt: Path) -> dict:
+    """Load dataset.json and the entries checkpointed by an interrupted run."""
+    dataset_mapping = {}
+    mapping_file = opt / "dataset.json"
+    if mapping_file.exists():
+        dataset_mapping.update(json.loads(mapping_file.read_text()))
+
+    journal_file = opt / "dataset.json.partial"
+    if journal_file.exists():
+        with journal_file.open("r") as f:
+            for line in f:
+                try:
+                    dataset_mapping.update(json.loads(line))
+                except json.JSONDecodeError:
+                    # the last line may be truncated by a crash
+                    break
+    return dataset_mapping
+
+
+def checkpoint_mapping(opt: Path, entries: dict):
+    """Append entries whose latents are flushed to disk to the journal."""
+    if not entries:
+        return
+    with (opt / "dataset.json.partial").open("a") as f:
+        f.write(json.dumps(entries) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_mapping(opt: Path, dataset_mapping: dict):
+    mapping_file = opt / "dataset.json"
+    tmp_file = opt / "dataset.json.tmp"
+    with tmp_file.open("w") as f:
+        json.dump(dataset_mapping, f, indent=4)
+    os.replace(tmp_file, mapping_file)
+    (opt / "dataset.json.partial").unlink(missing_ok=True)
+
+
 def get_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -225,6 +287,14 @@ def get_args():
     parser.add_argument("--num_workers", "-n", type=int, default=4, help="number of dataloader workers")
     parser.add_argument("--model", "-m", type=str, default="stabilityai/sdxl-vae", help="model path")
     parser.add_argument("--subfolder", type=str, default=None, help="use subfolder to locate vae")
+    parser.add_argument("--batch_size", "-b", type=int, default=8, help="images of the same size encoded together")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="vae device")
+    parser.add_argument(
+        "--compression", "-c", type=str, default="gzip", choices=["gzip", "lzf", "none"], help="latent compression"
+    )
+    parser.add_argument(
+        "--checkpoint_steps", type=int, default=100, help="checkpoint the mapping every n batches"
+    )
     args = parser.parse_args()
     return args
 
@@ -235,57 +305,81 @@ if __name__ == "__main__":
     opt = Path(args.output)
     dtype = torch.float32 if args.dtype == "float32" else torch.float16
     num_workers = args.num_workers
+    compression = None if args.compression == "none" else args.compression
 
     vae = AutoencoderKL.from_pretrained(args.model, subfolder=args.subfolder).to(dtype)
     vae.requires_grad_(False)
-    vae.eval().cuda()
+    vae.eval().to(args.device)
 
-    dataset = LatentEncodingDataset(root, dtype=dtype, no_upscale=args.no_upscale)
-    dataloader = DataLoader(dataset, batch_size=None, num_workers=num_workers)
     opt.mkdir(exist_ok=True, parents=True)
     assert opt.is_dir(), f"{opt} is not a directory"
 
-    cache_filename = "cache.h5"
-    dataset_mapping = {}
+    # re-runs skip the images already in the mapping without reading them
+    dataset_mapping = load_mapping(opt)
+    skip_paths = {it["file_path"] for it in dataset_mapping.values()}
 
+    dataset = LatentEncodingDataset(root, dtype=dtype, no_upscale=args.no_upscale, skip_paths=skip_paths)
+    dataloader = DataLoader(
+        dataset,
+        batch_sampler=dataset.bucket_batches(args.batch_size),
+        num_workers=num_workers,
+        collate_fn=list,
+    )
+
+    cache_filename = "cache.h5"
     h5_cache_file = opt / cache_filename
     print(f"Saving cache to {h5_cache_file}")
     file_mode = "w" if not h5_cache_file.exists() else "r+"
 
+    pending = {}
     with h5.File(h5_cache_file, file_mode, libver="latest") as f:
         with torch.no_grad():
-            for img, basepath, prompt, sha1, original_size, dhdw in tqdm(dataloader):
-                if sha1 is None:
-                    print(
-                        f"\033[33mWarning: {basepath} is invalid. Skipping... \033[0m"
-                    )
-                    continue
-
-                h, w = original_size
-                dataset_mapping[sha1] = {
-                    "train_use": True,
-                    "train_caption": prompt,
-                    "file_path": str(basepath),
-                    "train_width": w,
-                    "train_height": h,
-                }
-                if f"{sha1}.latents" in f:
-                    print(
-                        f"\033[33mWarning: {str(basepath)} is already cached. Skipping... \033[0m"
-                    )
-                    continue
-
-                img = img.unsqueeze(0).cuda()
-                latent = vae.encode(img, return_dict=False)[0]
-                latent.deterministic = True
-                latent = latent.sample()[0]
-                d = f.create_dataset(
-                    f"{sha1}.latents",
-                    data=latent.float().cpu().numpy(),
-                    compression="gzip",
-                )
-                d.attrs["scale"] = False
-                d.attrs["dhdw"] = dhdw
-
-    with open(opt / "dataset.json", "w") as f:
-        json.dump(dataset_mapping, f, indent=4)
+            for step, batch in enumerate(tqdm(dataloader)):
+                # images of a batch share the bucket size, group by shape in case decoding disagreed with the header
+                groups = {}
+                for img, basepath, prompt, sha1, original_size, dhdw in batch:
+                    if sha1 is None:
+                        print(
+                            f"\033[33mWarning: {basepath} is invalid. Skipping... \033[0m"
+                        )
+                        continue
+
+                    h, w = original_size
+                    pending[sha1] = {
+                        "train_use": True,
+                        "train_caption": prompt,
+                        "file_path": str(basepath),
+                        "train_width": w,
+                        "train_height": h,
+                    }
+                    if f"{sha1}.latents" in f:
+                        print(
+                            f"\033[33mWarning: {str(basepath)} is already cached. Skipping... \033[0m"
+                        )
+                        continue
+                    groups.setdefault(tuple(img.shape), []).append((img, sha1, dhdw))
+
+                for items in groups.values():
+                    img = torch.stack([it[0] for it in items]).to(args.device)
+                    latent = vae.encode(img, return_dict=False)[0]
+                    latent.deterministic = True
+                    latents = latent.sample().float().cpu().numpy()
+                    for latent, (_, sha1, dhdw) in zip(latents, items):
+                        d = f.create_dataset(
+                            f"{sha1}.latents",
+                            data=latent,
+                            compression=compression,
+                        )
+                        d.attrs["scale"] = False
+                        d.attrs["dhdw"] = dhdw
+
+                if (step + 1) % args.checkpoint_steps == 0:
+                    f.flush()
+                    checkpoint_mapping(opt, pending)
+                    dataset_mapping.update(pending)
+                    pending = {}
+
+        f.flush()
+        dataset_mapping.update(pending)
+
+    save_mapping(opt, dataset_mapping)
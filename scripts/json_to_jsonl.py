@@ -0,0 +1,22 @@
+import argparse
+import sys
+
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from data.jsonl_records import JsonlRecords, convert_json_to_jsonl
+
+
+def main(args):
+    output = args.output or str(Path(args.input).with_suffix(".jsonl"))
+    convert_json_to_jsonl(args.input, output)
+    records = JsonlRecords(output)
+    print(f"Wrote {len(records)} samples to {output}, index {JsonlRecords.index_path(output)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert a LLaVA json data file to indexed jsonl, use it as dataset.data_path")
+    parser.add_argument("--input", "-i", type=str, required=True)
+    parser.add_argument("--output", "-o", type=str, default=None, help="default: input with .jsonl suffix")
+    args = parser.parse_args()
+    main(args)
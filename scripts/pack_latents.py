@@ -0,0 +1,83 @@
+import argparse
+import json
+import sys
+import h5py as h5
+import numpy as np
+
+from pathlib import Path
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from data.latent_pack import PACK_DTYPES, write_latent_pack
+
+SCALE_FACTOR = 0.13025
+
+
+def collect_entries(root: Path, filehandles: dict):
+    """Same selection as LatentStore: every latent of the h5 files that is marked train_use in dataset.json."""
+    mapping_file = next(root.rglob("*.json"))
+    prompt_mapping = json.loads(mapping_file.read_text())
+    has_h5_loc = "h5_path" in next(iter(prompt_mapping.values()))
+
+    entries = []
+    h5_paths = sorted(p for p in root.rglob("*.h5") if "prompt_cache" not in p.stem)
+    for h5_path in h5_paths:
+        fs = h5.File(h5_path, "r", libver="latest")
+        filehandles[h5_path] = fs
+        for k in fs.keys():
+            hashkey = k[:-8]  # ".latents"
+            if hashkey not in prompt_mapping:
+                print(f"\033[33mWarning: key {k} not found in {mapping_file}\033[0m")
+                continue
+
+            it = prompt_mapping[hashkey]
+            if not it["train_use"] or (has_h5_loc and it["h5_path"] != h5_path.name):
+                continue
+
+            entries.append(
+                {
+                    "key": k,
+                    "h5_path": h5_path,
+                    "shape": fs[k].shape,
+                    "prompt": it["train_caption"],
+                    "file_path": it["file_path"],
+                    "train_height": it["train_height"],
+                    "train_width": it["train_width"],
+                    "dhdw": tuple(int(x) for x in fs[k].attrs.get("dhdw", (0, 0))),
+                }
+            )
+    return entries
+
+
+def main(args):
+    root = Path(args.input)
+    output = Path(args.output)
+    if output.is_dir():
+        output = output / "latents.pack"
+
+    filehandles = {}
+    entries = collect_entries(root, filehandles)
+    print(f"Packing {len(entries)} latents into {output}")
+
+    def read_fn(entry):
+        d = filehandles[entry["h5_path"]][entry["key"]]
+        latent = d[:]
+        # packs always hold unscaled latents, same as LatentStore returns them
+        if d.attrs.get("scale", True):
+            latent = 1.0 / SCALE_FACTOR * latent.astype(np.float32)
+        return latent
+
+    with tqdm(total=len(entries), desc="Packing latents", ascii=True) as progress:
+        write_latent_pack(output, entries, read_fn, dtype=args.dtype, progress=progress)
+
+    for fs in filehandles.values():
+        fs.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert cache.h5 + dataset.json latents into a memory-mappable .pack file")
+    parser.add_argument("--input", "-i", type=str, required=True, help="directory written by encode_latents_xl.py")
+    parser.add_argument("--output", "-o", type=str, required=True, help="output .pack file or directory")
+    parser.add_argument("--dtype", type=str, default="float32", choices=PACK_DTYPES)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,53 @@
+import argparse
+import os
+import sys
+import numpy as np
+import torch
+import lightning as pl
+
+from pathlib import Path
+from omegaconf import OmegaConf
+from tqdm import tqdm
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.utils import get_class
+from data.paired_wds import collate_fn
+from modules.dpo_utils import ref_loss_spec, save_ref_losses
+
+
+def main(args):
+    config = OmegaConf.load(args.config)
+    if args.output:
+        config.advanced.dpo_ref_losses = args.output
+    path = config.advanced.get("dpo_ref_losses")
+    assert path, "set advanced.dpo_ref_losses in the config or pass --output"
+    assert not os.path.exists(path), f"{path} already exists"
+
+    # same model and dataset as training; without the stored losses the module keeps its reference unet
+    fabric = pl.Fabric(accelerator=config.lightning.accelerator, devices=1, precision=config.lightning.precision)
+    fabric.seed_everything(config.trainer.seed)
+    model, dataset, _, _, _ = get_class(config.target)(fabric, config)
+    dataloader = torch.utils.data.DataLoader(
+        dataset, collate_fn=collate_fn, batch_size=args.batch_size or config.trainer.batch_size, num_workers=4
+    )
+    dataloader = fabric.setup_dataloaders(dataloader, use_distributed_sampler=False)
+
+    ref_losses = np.full((len(dataset), 2), np.nan, dtype=np.float32)
+    with torch.no_grad():
+        for batch in tqdm(dataloader, desc="Reference losses", ascii=True):
+            inputs = model.prepare_inputs(batch)
+            ref_loss = model.reference_losses(*inputs)
+            # (winner, loser) per pair
+            ref_losses[batch["indices"].cpu().numpy()] = torch.stack(ref_loss.chunk(2), dim=1).cpu().numpy()
+
+    save_ref_losses(path, ref_losses, ref_loss_spec(config))
+    print(f"{len(dataset)} reference losses in {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", type=str, required=True, help="dpo training config")
+    parser.add_argument("--output", "-o", type=str, default=None, help="output .npz (default: advanced.dpo_ref_losses)")
+    parser.add_argument("--batch_size", "-b", type=int, default=None, help="pairs per step (default: trainer.batch_size)")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,37 @@
+import argparse
+import sys
+
+from pathlib import Path
+from omegaconf import OmegaConf
+from transformers import AutoTokenizer
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+from common.utils import get_class
+
+
+def main(args):
+    config = OmegaConf.load(args.config)
+    if args.output:
+        config.dataset.token_cache = args.output
+    assert config.dataset.get("token_cache"), "set dataset.token_cache in the config or pass --output"
+    config.dataset.token_cache_workers = args.num_workers
+
+    # same construction as prepare_dataset of the llm modules, the datasets build their cache on init
+    tokenizer = AutoTokenizer.from_pretrained(config.trainer.model_path)
+    dataset_class = get_class(config.dataset.name)
+    for split in ("train", "val"):
+        if f"{split}_dataset_path" in config.dataset:
+            source = {"dataset_path": config.dataset[f"{split}_dataset_path"]}
+        else:
+            source = {"dataset_args": config.dataset[f"{split}_dataset"]}
+        dataset = dataset_class(tokenizer=tokenizer, **source, **config.dataset)
+        print(f"{split}: {len(dataset)} examples in {dataset.token_cache.path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", type=str, required=True, help="training config, dataset and model_path are taken from it")
+    parser.add_argument("--output", "-o", type=str, default=None, help="cache directory (default: dataset.token_cache)")
+    parser.add_argument("--num_workers", "-j", type=int, default=None, help="tokenizer processes (default: all cpus)")
+    args = parser.parse_args()
+    main(args)